@@ -0,0 +1,256 @@
+"""
+An offline stand-in of the Google APIs that the collectors use: Admin SDK Directory and Reports, Gmail, Cloud Logging and
+Cloud Asset. FakeGoogleApi serves synthetic paginated responses through an httplib2-compatible transport, with a
+configurable dataset size, page size, latency, and injected 429/5xx errors, so collection runs can be measured without
+credentials or network access. HTTP batch requests are served too (the latency is applied once per batch, the errors
+per sub-request).
+
+Usage:
+    api = FakeGoogleApi(users=1000, entries=100000, latency=0.05, error_rate=0.01)
+    api.install()  # every service built by the collectors from now on uses the fake transport
+"""
+import json
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+from email.parser import FeedParser
+
+import httplib2
+
+from collectors.shared import service_pool
+
+class FakeGoogleApi:
+    """
+    Class FakeGoogleApi holds the synthetic dataset and the behaviour (latency, page size, errors) of the fake APIs, and
+    the statistics of the requests that were served. The collections of the dataset are keyed by the last segment of the
+    request path (e.g. ".../users/{userKey}/tokens" => "tokens"), and so are the single objects of get requests. Paths
+    that match neither are served an empty object, and are counted as unknown.
+    """
+
+    def __init__(self, users: int = 100, groups: int = 20, members: int = 25, activities: int = 1000,
+                 entries: int = 10000, assets: int = 1000, page_size: int = 500, latency: float = 0.0,
+                 error_rate: float = 0.0, retry_after: float = 0.0, seed: int = 0):
+        """
+        @param users: the number of users of the domain (all active, with a mailbox)
+        @param groups: the number of groups of the domain
+        @param members: the number of members of every group
+        @param activities: the number of Reports API activities of every application
+        @param entries: the number of Cloud Logging entries of every resource
+        @param assets: the number of Cloud Asset assets of every parent
+        @param page_size: the maximal number of items in a page (lower maxResults/pageSize of the request win)
+        @param latency: the latency (in seconds) of every response
+        @param error_rate: the fraction of the requests that fail with a 429 or a 503 error
+        @param retry_after: the Retry-After header (in seconds) of the injected errors, or None to omit it
+        @param seed: the seed of the error injection
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.stats = {'requests': 0, 'items': 0, 'bytes': 0, 'errors': 0, 'unknown': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # collection => (the key of the items in the response, the number of items, the factory of an item)
+        self.collections = {
+            'users': ('users', users, self._user),
+            'groups': ('groups', groups, self._group),
+            'members': ('members', members, self._member),
+            'tokens': ('items', 2, self._token),
+            'asps': ('items', 1, self._asp),
+            'domains': ('domains', 1, lambda i: {'domainName': 'example.com', 'isPrimary': True, 'verified': True}),
+            'chromeos': ('chromeosdevices', users // 10, lambda i: {'deviceId': f'chromeos-{i}', 'status': 'ACTIVE'}),
+            'mobile': ('mobiledevices', users // 10, lambda i: {'resourceId': f'mobile-{i}', 'status': 'APPROVED'}),
+            'orgunits': ('organizationUnits', 5, lambda i: {'orgUnitPath': f'/ou-{i}', 'name': f'ou-{i}'}),
+            'roles': ('items', 10, lambda i: {'roleId': str(i), 'roleName': f'role-{i}'}),
+            'roleassignments': ('items', 10, lambda i: {'roleAssignmentId': str(i), 'roleId': str(i % 10)}),
+            'applications': ('items', activities, self._activity),
+            'sendAs': ('sendAs', 1, lambda i: {'sendAsEmail': 'user@example.com', 'isPrimary': True}),
+            'delegates': ('delegates', 1, lambda i: {'delegateEmail': f'delegate-{i}@example.com'}),
+            'forwardingAddresses': ('forwardingAddresses', 1, lambda i: {'forwardingEmail': 'fwd@example.org'}),
+            'labels': ('labels', 15, lambda i: {'id': f'Label_{i}', 'name': f'label-{i}', 'type': 'user'}),
+            'messages': ('messages', 200, lambda i: {'id': f'{i:016x}', 'threadId': f'{i:016x}'}),
+            'threads': ('threads', 100, lambda i: {'id': f'{i:016x}', 'snippet': 'synthetic', 'historyId': str(i)}),
+            'history': ('history', 50, lambda i: {'id': str(i), 'messages': [{'id': f'{i:016x}'}],
+                                                  'messagesAdded': [{'message': {'id': f'{i:016x}'}}]}),
+            'entries:list': ('entries', entries, self._entry),
+            'assets': ('assets', assets, self._asset),
+        }
+        # single object => the object
+        self.objects = {
+            'customers': {'id': 'C0000000', 'customerDomain': 'example.com', 'kind': 'admin#directory#customer'},
+            'imap': {'enabled': True, 'autoExpunge': True, 'expungeBehavior': 'archive', 'maxFolderSize': 0},
+            'pop': {'accessWindow': 'disabled', 'disposition': 'leaveInInbox'},
+            'autoForwarding': {'enabled': False},
+            'profile': {'emailAddress': 'user@example.com', 'messagesTotal': 200, 'historyId': '1000'},
+        }
+
+    def install(self) -> None:
+        """
+        Makes every service that the collectors build from now on use the fake transport
+        """
+        service_pool.HTTP_FACTORY = lambda: FakeHttp(self)
+
+    def uninstall(self) -> None:
+        service_pool.HTTP_FACTORY = None
+
+    def handle(self, uri: str, method: str = 'GET', body=None, headers: dict = None) -> tuple:
+        """
+        Serves a single request, or a batch request
+        @return: the response status, headers and content
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'POST' and '/batch' in urllib.parse.urlparse(uri).path:
+            return self._handle_batch(body=body, content_type=(headers or {}).get('content-type'))
+        return self._serve(uri=uri, body=body)
+
+    def _handle_batch(self, body: str, content_type: str) -> tuple:
+        parser = FeedParser()
+        parser.feed(f'content-type: {content_type}\r\n\r\n{body}')
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in parser.close().get_payload():
+            request_line = part.get_payload().split('\n', 1)[0]
+            _, path, _ = request_line.split(' ', 2)
+            status, _, content = self._serve(uri=f'https://fake.googleapis.com{path}')
+            parts.append(f'--{boundary}\r\nContent-Type: application/http\r\n'
+                         f'Content-ID: <response-{part["Content-ID"][1:]}\r\n\r\n'
+                         f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                         f'Content-Type: application/json\r\n\r\n{content}\r\n')
+        return 200, {'content-type': f'multipart/mixed; boundary={boundary}'}, ''.join(parts) + f'--{boundary}--'
+
+    def _serve(self, uri: str, body=None) -> tuple:
+        with self._lock:
+            self.stats['requests'] += 1
+            failed = self.error_rate and self._random.random() < self.error_rate
+            if failed:
+                self.stats['errors'] += 1
+                status = self._random.choice([429, 503])
+        if failed:
+            headers = {'retry-after': str(self.retry_after)} if self.retry_after is not None else {}
+            reason = 'rateLimitExceeded' if status == 429 else 'backendError'
+            return status, headers, json.dumps({'error': {'code': status, 'message': 'injected error',
+                                                          'errors': [{'reason': reason}]}})
+        url = urllib.parse.urlparse(uri)
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        if body:
+            params.update(json.loads(body))
+        segments = url.path.rstrip('/').split('/')
+        collection = segments[-2] if len(segments) > 1 and segments[-2] in ('applications', 'customers') \
+            else segments[-1]
+        if collection in self.objects:
+            content = json.dumps(self.objects[collection])
+        elif len(segments) > 1 and segments[-2] == 'users' and segments[-1].startswith('user'):  # users.get
+            user_key = urllib.parse.unquote(segments[-1])
+            content = json.dumps(FakeGoogleApi._user(int(user_key[len('user'):].partition('@')[0] or 0)))
+        elif len(segments) > 1 and segments[-2] == 'messages':
+            content = json.dumps(FakeGoogleApi._message(segments[-1], params.get('format', 'full')))
+        elif collection in self.collections:
+            content = json.dumps(self._get_page(collection, params))
+        else:
+            with self._lock:
+                self.stats['unknown'] += 1
+            content = json.dumps({})
+        with self._lock:
+            self.stats['bytes'] += len(content)
+        return 200, {}, content
+
+    def _get_page(self, collection: str, params: dict) -> dict:
+        key, total, factory = self.collections[collection]
+        requested_size = params.get('maxResults', params.get('pageSize'))
+        page_size = min(self.page_size, int(requested_size)) if requested_size else self.page_size
+        offset = int(params.get('pageToken') or 0)
+        items = [factory(i) for i in range(offset, min(total, offset + page_size))]
+        with self._lock:
+            self.stats['items'] += len(items)
+        page = {key: items}
+        if offset + page_size < total:
+            page['nextPageToken'] = str(offset + page_size)
+        return page
+
+    @staticmethod
+    def _user(i: int) -> dict:
+        return {'id': str(100000 + i), 'primaryEmail': f'user{i}@example.com', 'name': {'fullName': f'User {i}'},
+                'isAdmin': i == 0, 'suspended': False, 'isMailboxSetup': True, 'isEnrolledIn2Sv': i % 2 == 0,
+                'lastLoginTime': '2022-01-01T00:00:00.000Z', 'creationTime': '2020-01-01T00:00:00.000Z',
+                'orgUnitPath': '/'}
+
+    @staticmethod
+    def _group(i: int) -> dict:
+        return {'id': f'group-{i}', 'email': f'group{i}@example.com', 'name': f'Group {i}', 'directMembersCount': '1'}
+
+    @staticmethod
+    def _member(i: int) -> dict:
+        return {'id': str(100000 + i), 'email': f'user{i}@example.com', 'role': 'MEMBER', 'type': 'USER',
+                'status': 'ACTIVE'}
+
+    @staticmethod
+    def _token(i: int) -> dict:
+        return {'clientId': f'client-{i}.apps.googleusercontent.com', 'displayText': f'App {i}',
+                'scopes': ['https://mail.google.com/'], 'anonymous': False, 'nativeApp': False}
+
+    @staticmethod
+    def _asp(i: int) -> dict:
+        return {'codeId': i, 'name': f'asp-{i}', 'creationTime': '1640995200000', 'lastTimeUsed': '1640995200000'}
+
+    @staticmethod
+    def _activity(i: int) -> dict:
+        return {'id': {'time': f'2022-01-01T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.000Z',
+                       'uniqueQualifier': str(i), 'applicationName': 'login', 'customerId': 'C0000000'},
+                'actor': {'email': f'user{i % 100}@example.com', 'profileId': str(100000 + i % 100)},
+                'ipAddress': f'10.0.{i // 256 % 256}.{i % 256}',
+                'events': [{'type': 'login', 'name': 'login_success',
+                            'parameters': [{'name': 'login_type', 'value': 'google_password'}]}]}
+
+    @staticmethod
+    def _entry(i: int) -> dict:
+        return {'insertId': f'entry-{i}', 'logName': 'projects/project/logs/cloudaudit.googleapis.com%2Factivity',
+                'timestamp': f'2022-01-01T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.000000Z',
+                'resource': {'type': 'gce_instance', 'labels': {'project_id': 'project'}},
+                'protoPayload': {'methodName': 'v1.compute.instances.insert',
+                                 'resourceName': f'projects/project/zones/us-central1-a/instances/vm-{i}',
+                                 'authenticationInfo': {'principalEmail': f'user{i % 100}@example.com'},
+                                 'requestMetadata': {'callerIp': f'10.1.{i // 256 % 256}.{i % 256}'}}}
+
+    @staticmethod
+    def _message(message_id: str, message_format: str) -> dict:
+        message = {'id': message_id, 'threadId': message_id, 'labelIds': ['INBOX'], 'historyId': '1000',
+                   'internalDate': '1640995200000', 'sizeEstimate': 4096, 'snippet': 'synthetic message'}
+        headers = [{'name': 'From', 'value': 'sender@example.org'}, {'name': 'To', 'value': 'user@example.com'},
+                   {'name': 'Subject', 'value': f'Message {message_id}'},
+                   {'name': 'Date', 'value': 'Sat, 1 Jan 2022 00:00:00 +0000'}]
+        if message_format == 'raw':
+            message['raw'] = 'RnJvbTogc2VuZGVyQGV4YW1wbGUub3JnDQoNCnN5bnRoZXRpYw=='
+        elif message_format == 'metadata':
+            message['payload'] = {'headers': headers}
+        else:
+            message['payload'] = {'mimeType': 'text/plain', 'headers': headers,
+                                  'body': {'size': 9, 'data': 'c3ludGhldGlj'}}
+        return message
+
+    @staticmethod
+    def _asset(i: int) -> dict:
+        return {'name': f'//compute.googleapis.com/projects/project/zones/us-central1-a/instances/vm-{i}',
+                'assetType': 'compute.googleapis.com/Instance', 'updateTime': '2022-01-01T00:00:00Z',
+                'resource': {'version': 'v1', 'data': {'name': f'vm-{i}', 'status': 'RUNNING'}}}
+
+
+class FakeHttp:
+    """
+    Class FakeHttp is an httplib2-compatible transport that serves the requests of a single service from a
+    FakeGoogleApi
+    """
+
+    def __init__(self, api: FakeGoogleApi):
+        self.api = api
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        status, response_headers, content = self.api.handle(uri=uri, method=method, body=body, headers=headers)
+        response = httplib2.Response(dict({'content-type': 'application/json'}, status=status, **response_headers))
+        response.reason = 'OK' if status == 200 else 'Error'
+        return response, content.encode('utf-8')
+
+    def close(self):
+        pass
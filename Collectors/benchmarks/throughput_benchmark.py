@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Measures the throughput of representative collection runs against an offline stand-in of the Google APIs (see
+fake_google_api.py): items per second, peak memory and wall time. Every run executes the collector's command line in a
+fresh interpreter, in a temporary working folder (output, cache and log files), with a throwaway service account key.
+
+Scenarios:
+    gw all      - Admin Directory, Reports (all applications) and Gmail settings of --users users
+    gcp logs    - Cloud Logging entries of a single project, --entries entries
+
+Usage: python benchmarks/throughput_benchmark.py [--users 1000] [--entries 100000] [--latency 0.05] [--error-rate 0.01]
+       [--workers 8] [--unthrottled] [--runs 3] [--scenario "gw all"] [-- extra collector arguments]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+COLLECTORS_DIRECTORY = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+BENCHMARKS_DIRECTORY = os.path.join(COLLECTORS_DIRECTORY, 'benchmarks')
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+SCENARIOS = {
+    'gw all': ['gw', '--key-file', '{key_file}', '--super-admin', 'admin@example.com', '--output', '{output}',
+               '--override-cache', '--workers', '{workers}', '{extra}', 'all'],
+    'gcp logs': ['gcp', '--key-file', '{key_file}', '--output', '{output}', '--workers', '{workers}', '{extra}', 'logs',
+                 '--project-id', 'project', '--logs', 'all_logs', '--start-time', '2022-01-01T00:00:00Z',
+                 '--end-time', '2022-01-02T00:00:00Z'],
+}
+
+# Executed in the fresh interpreter of every run, with the run configuration as its first argument
+RUN_CODE = '''
+import json, sys, time
+config = json.loads(sys.argv[1])
+sys.path[:0] = [config['collectors_directory'], config['benchmarks_directory']]
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+from fake_google_api import FakeGoogleApi
+from collectors.shared.rate_limiter import API_QUOTAS
+if config['unthrottled']:
+    for quota in API_QUOTAS.values():
+        quota.update(rate=1000000.0, burst=1000000)
+api = FakeGoogleApi(**config['api'])
+api.install()
+sys.argv = ['mirage.py'] + config['argv']
+if config['argv'][0] == 'gw':
+    from collectors.gw import main
+else:
+    from collectors.gcp import main
+start = time.perf_counter()
+main()
+wall_time = time.perf_counter() - start
+peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else None  # KB => MB
+print(%r + json.dumps(dict(api.stats, wall_time=wall_time, peak_memory=peak_memory)))
+''' % RESULT_PREFIX
+
+
+def create_key_file(path: str) -> None:
+    """
+    Writes a throwaway service account key file, so the collectors can load credentials (the fake APIs never check them)
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption()).decode('utf-8')
+    with open(path, 'w') as f:
+        json.dump({'type': 'service_account', 'project_id': 'project', 'private_key_id': 'benchmark',
+                   'private_key': private_key, 'client_email': 'benchmark@project.iam.gserviceaccount.com',
+                   'client_id': '0', 'token_uri': 'https://oauth2.googleapis.com/token'}, f)
+
+
+def run(scenario: str, api: dict, workers: int, unthrottled: bool, extra: list, key_file: str) -> dict:
+    """
+    Runs a scenario in a fresh interpreter and a fresh working folder
+    @return: the statistics of the run: wall time, peak memory (MB) and the requests, items, bytes and errors that were
+    served by the fake APIs
+    """
+    with tempfile.TemporaryDirectory() as working_folder:
+        argv = []
+        for arg in SCENARIOS[scenario]:
+            if arg == '{extra}':
+                argv.extend(extra)
+            else:
+                argv.append(arg.format(key_file=key_file, output=os.path.join(working_folder, 'output'),
+                                       workers=workers))
+        config = {'collectors_directory': COLLECTORS_DIRECTORY, 'benchmarks_directory': BENCHMARKS_DIRECTORY,
+                  'api': api, 'unthrottled': unthrottled, 'argv': argv}
+        process = subprocess.run([sys.executable, '-c', RUN_CODE, json.dumps(config)], cwd=working_folder,
+                                 capture_output=True, text=True)
+    results = [line for line in process.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if process.returncode != 0 or not results:
+        raise Exception(f'the run of "{scenario}" failed:\n{process.stdout[-2000:]}\n{process.stderr[-2000:]}')
+    return json.loads(results[-1][len(RESULT_PREFIX):])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mirage collection throughput benchmark (offline)')
+    parser.add_argument('--scenario', type=str, choices=list(SCENARIOS), action='append',
+                        help='the scenario to run (default is all the scenarios)')
+    parser.add_argument('--runs', type=int, default=3, help='The number of runs of each scenario')
+    parser.add_argument('--users', type=int, default=200, help='the number of users of the fake domain')
+    parser.add_argument('--groups', type=int, default=50, help='the number of groups of the fake domain')
+    parser.add_argument('--activities', type=int, default=1000,
+                        help='the number of Reports API activities of every application')
+    parser.add_argument('--entries', type=int, default=50000, help='the number of Cloud Logging entries')
+    parser.add_argument('--page-size', type=int, default=500, help='the maximal number of items in a page')
+    parser.add_argument('--latency', type=float, default=0.02, help='the latency (in seconds) of every response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='the fraction of the requests that fail with a 429 or a 503 error')
+    parser.add_argument('--workers', type=int, default=1, help='the --workers argument of the collectors')
+    parser.add_argument('--unthrottled', action='store_true',
+                        help='disable the client side rate limits (API_QUOTAS), to measure the collectors alone')
+    parser.add_argument('extra', nargs=argparse.REMAINDER,
+                        help='additional arguments to the collectors (after "--"), e.g. -- --stream')
+    args = parser.parse_args()
+    extra = args.extra[1:] if args.extra[:1] == ['--'] else args.extra
+
+    api = {'users': args.users, 'groups': args.groups, 'activities': args.activities, 'entries': args.entries,
+           'page_size': args.page_size, 'latency': args.latency, 'error_rate': args.error_rate}
+    with tempfile.TemporaryDirectory() as key_folder:
+        key_file = os.path.join(key_folder, 'key.json')
+        create_key_file(key_file)
+        print(f'{"scenario":<12}{"wall time (s)":>15}{"items":>10}{"items/s":>12}{"peak memory (MB)":>18}'
+              f'{"requests":>10}{"errors":>8}')
+        for scenario in args.scenario or list(SCENARIOS):
+            results = [run(scenario=scenario, api=api, workers=args.workers, unthrottled=args.unthrottled,
+                           extra=extra, key_file=key_file) for _ in range(args.runs)]
+            wall_time = statistics.median(result['wall_time'] for result in results)
+            items = results[0]['items']
+            peak_memory = max(result['peak_memory'] or 0 for result in results)
+            print(f'{scenario:<12}{wall_time:>15.2f}{items:>10}{items / wall_time:>12.1f}{peak_memory:>18.1f}'
+                  f'{results[0]["requests"]:>10}{results[0]["errors"]:>8}')
+            if results[0]['unknown']:
+                print(f'  {results[0]["unknown"]} requests of "{scenario}" were served an empty object')
+
+
+if __name__ == '__main__':
+    main()
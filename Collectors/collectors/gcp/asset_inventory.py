@@ -1,22 +1,47 @@
 import logging
 
-from googleapiclient.discovery import build
-
+from ..shared.checkpoint import CheckpointStore
 from ..shared.module_handler import ModuleHandler
-from ..shared.shared_utils import MemoryCache
 
 SUPPORTED_CONFIGS = ['gcp_map', 'rb_map', 'sa_info', 'sa_key_info', 'all_configs']
+SERVICE_ACCOUNT_ASSET_TYPE = 'iam.googleapis.com/ServiceAccount'
+SERVICE_ACCOUNT_KEY_ASSET_TYPE = 'iam.googleapis.com/ServiceAccountKey'
+HIERARCHY_ASSET_TYPE = 'cloudresourcemanager.googleapis.com/{}'
 
 
 class AssetInventoryManagement(ModuleHandler):
-    def __init__(self, creds, file_handler):
-        super().__init__(creds, file_handler, build('cloudasset', 'v1', credentials=creds, cache=MemoryCache()),
-                         'asset_inventory')
+    SERVICE_NAME = 'cloudasset'
+    SERVICE_VERSION = 'v1'
+    FIELD_PROFILES = {
+        'assets': {
+            'minimal': {'fields': 'nextPageToken,assets(name,assetType,updateTime,iamPolicy/bindings,'
+                                  'resource/parent)'},
+            'triage': {'fields': 'nextPageToken,assets(name,assetType,updateTime,ancestors,iamPolicy,resource/parent,'
+                                 'resource/location,resource/data/name,resource/data/email,resource/data/displayName,'
+                                 'resource/data/disabled,resource/data/keyType,resource/data/validAfterTime,'
+                                 'resource/data/validBeforeTime)'},
+        },
+    }
+
+    def __init__(self, creds, file_handler, **kwargs):
+        super().__init__(creds, file_handler, self.build_service(creds), 'asset_inventory', **kwargs)
 
     @staticmethod
-    def collect_configs(handler, resource_ids: list, config_selection: list):
-        """Collect configuration data based on user-specified configs"""
+    def collect_configs(handler, resource_ids: list, config_selection: list, combined: bool = False):
+        """
+        Collect configuration data based on user-specified configs. In combined mode, the asset types of the configs
+        (all but rb_map) are listed in a single listing per resource (see collect_combined_assets)
+        """
         resource_type = resource_ids[0].split('/')[0]
+        if combined:
+            if 'rb_map' in config_selection or 'all_configs' in config_selection:
+                AssetInventoryManagement.collect_role_bindings(handler, resource_type, resource_ids)
+            # only the first organization is collected, as in the separate listings
+            for resource_id in resource_ids[:1] if resource_type == 'organizations' else resource_ids:
+                outputs = AssetInventoryManagement.get_asset_outputs(resource_type, resource_id, config_selection)
+                if outputs:
+                    AssetInventoryManagement.collect_combined_assets(handler, resource_id, outputs)
+            return
         if 'rb_map' in config_selection or 'all_configs' in config_selection:
             AssetInventoryManagement.collect_role_bindings(handler, resource_type, resource_ids)
         if 'sa_info' in config_selection or 'all_configs' in config_selection:
@@ -74,7 +99,7 @@ class AssetInventoryManagement(ModuleHandler):
         # Set up parameters to execute API call: collect service account(s) info from specified resources
         sa_params = {
             'parent': f'{resource_id}',
-            'assetTypes': 'iam.googleapis.com/ServiceAccount',
+            'assetTypes': SERVICE_ACCOUNT_ASSET_TYPE,
             'contentType': 'RESOURCE'
         }
         # API call
@@ -103,7 +128,7 @@ class AssetInventoryManagement(ModuleHandler):
         # Set up parameters to execute API call: gather info on service account keys from targeted project(s)
         sa_key_params = {
             'parent': f'{resource_id}',
-            'assetTypes': 'iam.googleapis.com/ServiceAccountKey',
+            'assetTypes': SERVICE_ACCOUNT_KEY_ASSET_TYPE,
             'contentType': 'RESOURCE'
         }
         # API call
@@ -134,10 +159,87 @@ class AssetInventoryManagement(ModuleHandler):
         formatted_resource_type = resource_type[:-1].capitalize()
         params = {
             'parent': f'{resource_id}',
-            'assetTypes': f'cloudresourcemanager.googleapis.com/{formatted_resource_type}',
+            'assetTypes': HIERARCHY_ASSET_TYPE.format(formatted_resource_type),
             'contentType': 'RESOURCE'
         }
         isolated_resource_id = resource_id.split('/')[1]
         handler.list_action(function='assets', params=params, inner_object='assets',
                             documented_item=f"resource_hierarchy_{resource_type}_{isolated_resource_id}")
         handler.close()
+
+    @staticmethod
+    def get_asset_outputs(resource_type: str, resource_id: str, config_selection: list) -> dict:
+        """
+        Maps the asset types of the selected RESOURCE configs of a resource to the outputs of their separate listings
+        @return: a dictionary of asset type => documented item (see ModuleHandler.list_action)
+        """
+        select_all = 'all_configs' in config_selection
+        isolated_resource_id = resource_id.split('/')[1]
+        outputs = {}
+        if 'sa_info' in config_selection or select_all:
+            outputs[SERVICE_ACCOUNT_ASSET_TYPE] = f"service_accounts_{isolated_resource_id}"
+        if 'sa_key_info' in config_selection or select_all:
+            outputs[SERVICE_ACCOUNT_KEY_ASSET_TYPE] = f"service_accounts_keys_{isolated_resource_id}"
+        if 'gcp_map' in config_selection or select_all:
+            hierarchy_types = {'organizations': ['organizations', 'folders', 'projects'],
+                               'folders': ['folders', 'projects']}.get(resource_type, [])
+            for hierarchy_type in hierarchy_types:
+                asset_type = HIERARCHY_ASSET_TYPE.format(hierarchy_type[:-1].capitalize())
+                outputs[asset_type] = f"resource_hierarchy_{hierarchy_type}_{isolated_resource_id}"
+        return outputs
+
+    @staticmethod
+    def collect_combined_assets(handler, resource_id: str, outputs: dict):
+        """
+        Collects several asset types of a resource in a single listing, and splits the assets into the output of every
+        asset type (the outputs of the separate listings, written as NDJSON streams)
+        """
+        params = {
+            'parent': f'{resource_id}',
+            'contentType': 'RESOURCE'
+        }
+        # every output keeps the checkpoint of its separate listing, so resumed runs skip completed outputs either way
+        checkpoints = {asset_type: CheckpointStore.get_key(module=handler.module, function='assets',
+                                                           params=dict(params, assetTypes=asset_type),
+                                                           item=documented_item)
+                       for asset_type, documented_item in outputs.items()}
+        completed_types = [asset_type for asset_type, key in checkpoints.items()
+                           if handler.file_handler.checkpoints.is_completed(key)]
+        if completed_types:
+            handler.file_handler.append_log(f'Skipping {handler.module}=>assets of {completed_types} in '
+                                            f'{resource_id}. Already collected by a previous run')
+            outputs = {asset_type: documented_item for asset_type, documented_item in outputs.items()
+                       if asset_type not in completed_types}
+            if not outputs:
+                return
+        params['assetTypes'] = list(outputs)
+        listing = {'completed': False}
+        unexpected_types = set()
+
+        def split_page(assets: list, next_page_token: str) -> None:
+            assets_by_type = {}
+            for asset in assets or []:
+                assets_by_type.setdefault(asset.get('assetType'), []).append(asset)
+            for asset_type, type_assets in assets_by_type.items():
+                if asset_type in outputs:
+                    handler.add_to_log(function='assets', results=type_assets, documented_item=outputs[asset_type],
+                                       writing_mode='a')
+                elif asset_type not in unexpected_types:
+                    unexpected_types.add(asset_type)
+                    handler.file_handler.append_log(f'Dropping the assets of the unexpected asset type {asset_type} '
+                                                    f'from the combined listing of {resource_id}')
+            listing['completed'] = next_page_token is None
+
+        logging.info(f"Collecting {len(outputs)} asset types from [{resource_id}] in a single listing")
+        handler.list_action(function='assets', params=params, inner_object='assets', add_to_log=False,
+                            page_callback=split_page)
+        for asset_type, documented_item in outputs.items():
+            type_params = dict(params, assetTypes=asset_type)
+            summary = handler._wrap_results(function='assets', params=type_params, results=None, results_only=False)
+            del summary['data']
+            summary['combined_asset_types'] = params['assetTypes']
+            handler.end_stream_log(function='assets', summary=summary, documented_item=documented_item)
+            if listing['completed']:
+                handler._save_checkpoint(key=checkpoints[asset_type], function='assets', params=type_params,
+                                         documented_item=documented_item, completed=True)
+        handler.close()
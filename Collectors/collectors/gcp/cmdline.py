@@ -2,6 +2,7 @@ from argparse import ArgumentParser
 
 from .asset_inventory import SUPPORTED_CONFIGS
 from .logging_data import SUPPORTED_LOGS
+from ..shared.module_handler import ModuleHandler
 from ..shared.shared_utils import Validators, DEFAULT_LOG_FILE
 
 
@@ -28,6 +29,25 @@ class Parser:
                                  help='output folder (default is folder "output"')
         self.parser.add_argument('--log-file', type=str,
                                  help=f"output log file path; default filename: [{DEFAULT_LOG_FILE}]")
+        self.parser.add_argument('--stream', action='store_true',
+                                 help='append each results page to an NDJSON output file as soon as it is received '
+                                      '(keeps memory usage flat on large collections)')
+        self.parser.add_argument('--resume', action='store_true',
+                                 help='resume an interrupted collection from the checkpoints of a previous run with '
+                                      'the same output folder (skips completed calls and continues from the saved '
+                                      'page token)')
+        self.parser.add_argument('--fields-profile', type=str, default=ModuleHandler.DEFAULT_FIELDS_PROFILE,
+                                 choices=ModuleHandler.FIELDS_PROFILES,
+                                 help='the fields to collect: "minimal" (identifiers and the key forensic fields), '
+                                      '"triage" (the fields commonly used for triage) or "full" (complete API '
+                                      'responses, default)')
+        self.parser.add_argument('--index-db', type=str, default=None,
+                                 help='path of a SQLite database to index the collected events in during the '
+                                      'collection (time, actor, event name, source IP and resource of every log entry), '
+                                      'for querying them right away')
+        self.parser.add_argument('--workers', type=Validators.positive_int, default=1,
+                                 help='number of API calls to execute concurrently when collecting sharded logs '
+                                      '(default is 1)')
 
     def add_log_collection_args(self):
         self.parser_log.add_argument('--logs', type=str, default=None,
@@ -46,6 +66,12 @@ class Parser:
                                      help='preview logs contained within specified resource ID(s)')
         self.parser_log.add_argument('--custom-logs', type=str, default=None,
                                      help='in comma-delimited format (no spaces), specify custom log(s) for collection')
+        self.parser_log.add_argument('--shards', type=int, default=1,
+                                     help='split the collection time range into this number of time windows, '
+                                          'collected concurrently by the workers (default is 1)')
+        self.parser_log.add_argument('--page-budget', type=int, default=None,
+                                     help='maximal number of pages per time window. A window that exceeds it is split '
+                                          'into two windows (adaptive sharding)')
 
     def add_config_collection_args(self):
         self.parser_config.add_argument('--configs', required=True, type=str, default=None,
@@ -56,6 +82,9 @@ class Parser:
                                         help='in comma-delimited format (no spaces), specify folder ID(s) for config collection')
         self.parser_config.add_argument('--organization-id', type=str, default=None,
                                         help='in comma-delimited format (no spaces), specify organization ID for config collection')
+        self.parser_config.add_argument('--combined', action='store_true',
+                                        help='list the asset types of all the selected configs (except rb_map) in a '
+                                             'single listing per resource, split into the output of every config')
 
     @staticmethod
     def validate_log_collection_args(parser, args):
@@ -69,6 +98,8 @@ class Parser:
                 (args.start_time is None or args.end_time is None):
             parser.error(
                 'specify start and end timestamps: [--start-time YYYY-MM-DDTHH:MM:SSZ] [--end-time YYYY-MM-DDTHH:MM:SSZ]')
+        if args.shards < 1 or (args.page_budget is not None and args.page_budget < 1):
+            parser.error('--shards and --page-budget should be positive numbers')
 
     @staticmethod
     def validate_config_collection_args(parser, args):
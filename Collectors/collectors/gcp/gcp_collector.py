@@ -32,7 +32,8 @@ def main():
             parser.validate_config_collection_args(parser.parser, args)
 
         # Create file handler (for output folder and log file)
-        file_handler = FileHandler(folder=args.output, log_file=args.log_file, cmdline=cmdline)
+        file_handler = FileHandler(folder=args.output, log_file=args.log_file, cmdline=cmdline,
+                                   stream=args.stream, resume=args.resume, index_db=args.index_db)
         log_file = file_handler.log_file
 
         # Basic validations
@@ -50,7 +51,8 @@ def main():
 
                 service_account_credentials = Credentials.from_service_account_file(
                     preview_log_values['credential_file'])
-                preview_handler = LogManagement(creds=service_account_credentials, file_handler=file_handler)
+                preview_handler = LogManagement(creds=service_account_credentials, file_handler=file_handler,
+                                                fields_profile=args.fields_profile)
 
                 LogManagement.collect_preview(preview_handler,
                                               resource_ids=preview_log_values['resource_ids'])
@@ -59,7 +61,8 @@ def main():
                 log_collection_values = parser.user_cli_log_collection(parser.parser, args)
                 service_account_credentials = Credentials.from_service_account_file(
                     log_collection_values['credential_file'])
-                log_handler = LogManagement(creds=service_account_credentials, file_handler=file_handler)
+                log_handler = LogManagement(creds=service_account_credentials, file_handler=file_handler,
+                                            fields_profile=args.fields_profile, workers=args.workers)
 
                 if args.custom_logs:
                     LogManagement.collect_logs(log_handler,
@@ -67,13 +70,17 @@ def main():
                                                log_selection=log_collection_values['log_selection'],
                                                custom_selection=log_collection_values['custom_selection'],
                                                start_time=log_collection_values['start_time'],
-                                               end_time=log_collection_values['end_time'])
+                                               end_time=log_collection_values['end_time'],
+                                               shards=args.shards,
+                                               page_budget=args.page_budget)
                 else:
                     LogManagement.collect_logs(log_handler,
                                                resource_ids=log_collection_values['resource_ids'],
                                                log_selection=log_collection_values['log_selection'],
                                                start_time=log_collection_values['start_time'],
-                                               end_time=log_collection_values['end_time'])
+                                               end_time=log_collection_values['end_time'],
+                                               shards=args.shards,
+                                               page_budget=args.page_budget)
 
         # Config collection
         if args.module == 'configurations':
@@ -81,14 +88,22 @@ def main():
             service_account_credentials = Credentials.from_service_account_file(
                 config_collection_values['credential_file'])
             config_handler = AssetInventoryManagement(creds=service_account_credentials,
-                                                      file_handler=file_handler)
+                                                      file_handler=file_handler,
+                                                      fields_profile=args.fields_profile)
             AssetInventoryManagement.collect_configs(config_handler,
                                                      resource_ids=config_collection_values['resource_ids'],
-                                                     config_selection=config_collection_values['config_selection'])
+                                                     config_selection=config_collection_values['config_selection'],
+                                                     combined=args.combined)
 
         print(f"{BG}Results are tracked in [{DEFAULT_OUTPUT_FOLDER}]{RR}")
         print(f"{BG}More detailed results can be found at [{log_file}]{RR}")
         file_handler.append_log(f'Finished in {(time.time() - script_start_time) / 60} minutes')
+        # Performance summary of the run (latency per API function, throughput, etc.)
+        metrics_report = file_handler.metrics.report()
+        print(metrics_report)
+        file_handler.append_log(metrics_report)
+        file_handler.close()
+        print(f"{BG}Evidence manifest can be found at [{file_handler.manifest_file}]{RR}")
 
     # General exception catcher
     except (Exception, SystemExit) as e:
@@ -97,7 +112,7 @@ def main():
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
             err_msg = f'ERROR => {exc_type.__name__}: {str(exc_obj)}, line {exc_tb.tb_lineno}, in file {fname}.'
             if log_file is not None and os.access(log_file, os.R_OK):
-                file_handler.append_log(data=err_msg)
+                file_handler.append_log(data=err_msg, level='error')
                 logging.info(f'ERROR! please see log {log_file}')
             else:  # in case log file can't be accesses => print to stdout
                 logging.info(err_msg)
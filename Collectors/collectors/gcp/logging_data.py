@@ -1,12 +1,12 @@
 import logging
 import os
 import time
+from concurrent.futures import wait, FIRST_COMPLETED
 
-from googleapiclient.discovery import build
 from tabulate import tabulate
 
 from ..shared.module_handler import ModuleHandler
-from ..shared.shared_utils import DEFAULT_OUTPUT_FOLDER, MemoryCache
+from ..shared.shared_utils import DEFAULT_OUTPUT_FOLDER, parse_time, split_time_range
 
 LOG_PREVIEW_TRACKER = os.path.join(DEFAULT_OUTPUT_FOLDER, "log_preview")
 
@@ -32,9 +32,26 @@ LOG_MAPPING = {
 
 
 class LogManagement(ModuleHandler):
-    def __init__(self, creds, file_handler):
-        super().__init__(creds, file_handler, build('logging', 'v2', credentials=creds, cache=MemoryCache()),
-                         'log_collection')
+    SERVICE_NAME = 'logging'
+    SERVICE_VERSION = 'v2'
+    FIELD_PROFILES = {
+        'entries': {
+            'minimal': {'fields': 'nextPageToken,entries(insertId,timestamp,logName,severity,resource/type,'
+                                  'protoPayload/methodName,protoPayload/authenticationInfo/principalEmail,'
+                                  'protoPayload/requestMetadata/callerIp)'},
+            'triage': {'fields': 'nextPageToken,entries(insertId,timestamp,receiveTimestamp,logName,severity,resource,'
+                                 'protoPayload/serviceName,protoPayload/methodName,protoPayload/resourceName,'
+                                 'protoPayload/authenticationInfo,protoPayload/authorizationInfo,'
+                                 'protoPayload/requestMetadata,protoPayload/status,httpRequest,jsonPayload)'},
+        },
+    }
+
+    # A window of a sharded collection that reaches the page budget stops, and the rest of it is split into
+    # two windows. Windows shorter than MIN_WINDOW_SECONDS are never split
+    MIN_WINDOW_SECONDS = 1
+
+    def __init__(self, creds, file_handler, **kwargs):
+        super().__init__(creds, file_handler, self.build_service(creds), 'log_collection', **kwargs)
 
     @staticmethod
     def check_logs(logs: list):
@@ -42,8 +59,11 @@ class LogManagement(ModuleHandler):
 
     @staticmethod
     def collect_logs(handler, resource_ids: list = None, log_selection: list = None,
-                     custom_selection: list = None, start_time: str = None, end_time: str = None):
-        """Used to gather historical logs against specified project(s), folder(s), and/or organization"""
+                     custom_selection: list = None, start_time: str = None, end_time: str = None,
+                     shards: int = 1, page_budget: int = None):
+        """Used to gather historical logs against specified project(s), folder(s), and/or organization.
+        If shards or page_budget are given, the time range is collected in concurrent windows
+        (see collect_sharded_logs)"""
 
         for rid in resource_ids:
 
@@ -89,17 +109,15 @@ class LogManagement(ModuleHandler):
                     for custom_log in custom_selection:
                         final_format_logs = f'{final_format_logs} OR logName : ("{custom_log}")'
 
+            if shards > 1 or page_budget:
+                LogManagement.collect_sharded_logs(handler, resource_id=rid, log_filter=final_format_logs,
+                                                   start_time=start_time, end_time=end_time, shards=shards,
+                                                   page_budget=page_budget)
+                continue
+
             # Formatted parameters to use in historical log collection API call
-            params = {
-                "body": {
-                    'resourceNames': rid,
-                    'orderBy': "timestamp desc",
-                    'pageSize': 500,
-                    'filter': f'timestamp >= \"{start_time}\" AND '
-                              f'timestamp <= \"{end_time}\" AND '
-                              f'({final_format_logs})'
-                }
-            }
+            params = LogManagement._get_entries_params(resource_id=rid, log_filter=final_format_logs,
+                                                       start_time=start_time, end_time=end_time)
 
             # API call
             formatted_resource_id = rid.split('/')[-1]
@@ -110,7 +128,103 @@ class LogManagement(ModuleHandler):
                                 is_wrapped=True,
                                 results_only=True,
                                 documented_item=f'{formatted_resource_id}')
-            handler.close()
+        # the workers of the handler are shared by the resources, so they are shut down once all were collected
+        handler.close()
+
+    @staticmethod
+    def collect_sharded_logs(handler, resource_id: str, log_filter: str, start_time: str, end_time: str,
+                             shards: int = 1, page_budget: int = None):
+        """
+        Collects the logs of a resource in time windows that are executed concurrently by the handler's workers (the
+        API calls are still throttled by the per-project quota). The time range is split into "shards" windows. If a
+        page budget is given, a window that reaches it is stopped, and the rest of the window (from its oldest
+        collected entry) is split into two new windows. Entries with the exact timestamp of the oldest collected entry
+        may appear in both windows.
+        Each window is written to its own output files, and an index of the windows and their output files is written
+        once all the windows were collected.
+        """
+        formatted_resource_id = resource_id.split('/')[-1]
+        logging.info(f"Collecting logs from [{resource_id}] in {shards} time windows")
+        executor = handler._get_executor()
+        futures = [executor.submit(LogManagement._collect_window, handler, resource_id, log_filter, window,
+                                   page_budget)
+                   for window in split_time_range(start_time, end_time, shards)]
+        index = []
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures.remove(future)
+                try:
+                    window_summary, remainder = future.result()
+                except Exception as ex:
+                    handler.add_error_to_log(function='entries', requested_action='.list', page=0, latest_err=str(ex),
+                                             additions=f'Failed to collect a time window of {resource_id}')
+                    continue
+                index.append(window_summary)
+                if remainder is not None:
+                    futures.extend(executor.submit(LogManagement._collect_window, handler, resource_id, log_filter,
+                                                   window, page_budget)
+                                   for window in split_time_range(*remainder, shards=2, end_inclusive=True))
+        index.sort(key=lambda window_summary: (parse_time(window_summary['end_time']),
+                                               parse_time(window_summary['start_time'])), reverse=True)
+        handler.add_to_log(function='entries_index', documented_item=formatted_resource_id,
+                           results={'resource': resource_id, 'start_time': start_time, 'end_time': end_time,
+                                    'windows': index})
+
+    @staticmethod
+    def _collect_window(handler, resource_id: str, log_filter: str, window: tuple, page_budget: int = None) -> tuple:
+        """
+        Collects the logs of a single time window of collect_sharded_logs.
+        @return: the summary of the window for the index, and the (start, end) of the rest of the window that was not
+        collected due to the page budget (None if the whole window was collected)
+        """
+        window_start, window_end, end_inclusive = window
+        state = {'pages': 0, 'records': 0, 'oldest': None, 'stopped': False}
+
+        def page_callback(entries, next_page_token):
+            state['pages'] += 1
+            state['records'] += len(entries)
+            if entries:
+                state['oldest'] = entries[-1].get('timestamp', state['oldest'])  # entries are ordered newest first
+            if page_budget and next_page_token and state['pages'] >= page_budget and state['oldest'] and \
+                    (parse_time(state['oldest']) - parse_time(window_start)).total_seconds() >= \
+                    LogManagement.MIN_WINDOW_SECONDS:
+                state['stopped'] = True
+                return False
+            return True
+
+        documented_item = f"{resource_id.split('/')[-1]}_{window_start}_{window_end}".replace(':', '_')
+        handler.list_action(function='entries',
+                            params=LogManagement._get_entries_params(resource_id=resource_id, log_filter=log_filter,
+                                                                     start_time=window_start, end_time=window_end,
+                                                                     end_inclusive=end_inclusive),
+                            inner_object='entries',
+                            is_wrapped=True,
+                            results_only=True,
+                            documented_item=documented_item,
+                            service=handler._get_worker_service(),
+                            page_callback=page_callback)
+        window_summary = {'start_time': window_start, 'end_time': window_end, 'end_inclusive': end_inclusive,
+                          'pages': state['pages'], 'records': state['records'],
+                          'outputs': handler.get_output_files(function='entries', documented_item=documented_item)}
+        if not state['stopped']:
+            return window_summary, None
+        window_summary['truncated_at'] = state['oldest']  # the rest of the window is collected by new windows
+        return window_summary, (window_start, state['oldest'])
+
+    @staticmethod
+    def _get_entries_params(resource_id: str, log_filter: str, start_time: str, end_time: str,
+                            end_inclusive: bool = True) -> dict:
+        return {
+            "body": {
+                'resourceNames': resource_id,
+                'orderBy': "timestamp desc",
+                'pageSize': 500,
+                'filter': f'timestamp >= \"{start_time}\" AND '
+                          f'timestamp {"<=" if end_inclusive else "<"} \"{end_time}\" AND '
+                          f'({log_filter})'
+            }
+        }
 
     @staticmethod
     def collect_preview(handler, resource_ids: list = None):
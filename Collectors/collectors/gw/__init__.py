@@ -1,4 +1,5 @@
-from .admin_directory import AdminDirectory, DEFAULT_MAILBOX_SETUP_FILE
+from .admin_directory import AdminDirectory
+from .directory_cache import DirectoryCache, UserDirectory
 from .gmail import Gmail
 from .gw_collector import main
 from .log_events import LogEvents, ALL_APPLICATIONS
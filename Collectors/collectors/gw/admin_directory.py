@@ -1,108 +1,463 @@
 import logging
-import os
-
-from googleapiclient.discovery import build
+import threading
+from datetime import timedelta
 
+from .directory_cache import DirectoryCache, UserDirectory, DEFAULT_CACHE_TTL
+from .group_graph import GroupGraph, GROUP_TYPE
+from .log_events import LogEvents, DEFAULT_OVERLAP_MINUTES
+from ..shared.checkpoint import CheckpointStore
 from ..shared.module_handler import ModuleHandler
-from ..shared.shared_utils import DEFAULT_CACHE_FOLDER, MemoryCache
-
-DEFAULT_USERS_FILE = os.path.join(DEFAULT_CACHE_FOLDER,
-                                  'active_users.tmp')  # Active users are non suspended users that have logged in at least once
-DEFAULT_GROUPS_FILE = os.path.join(DEFAULT_CACHE_FOLDER, 'groups.tmp')
-DEFAULT_MAILBOX_SETUP_FILE = os.path.join(DEFAULT_CACHE_FOLDER,
-                                          'gmail_users.tmp')  # Contains all users that have their mailbox
-# setup enables (and has Gmail access). This file keeps updating every time a new user is queries for its mailboxsetup settings.
+from ..shared.shared_utils import parse_time, format_time
 
 CUSTOMER_DEFAULT_PARAMS = {'customer': 'my_customer'}
-NO_LOGIN_TIME = '1970-01-01T00:00:00.000Z'
+# The fields of the users that are kept by the user directory snapshot (see UserDirectory)
+USER_DIRECTORY_FIELDS = 'id,primaryEmail,lastLoginTime,isMailboxSetup,suspended,orgUnitPath'
+# The admin audit log events that change the users or the groups of the directory cache
+GROUP_CREATE_EVENTS = ['CREATE_GROUP']
+GROUP_DELETE_EVENTS = ['DELETE_GROUP']
+GROUP_RENAME_EVENTS = ['CHANGE_GROUP_EMAIL']
+USER_DELETE_EVENTS = ['DELETE_USER']
+# The listings that can be sharded (see AdminDirectory.list_directory), and how: by the prefix of the email of the user
+# (users.list and mobiledevices.list search queries) or by organizational unit (chromeosdevices.list orgUnitPath).
+# users.list orgUnitPath queries match the children of the organizational unit too, so the users of the root
+# organizational unit cannot be listed by themselves.
+SHARDED_FUNCTIONS = {'users': ('email', 'id'), 'mobiledevices': ('email', 'resourceId'),
+                     'chromeosdevices': ('orgunit', 'deviceId')}
+# The characters that usernames can start with. Apostrophes quote the values of search queries, so they cannot prefix
+# a shard.
+EMAIL_SHARD_PREFIXES = list('abcdefghijklmnopqrstuvwxyz0123456789') + ['_', '-']
+# The number of transitive membership records that are written to the output at once (see collect_group_graph)
+GROUP_CLOSURE_CHUNK_SIZE = 5000
 
 
 class AdminDirectory(ModuleHandler):
-    def __init__(self, creds, file_handler):
-        super().__init__(creds, file_handler, build('admin', 'directory_v1', credentials=creds, cache=MemoryCache()),
-                         'admin_directory')
+    SERVICE_NAME = 'admin'
+    SERVICE_VERSION = 'directory_v1'
+    FIELD_PROFILES = {
+        'users': {
+            'minimal': {'projection': 'basic',
+                        'fields': f'nextPageToken,users({USER_DIRECTORY_FIELDS})'},
+            'triage': {'projection': 'basic',
+                       'fields': 'nextPageToken,users(id,primaryEmail,name/fullName,isAdmin,isDelegatedAdmin,'
+                                 'suspended,archived,creationTime,lastLoginTime,isEnrolledIn2Sv,isEnforcedIn2Sv,'
+                                 'isMailboxSetup,orgUnitPath,aliases)'},
+        },
+        'groups': {
+            'minimal': {'fields': 'nextPageToken,groups(email)'},
+            'triage': {'fields': 'nextPageToken,groups(id,email,name,directMembersCount,adminCreated)'},
+        },
+        'members': {
+            'minimal': {'fields': 'nextPageToken,members(id,email,role,type)'},
+            'triage': {'fields': 'nextPageToken,members(id,email,role,type,status,delivery_settings)'},
+        },
+        'chromeosdevices': {
+            'minimal': {'projection': 'BASIC',
+                        'fields': 'nextPageToken,chromeosdevices(deviceId,serialNumber,status,annotatedUser,lastSync)'},
+            'triage': {'projection': 'BASIC',
+                       'fields': 'nextPageToken,chromeosdevices(deviceId,serialNumber,status,model,osVersion,'
+                                 'orgUnitPath,annotatedUser,annotatedAssetId,lastSync,lastEnrollmentTime)'},
+        },
+        'mobiledevices': {
+            'minimal': {'projection': 'BASIC',
+                        'fields': 'nextPageToken,mobiledevices(resourceId,email,type,status,lastSync)'},
+            'triage': {'projection': 'BASIC',
+                       'fields': 'nextPageToken,mobiledevices(resourceId,deviceId,email,name,type,model,os,status,'
+                                 'deviceCompromisedStatus,firstSync,lastSync)'},
+        },
+        'tokens': {
+            'minimal': {'fields': 'items(clientId,displayText,userKey)'},
+            'triage': {'fields': 'items(clientId,displayText,userKey,scopes,anonymous,nativeApp)'},
+        },
+    }
 
-    def get_all_active_users(self, override=False, mailbox_setup=False):
+    def __init__(self, creds, file_handler, sharded=False, **kwargs):
+        """
+        @param sharded: whether to list the users, ChromeOS devices and mobile devices in concurrent shards (see
+        list_directory)
+        """
+        super().__init__(creds, file_handler, self.build_service(creds), 'admin_directory', **kwargs)
+        self.sharded = sharded
+        self.user_directory = None  # the user directory snapshot of the run, see get_user_directory
+        self.directory_cache = None
+
+    def get_all_active_users(self, override=False, collect_users=False, cache_ttl=DEFAULT_CACHE_TTL):
+        """
+        @return: the active users (non-suspended users that have logged in at least once), see get_user_directory
+        """
+        return self.get_user_directory(override=override, collect_users=collect_users,
+                                       cache_ttl=cache_ttl).get_active_users()
+
+    def get_mailbox_enabled_users(self, override=False, cache_ttl=DEFAULT_CACHE_TTL) -> list:
+        """
+        @return: the active users that have their mailbox setup (and have Gmail access), see get_user_directory
+        """
+        return self.get_user_directory(override=override, cache_ttl=cache_ttl).get_mailbox_users()
+
+    def get_user_directory(self, override=False, collect_users=False, cache_ttl=DEFAULT_CACHE_TTL) -> UserDirectory:
+        """
+        Gets the user directory snapshot of the run. The snapshot is taken once per run: from the directory cache of
+        the tenant if it was refreshed within cache_ttl, by refreshing the cache from the admin audit log since its
+        last refresh, or by listing the directory (see fetch_user_directory).
+        @param override: whether to list the directory even if it is cached
+        @param collect_users: whether the listed directory is also written as the "users" output of the run. The
+        directory is always listed in this case, unless the output was started by a previous run: the output is then
+        resumed, and the snapshot is taken as if the users were not collected.
+        @param cache_ttl: the time (in hours) that a refreshed cache is used for
+        @return: the snapshot, which is also kept in self.user_directory
+        """
+        if self.user_directory is not None and (self.user_directory.written or not collect_users):
+            return self.user_directory
         console = logging.getLogger(__name__)
-        if not os.path.exists(DEFAULT_USERS_FILE) or override:
-            if override and os.path.exists(DEFAULT_USERS_FILE):
-                console.info('Overriding cache')
-            logging.info("Creating temp file with all active users (non-suspended + have logged in)")
-            results = self._get_raw_active_users()
-            if type(results[0]) == list:  # more than one page
-                users = [user_data['primaryEmail'].lower() for page_results in results for user_data in page_results
-                         if user_data['lastLoginTime'] != NO_LOGIN_TIME]
+        cache = self.get_directory_cache(ttl=cache_ttl)
+        refreshed = cache.get_refreshed('users')
+        user_directory = None
+        if collect_users:
+            logging.info("Listing the user directory")
+            refresh_time = DirectoryCache.get_time()
+            user_directory = self.fetch_user_directory(write_output=True)
+            if user_directory is not None:
+                cache.set_users(user_directory, refreshed=refresh_time)
+        if user_directory is None:  # the users output was resumed (or is not collected by the run)
+            if override or refreshed is None:
+                if override and refreshed is not None:
+                    console.info('Overriding cache')
+                logging.info("Listing the user directory")
+                refresh_time = DirectoryCache.get_time()
+                user_directory = self.fetch_user_directory()
+                cache.set_users(user_directory, refreshed=refresh_time)
             else:
-                users = [user_data['primaryEmail'].lower() for user_data in results
-                         if user_data['lastLoginTime'] != NO_LOGIN_TIME]
-
-            # If "mailbox_setup" collection was requested, get all users that have access to Gmail
-            if mailbox_setup:
-                self._handle_gmail_users(results)
-            with open(DEFAULT_USERS_FILE, 'w') as f:
-                for user in users:
-                    f.write(str(user) + '\n')
+                if not cache.is_fresh('users'):
+                    logging.info(f"Refreshing the cached user directory from the admin audit log since {refreshed}")
+                    self._refresh_directory_cache(cache=cache, since=refreshed, parts=['users'])
+                else:
+                    logging.info("Loading users from the directory cache")
+                user_directory = cache.user_directory
+            user_directory.written = collect_users
+        self.user_directory = user_directory
+        logging.info(f'Working with {len(self.user_directory)} users, '
+                     f'{len(self.user_directory.get_active_users())} active users')
+        return self.user_directory
+
+    def fetch_user_directory(self, write_output=False):
+        """
+        Lists the users of the domain once, keeping a snapshot of the fields that select the users of the other
+        collections (see UserDirectory).
+        @param write_output: whether to write the listed users as the "users" output. Otherwise, only non-suspended
+        users are listed, with the fields of the snapshot only.
+        @return: the snapshot, or None if the "users" output was started by a previous run. The output is then resumed
+        (or skipped if it was completed), and its pages cannot feed the snapshot.
+        """
+        user_directory = UserDirectory(written=write_output)
+        if write_output:
+            checkpoint_key = CheckpointStore.get_key(module=self.module, function='users',
+                                                     params=CUSTOMER_DEFAULT_PARAMS, item=None)
+            if self.file_handler.checkpoints.get(checkpoint_key) is not None:
+                self.file_handler.append_log('Users output was started by a previous run, resuming it')
+                self.list_directory(function='users', params=CUSTOMER_DEFAULT_PARAMS, inner_object='users')
+                return None
+            self.list_directory(function='users', params=CUSTOMER_DEFAULT_PARAMS, inner_object='users',
+                                page_callback=user_directory.add_page)
         else:
-            logging.info("Loading users from temp file ...")
-            users = []
-            with open(DEFAULT_USERS_FILE, 'r') as f:
-                for line in f:
-                    users.append(line.rstrip())
-            console.info("Users loaded from temp file")
-        return users
-
-    def get_all_groups(self, override=False):
-        if not os.path.exists(DEFAULT_GROUPS_FILE) or override:
-            if override and os.path.exists(DEFAULT_GROUPS_FILE):
+            self.list_directory(function='users', params=dict(CUSTOMER_DEFAULT_PARAMS, query='isSuspended=false',
+                                                              projection='basic',
+                                                              fields=f'nextPageToken,users({USER_DIRECTORY_FIELDS})'),
+                                inner_object='users', add_to_log=False, page_callback=user_directory.add_page)
+        logging.info(f'Listed {len(user_directory)} users, {len(user_directory.get_mailbox_users())} active users '
+                     f'with mailbox enabled.')
+        return user_directory
+
+    def list_directory(self, function: str, params: dict, inner_object: str, add_to_log: bool = True,
+                       page_callback=None) -> None:
+        """
+        Executes list_action for the users, ChromeOS devices or mobile devices of the domain. If the handler is sharded
+        (and has more than one worker), the listing is split into shards that are listed concurrently and merged into
+        a single output (see SHARDED_FUNCTIONS and ModuleHandler.sharded_list_action).
+        """
+        if not self.sharded or self.workers == 1:
+            if self.sharded:
+                self.file_handler.append_log(f'Listing {self.module}=>{function} without shards: sharded listings '
+                                             f'require more than one worker')
+            self.list_action(function=function, params=params, inner_object=inner_object, add_to_log=add_to_log,
+                             page_callback=page_callback)
+            return
+        id_key = SHARDED_FUNCTIONS[function][1]
+        # the shards overlap, so the items are deduplicated by their ID, which the fields mask has to include
+        fields = self.get_projected_params(function=function, params=params).get('fields')
+        if fields is not None:
+            params = dict(params, fields=AdminDirectory._add_item_field(fields, inner_object, id_key))
+        listed_ids = set()
+
+        def track_page(items: list, next_page_token: str) -> None:
+            listed_ids.update(list_item.get(id_key) for list_item in items or [])
+            if page_callback is not None:
+                page_callback(items, next_page_token)
+
+        completed = self.sharded_list_action(function=function, params=params,
+                                             shards=self.get_shards(function, params), inner_object=inner_object,
+                                             id_key=id_key, add_to_log=add_to_log, page_callback=track_page)
+        if completed and SHARDED_FUNCTIONS[function][0] == 'email':
+            self._check_email_shards(function=function, params=params, inner_object=inner_object, id_key=id_key,
+                                     listed_ids=listed_ids)
+
+    def _check_email_shards(self, function: str, params: dict, inner_object: str, id_key: str,
+                            listed_ids: set) -> None:
+        """
+        Email shards cover the addresses that start with EMAIL_SHARD_PREFIXES only, so the IDs of all the items are
+        listed (unsharded, without other fields) and compared with the items of the shards
+        """
+        missing_ids = []
+
+        def find_missing(items: list, next_page_token: str) -> None:
+            missing_ids.extend(list_item.get(id_key) for list_item in items or []
+                               if list_item.get(id_key) not in listed_ids)
+
+        self.list_action(function=function, params=dict(params, fields=f'nextPageToken,{inner_object}({id_key})'),
+                         inner_object=inner_object, add_to_log=False, page_callback=find_missing)
+        if missing_ids:
+            message = (f'WARNING: {len(missing_ids)} {function} were not listed by the email shards (addresses that '
+                       f'start with other characters, or items created during the listing). First IDs: '
+                       f'{missing_ids[:10]}')
+            logging.info(message)
+            self.file_handler.append_log(message)
+
+    @staticmethod
+    def _add_item_field(fields: str, inner_object: str, field: str) -> str:
+        """
+        @return: the fields mask of a listing, with the field added to the mask of its items (if they are masked)
+        """
+        start = fields.find(f'{inner_object}(')
+        if start == -1:
+            return fields
+        start += len(inner_object) + 1
+        if field in fields[start:fields.find(')', start)].split(','):
+            return fields
+        return f'{fields[:start]}{field},{fields[start:]}'
+
+    def get_shards(self, function: str, params: dict) -> list:
+        """
+        @return: the params of every shard of a listing (see SHARDED_FUNCTIONS)
+        """
+        if SHARDED_FUNCTIONS[function][0] == 'orgunit':
+            org_units = {'/'}
+            self.list_action(function='orgunits', params={'customerId': params.get('customerId', 'my_customer'),
+                                                          'type': 'all',
+                                                          'fields': 'organizationUnits(orgUnitPath)'},
+                             inner_object='organizationUnits', add_to_log=False,
+                             page_callback=lambda page, next_page_token: org_units.update(
+                                 org_unit['orgUnitPath'] for org_unit in page or []))
+            return [dict(params, orgUnitPath=org_unit, includeChildOrgunits=False) for org_unit in sorted(org_units)]
+        return [dict(params, query=' '.join(filter(None, [params.get('query'), f'email:{prefix}*'])))
+                for prefix in EMAIL_SHARD_PREFIXES]
+
+    def collect_group_graph(self, groups: list) -> None:
+        """
+        Collects the group memberships as a graph (see GroupGraph) instead of listing the derived members of every
+        group. The direct members of the groups, and of the groups that are nested in them, are listed concurrently
+        (a wave of groups at a time) and written as the "group_edges" output. The transitive members of every collected
+        group are then computed locally and written as the "group_closure" output, with the depth of the membership.
+        @param groups: the emails of the groups to collect the memberships of
+        """
+        checkpoint_params = {'groupKeys': sorted(groups)}
+        checkpoint_key = CheckpointStore.get_key(module=self.module, function='group_closure',
+                                                 params=checkpoint_params, item=None)
+        if self.file_handler.checkpoints.is_completed(checkpoint_key):
+            self.file_handler.append_log(f'Skipping {self.module}=>group_closure, params: {checkpoint_params}. '
+                                         f'Already collected by a previous run')
+            return
+        graph = GroupGraph()
+        lock = threading.Lock()
+        stats = {'incomplete_groups': 0}
+        collected = []  # the nodes of the groups that their members were listed
+        wave = sorted(set(group.lower() for group in groups))
+        listed = set(wave)
+        while wave:
+            discovered = set()
+            tasks = [(group, graph.get_node(group, GROUP_TYPE)) for group in wave]
+            collected.extend(node for group, node in tasks)
+
+            def list_group(group: str, node: int, in_worker: bool = False) -> None:
+                listing = {'completed': False}
+
+                def add_members(members: list, next_page_token: str) -> None:
+                    edges = []
+                    with lock:
+                        for member in members or []:
+                            key = (member.get('email') or member.get('id', '')).lower()
+                            graph.add_edge(node, graph.get_node(key, member.get('type')))
+                            if member.get('type') == GROUP_TYPE and key not in listed:
+                                discovered.add(key)
+                            edges.append({'group': group, 'member': key, 'type': member.get('type'),
+                                          'role': member.get('role'), 'status': member.get('status')})
+                        if edges:  # the pages of the workers are appended to the stream one at a time
+                            self.add_to_log(function='group_edges', results=edges, writing_mode='a')
+                    listing['completed'] = next_page_token is None
+
+                self.list_action(function='members', params={'groupKey': group}, inner_object='members',
+                                 add_to_log=False, service=self._get_worker_service() if in_worker else None,
+                                 page_callback=add_members)
+                if not listing['completed']:
+                    with lock:
+                        stats['incomplete_groups'] += 1
+
+            if self.workers == 1 or len(tasks) < 2:
+                for group, node in tasks:
+                    list_group(group, node)
+            else:
+                executor = self._get_executor()
+                futures = {group: executor.submit(list_group, group=group, node=node, in_worker=True)
+                           for group, node in tasks}
+                for group, future in futures.items():
+                    try:
+                        future.result()
+                    except Exception as ex:
+                        self.add_error_to_log(function='members', requested_action='.list', page=0, latest_err=str(ex),
+                                              additions=f'Failed to list the members of the group {group}')
+                        stats['incomplete_groups'] += 1
+            wave = sorted(discovered)
+            listed.update(wave)
+
+        graph.build()
+        closure_edges = 0
+        chunk = []
+        for group in collected:
+            for member, depth in graph.get_transitive_members(group):
+                chunk.append({'group': graph.keys[group], 'member': graph.keys[member], 'type': graph.types[member],
+                              'depth': depth})
+            if len(chunk) >= GROUP_CLOSURE_CHUNK_SIZE:
+                self.add_to_log(function='group_closure', results=chunk, writing_mode='a')
+                closure_edges += len(chunk)
+                chunk = []
+        if chunk:
+            self.add_to_log(function='group_closure', results=chunk, writing_mode='a')
+            closure_edges += len(chunk)
+        self.print_stdout(f'{len(collected)} groups, {graph.edges} memberships and {closure_edges} transitive '
+                          f'memberships were found')
+        self.file_handler.append_log(f'Collected the group graph: {len(collected)} groups, {len(graph)} members, '
+                                     f'{graph.edges} direct memberships, {closure_edges} transitive memberships, '
+                                     f'{stats["incomplete_groups"]} incomplete groups')
+        for function, records in [('group_edges', graph.edges), ('group_closure', closure_edges)]:
+            summary = self._wrap_results(function=function, params=checkpoint_params, results=None,
+                                         results_only=False)
+            del summary['data']
+            summary.update({'groups': len(collected), 'records': records,
+                            'incomplete_groups': stats['incomplete_groups']})
+            self.end_stream_log(function=function, summary=summary)
+        if stats['incomplete_groups'] == 0:
+            self._save_checkpoint(key=checkpoint_key, function='group_closure', params=checkpoint_params,
+                                  completed=True)
+
+    def get_all_groups(self, override=False, cache_ttl=DEFAULT_CACHE_TTL):
+        cache = self.get_directory_cache(ttl=cache_ttl)
+        refreshed = cache.get_refreshed('groups')
+        if override or refreshed is None:
+            if override and refreshed is not None:
                 logging.info('Overriding cache')
-            logging.info("Creating temp file with all the groups")
-            results = self.list_action(function='groups',
-                                       params=CUSTOMER_DEFAULT_PARAMS,
-                                       inner_object='groups', add_to_log=False)
-            if type(results[0]) == list:  # more than one page
-                groups = [group_data['email'].lower() for page_results in results for group_data in page_results]
-            else:  # one page
-                groups = [group_data['email'].lower() for group_data in results]
-            with open(DEFAULT_GROUPS_FILE, 'w') as f:
-                for group in groups:
-                    f.write(str(group) + '\n')
+            logging.info("Listing all the groups")
+            refresh_time = DirectoryCache.get_time()
+            groups = set()
+            self.list_action(function='groups', params=CUSTOMER_DEFAULT_PARAMS, inner_object='groups',
+                             add_to_log=False, fields_profile='minimal',
+                             page_callback=lambda page, next_page_token: groups.update(
+                                 group_data['email'].lower() for group_data in page or []))
+            cache.set_groups(groups, refreshed=refresh_time)
+        elif not cache.is_fresh('groups'):
+            logging.info(f"Refreshing the cached groups from the admin audit log since {refreshed}")
+            self._refresh_directory_cache(cache=cache, since=refreshed, parts=['groups'])
         else:
-            logging.info("Loading groups from temp file")
-            groups = []
-            with open(DEFAULT_GROUPS_FILE, 'r') as f:
-                for line in f:
-                    groups.append(line.rstrip())
+            logging.info("Loading groups from the directory cache")
+        groups = sorted(cache.groups)
         logging.info(f"Working with {len(groups)} groups. First group is: {groups[0] if len(groups) > 0 else 'None'}")
         return groups
 
-    def get_mailbox_enabled_users(self) -> list:
-        """
-        Gets all uses with mailbox enabled, save them to temp file and returns them.
-        Use this function if the main script worked with specific users, hence not all users were collected
-        with their mailbox enables settings.
-        """
-        results = self._get_raw_active_users()
-        return self._handle_gmail_users(results=results)
-
-    def _handle_gmail_users(self, results):
-        logging.info('Gathering all active users with mailbox enabled.')
-        if type(results[0]) == list:  # more than one page
-            gmail_users = [user_data['primaryEmail'].lower() for page_results in results for user_data in page_results
-                           if user_data['lastLoginTime'] != NO_LOGIN_TIME and user_data['isMailboxSetup']]
-        else:  # one page
-            gmail_users = [user_data['primaryEmail'].lower() for user_data in results
-                           if user_data['lastLoginTime'] != NO_LOGIN_TIME and user_data['isMailboxSetup']]
-
-        if len(gmail_users) > 0:
-            with open(DEFAULT_MAILBOX_SETUP_FILE, 'w') as f:
-                for gmail_user in gmail_users:
-                    f.write(str(gmail_user) + '\n')
-        logging.info(f'Collected {len(gmail_users)} active users with mailbox enabled.')
-        return gmail_users
-
-    def _get_raw_active_users(self):
-        params = CUSTOMER_DEFAULT_PARAMS.copy()
-        params['query'] = 'isSuspended=false'
-        results = self.list_action(function='users', params=CUSTOMER_DEFAULT_PARAMS,
-                                   inner_object='users', add_to_log=False)
-        return results
+    def get_directory_cache(self, ttl=DEFAULT_CACHE_TTL) -> DirectoryCache:
+        """
+        @return: the directory cache of the tenant (customer ID) and the super admin of the handler. If the customer ID
+        cannot be resolved, the cache is kept in memory only (the directory is listed by the run).
+        """
+        if self.directory_cache is None:
+            customer = self.list_action(function='customers', params={'customerKey': 'my_customer', 'fields': 'id'},
+                                        is_get_action=True, add_to_log=False)
+            customer_id = customer[0]['id'] if customer else None
+            if customer_id is None:
+                self.file_handler.append_log('The customer ID of the tenant cannot be resolved, the directory cache '
+                                             'is not used')
+            self.directory_cache = DirectoryCache(customer_id=customer_id, super_admin=self.creds._subject, ttl=ttl)
+        return self.directory_cache
+
+    def _refresh_directory_cache(self, cache: DirectoryCache, since: str, parts: list) -> None:
+        """
+        Applies the changes of the admin audit log since the last refresh of the cache: users that were changed are
+        fetched again, deleted users are removed and groups that were created, deleted or renamed are updated. Users
+        that had never logged in are checked against the successful logins since the refresh.
+        @param since: the time (RFC3339) the cache was refreshed
+        @param parts: the parts of the cache to refresh ("users", "groups")
+        """
+        refresh_time = DirectoryCache.get_time()
+        start_time = format_time(parse_time(since) - timedelta(minutes=DEFAULT_OVERLAP_MINUTES))
+        reports_handler = LogEvents(creds=self.creds, file_handler=self.file_handler)
+        events = []  # (event name, parameters), from the oldest
+
+        def add_events(activities: list, next_page_token: str) -> None:
+            for activity in activities or []:
+                for event in activity.get('events', []):
+                    events.append((event.get('name'), {parameter['name']: parameter.get('value')
+                                                       for parameter in event.get('parameters', [])}))
+
+        reports_handler.list_action(function='activities',
+                                    params={'userKey': 'all', 'applicationName': 'admin', 'startTime': start_time,
+                                            'fields': 'nextPageToken,items(events(name,parameters(name,value)))'},
+                                    inner_object='items', add_to_log=False, page_callback=add_events)
+        events.reverse()  # activities are listed from the newest
+
+        if 'groups' in parts:
+            groups = set(cache.groups)
+            for name, parameters in events:
+                group = (parameters.get('GROUP_EMAIL') or '').lower()
+                if name in GROUP_CREATE_EVENTS and group:
+                    groups.add(group)
+                elif name in GROUP_DELETE_EVENTS:
+                    groups.discard(group)
+                elif name in GROUP_RENAME_EVENTS and parameters.get('NEW_VALUE'):
+                    groups.discard(group)
+                    groups.add(parameters['NEW_VALUE'].lower())
+            cache.set_groups(groups, refreshed=refresh_time)
+
+        if 'users' in parts:
+            user_directory = cache.user_directory
+            deleted, changed = set(), set()
+            for name, parameters in events:
+                user = (parameters.get('USER_EMAIL') or '').lower()
+                if not user:
+                    continue
+                if name in USER_DELETE_EVENTS:
+                    deleted.add(user)
+                    changed.discard(user)
+                else:
+                    changed.add(user)
+                    deleted.discard(user)
+            for user in deleted:
+                user_directory.remove_user(user)
+            # users that logged in for the first time became active
+            never_logged_in = user_directory.get_never_logged_in_users()
+            if never_logged_in:
+                logins = set()
+                reports_handler.list_action(function='activities',
+                                            params={'userKey': 'all', 'applicationName': 'login',
+                                                    'eventName': 'login_success', 'startTime': start_time,
+                                                    'fields': 'nextPageToken,items(actor/email)'},
+                                            inner_object='items', add_to_log=False,
+                                            page_callback=lambda page, next_page_token: logins.update(
+                                                activity['actor']['email'].lower() for activity in page or []
+                                                if activity.get('actor', {}).get('email')))
+                changed |= never_logged_in & logins
+            for user in changed:
+                user_data = self.list_action(function='users', params={'userKey': user, 'projection': 'basic',
+                                                                       'fields': USER_DIRECTORY_FIELDS},
+                                             is_get_action=True, add_to_log=False)
+                if user_data:
+                    user_directory.remove_user(user)  # the user may have been renamed
+                    user_directory.add_user(user_data[0])
+            self.file_handler.append_log(f'Refreshed the directory cache from {len(events)} admin audit log events: '
+                                         f'{len(changed)} changed users, {len(deleted)} deleted users')
+            cache.set_users(user_directory, refreshed=refresh_time)
+        reports_handler.close()
@@ -1,6 +1,9 @@
 from argparse import ArgumentParser
 
-from .log_events import ALL_APPLICATIONS
+from .gmail import FETCH_FORMATS
+from .directory_cache import DEFAULT_CACHE_TTL
+from .log_events import ALL_APPLICATIONS, DEFAULT_OVERLAP_MINUTES, HEAVY_APPLICATIONS
+from ..shared.module_handler import ModuleHandler
 from ..shared.shared_utils import DEFAULT_LOG_FILE, Validators
 
 
@@ -68,9 +71,45 @@ class Parser:
                                  help='output folder (default is folder "output")')
         self.parser.add_argument('--log-file', type=str,
                                  help=f"output log file path; default filename: [{DEFAULT_LOG_FILE}]")
+        self.parser.add_argument('--stream', action='store_true',
+                                 help='append each results page to an NDJSON output file as soon as it is received '
+                                      '(keeps memory usage flat on large collections)')
+        self.parser.add_argument('--resume', action='store_true',
+                                 help='resume an interrupted collection from the checkpoints of a previous run with '
+                                      'the same output folder (skips completed calls and continues from the saved '
+                                      'page token)')
+        self.parser.add_argument('--fields-profile', type=str, default=ModuleHandler.DEFAULT_FIELDS_PROFILE,
+                                 choices=ModuleHandler.FIELDS_PROFILES,
+                                 help='the fields to collect: "minimal" (identifiers and the key forensic fields), '
+                                      '"triage" (the fields commonly used for triage) or "full" (complete API '
+                                      'responses, default)')
+        self.parser.add_argument('--consolidate', action='store_true',
+                                 help='append the results of all the users/groups of a function to a single NDJSON '
+                                      'output file (with an index of the items), instead of a file per item')
+        self.parser.add_argument('--rotate-size', type=Validators.positive_int, default=None,
+                                 help='maximal size in MB of a consolidated output file, a new part is started once '
+                                      'it is reached (default is no rotation)')
+        self.parser.add_argument('--index-db', type=str, default=None,
+                                 help='path of a SQLite database to index the collected events in during the '
+                                      'collection (time, actor, event name, source IP and resource of every activity event), '
+                                      'for querying them right away')
         self.parser.add_argument('--override-cache', action='store_true',
-                                 help='override active_users and groups cache that is created (use this flag in case '
-                                      'the investigated environment was changed or once a cache refresh is required)')
+                                 help='override the users and groups directory cache of the tenant (use this flag in '
+                                      'case the investigated environment was changed or once a cache refresh is '
+                                      'required)')
+        self.parser.add_argument('--cache-ttl', type=Validators.non_negative_float, default=DEFAULT_CACHE_TTL,
+                                 help='the time (in hours) that the users and groups directory cache of the tenant is '
+                                      'used for, before it is refreshed from the admin audit log (default is '
+                                      f'{DEFAULT_CACHE_TTL})')
+        self.parser.add_argument('--workers', type=Validators.positive_int, default=1,
+                                 help='number of API calls to execute concurrently when collecting information for '
+                                      'multiple users, groups or applications (default is 1)')
+        self.parser.add_argument('--sharded', action='store_true',
+                                 help='list the users, ChromeOS devices and mobile devices of large domains in shards '
+                                      '(email prefixes or organizational units) that are listed concurrently by the '
+                                      'workers, merged into a single NDJSON output (requires --workers of 2 or more)')
+        self.parser.add_argument('--batch', action='store_true',
+                                 help='pack per-user and per-group single page API calls into HTTP batch requests')
         self.parser.add_argument('--super-admin', type=str, required=True,
                                  help='the Super Admin privileged user email address being used to gather '
                                       'information on behalf of the service account')
@@ -82,6 +121,11 @@ class Parser:
         self.admin_directory_members_parser.add_argument('--groups', type=str, required=True,
                                                          help='in comma-delimited format (no spaces), specify groups to acquire '
                                                               'their members (enter "all_groups" for all groups)')
+        self.admin_directory_members_parser.add_argument('--graph', action='store_true',
+                                                         help='collect the direct memberships of the groups (and of '
+                                                              'their nested groups) concurrently and compute the '
+                                                              'transitive memberships locally, instead of listing the '
+                                                              'derived members of every group')
         self.admin_directory_tokens_parser.add_argument('--users', type=str, required=True,
                                                         help='in comma-delimited format (no spaces), specify users to '
                                                              'acquire information for (enter "all_users" for all users)')
@@ -97,6 +141,19 @@ class Parser:
                                             help='specify collection start date (RFC3339 format)')
         self.log_events_parser.add_argument('--end-time', type=Validators.time,
                                             help='specify collection end date (RFC3339 format)')
+        self.log_events_parser.add_argument('--incremental', action='store_true',
+                                            help='collect only the events since the previous collection of every '
+                                                 'application (and users), instead of the whole time range')
+        self.log_events_parser.add_argument('--overlap-minutes', type=Validators.non_negative_int, default=DEFAULT_OVERLAP_MINUTES,
+                                            help='the overlap (in minutes) of incremental collections with the '
+                                                 'previous collection, to cover the ingestion lag of the Reports API. '
+                                                 f'Events that were already collected are dropped (default is '
+                                                 f'{DEFAULT_OVERLAP_MINUTES})')
+        self.log_events_parser.add_argument('--time-slices', type=Validators.positive_int, default=1,
+                                            help=f'split the time range of the heavy applications '
+                                                 f'{HEAVY_APPLICATIONS} into this number of time slices, which are '
+                                                 f'collected concurrently (with --workers) to separate output files '
+                                                 f'(default is 1)')
 
     def add_gmail_args(self):
         self.gmail_parser.add_argument('--users', type=str, required=True,
@@ -112,6 +169,19 @@ class Parser:
                                                 help='add this flag to exclude trash and spam from messages search')
         self.gmail_messages_parser.add_argument('--query', type=str,
                                                 help='the query to search for messages (default is with no query)')
+        self.gmail_messages_parser.add_argument('--fetch', type=str, choices=FETCH_FORMATS,
+                                                help='fetch the content of the listed messages in the given format '
+                                                     '(batched, concurrent messages.get), instead of collecting their '
+                                                     'IDs only')
+        self.gmail_messages_parser.add_argument('--headers', type=str,
+                                                help='in comma-delimited format (no spaces), the headers to fetch in '
+                                                     '"metadata" format (default is the headers commonly used for '
+                                                     'investigations: From, To, Subject, Received, etc.)')
+        self.gmail_messages_parser.add_argument('--incremental', action='store_true',
+                                                help='collect only the messages that were added, deleted or '
+                                                     'relabeled since the previous collection of every user (using '
+                                                     'the Gmail history). Users without a previous collection, or '
+                                                     'whose history has expired, are fully collected')
         self.gmail_message_parser.add_argument('--id', required=True, type=str,
                                                help='the requested message id')
         self.gmail_message_history_parser.add_argument('--id', required=True, type=str,
@@ -120,3 +190,11 @@ class Parser:
                                                       help='the requested message id containing the attachment')
         self.gmail_get_attachment_parser.add_argument('--attachment-id', required=True, type=str,
                                                       help='the attachment id')
+
+    @staticmethod
+    def validate_args(parser, args):
+        if args.module == 'gmail' and 'incremental' in args and args.incremental and args.query:
+            parser.error('--incremental collects the Gmail history, which cannot be searched: remove --query or '
+                         '--incremental')
+        if args.sharded and args.workers < 2:
+            parser.error('--sharded lists the shards concurrently, specify more than one worker: [--workers N]')
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from ..shared.shared_utils import DEFAULT_CACHE_FOLDER, parse_time, format_time
+
+DIRECTORY_CACHE_FOLDER = os.path.join(DEFAULT_CACHE_FOLDER, 'directory')
+DEFAULT_CACHE_TTL = 24  # in hours
+# Caches that were refreshed longer ago than this are rebuilt instead of being refreshed from the admin audit log
+MAX_INCREMENTAL_REFRESH_AGE = 30  # in days
+NO_LOGIN_TIME = '1970-01-01T00:00:00.000Z'
+USER_FIELDS = ['id', 'lastLoginTime', 'isMailboxSetup', 'suspended', 'orgUnitPath']
+
+
+def get_tenant_scope(customer_id: str, super_admin: str) -> str:
+    """
+    @return: the scope of the data that is kept between runs for a tenant (the directory cache, the watermarks of
+    incremental collections, etc.): the customer ID and a hash of the super admin
+    """
+    admin_hash = hashlib.sha256(super_admin.lower().encode('utf-8')).hexdigest()[:16]
+    return f'{customer_id}_{admin_hash}'
+
+
+class UserDirectory:
+    """
+    Class UserDirectory is a snapshot of the users of the domain. Only the fields that select the users of the other
+    collections (see USER_FIELDS) are kept, by the lowercase primary email of the user, so the snapshot stays small
+    for large domains and users are looked up in constant time.
+    """
+
+    def __init__(self, users: dict = None, written: bool = False):
+        """
+        @param users: the users of the snapshot, primary email => fields
+        @param written: whether the "users" output of the run was collected (written, or resumed from a previous run)
+        """
+        self.users = users if users is not None else {}
+        self.written = written
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, email: str):
+        return email.lower() in self.users
+
+    def add_page(self, users: list, next_page_token: str) -> None:
+        """
+        Adds a page of users.list results (a page_callback of list_action)
+        """
+        for user in users or []:
+            self.add_user(user)
+
+    def add_user(self, user: dict) -> None:
+        self.users[user['primaryEmail'].lower()] = {field: user.get(field) for field in USER_FIELDS}
+
+    def remove_user(self, email: str) -> None:
+        self.users.pop(email.lower(), None)
+
+    def get_active_users(self) -> list:
+        """
+        @return: the non-suspended users that have logged in at least once
+        """
+        return [email for email, user in self.users.items() if UserDirectory._is_active(user)]
+
+    def get_mailbox_users(self) -> list:
+        """
+        @return: the active users that have their mailbox setup (and have Gmail access)
+        """
+        return [email for email, user in self.users.items() if UserDirectory._is_active(user) and
+                user['isMailboxSetup']]
+
+    def get_never_logged_in_users(self) -> set:
+        return {email for email, user in self.users.items() if not user['suspended'] and
+                (user['lastLoginTime'] or NO_LOGIN_TIME) == NO_LOGIN_TIME}
+
+    @staticmethod
+    def _is_active(user: dict) -> bool:
+        return not user['suspended'] and (user['lastLoginTime'] or NO_LOGIN_TIME) != NO_LOGIN_TIME
+
+
+class DirectoryCache:
+    """
+    Class DirectoryCache keeps the user directory (see UserDirectory) and the groups of a tenant between runs. Every
+    customer ID and super admin has a cache of its own, so collections from a single host against several tenants never
+    share data. Each part of the cache (users, groups) records when it was refreshed: parts older than the TTL are
+    refreshed by the caller, from the admin audit log since the last refresh or by listing the directory again.
+    """
+
+    def __init__(self, customer_id: str, super_admin: str, ttl: float = DEFAULT_CACHE_TTL,
+                 folder: str = DIRECTORY_CACHE_FOLDER):
+        """
+        @param customer_id: the customer ID of the tenant. None if it cannot be resolved: the cache is then kept in
+        memory only, so it is never shared with other tenants
+        @param super_admin: the super admin that the directory is listed as
+        @param ttl: the time (in hours) that a refreshed part of the cache is used for
+        @param folder: the folder of the cache files
+        """
+        self.customer_id = customer_id
+        self.super_admin = super_admin.lower()
+        self.ttl = ttl
+        self.path = os.path.join(folder, f'directory_{get_tenant_scope(customer_id, self.super_admin)}.json') \
+            if customer_id is not None else None
+        self.created = None
+        self.user_directory = None
+        self.groups = None
+        self._refreshed = {}  # part => the time the part was refreshed
+        self._lock = threading.Lock()
+        self._load()
+
+    def is_fresh(self, part: str) -> bool:
+        """
+        @param part: "users" or "groups"
+        @return: whether the part was refreshed within the TTL
+        """
+        refreshed = self._refreshed.get(part)
+        return refreshed is not None and datetime.utcnow() - parse_time(refreshed) < timedelta(hours=self.ttl)
+
+    def get_refreshed(self, part: str):
+        """
+        @return: the time (RFC3339) that the part was refreshed, or None if it is not cached. Parts that were refreshed
+        too long ago to be refreshed incrementally (see MAX_INCREMENTAL_REFRESH_AGE) are considered not cached.
+        """
+        refreshed = self._refreshed.get(part)
+        if refreshed is None or \
+                datetime.utcnow() - parse_time(refreshed) > timedelta(days=MAX_INCREMENTAL_REFRESH_AGE):
+            return None
+        return refreshed
+
+    def set_users(self, user_directory: UserDirectory, refreshed: str) -> None:
+        with self._lock:
+            self.user_directory = user_directory
+            self._refreshed['users'] = refreshed
+            self._save()
+
+    def set_groups(self, groups: set, refreshed: str) -> None:
+        with self._lock:
+            self.groups = set(groups)
+            self._refreshed['groups'] = refreshed
+            self._save()
+
+    @staticmethod
+    def get_time() -> str:
+        return format_time(datetime.utcnow().replace(microsecond=0))
+
+    def _load(self) -> None:
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                cache = json.load(f)
+        except ValueError:
+            logging.info(f'Ignoring the corrupted directory cache {self.path}')
+            return
+        self.created = cache.get('created')
+        if 'users' in cache:
+            self.user_directory = UserDirectory(users=cache['users']['records'])
+            self._refreshed['users'] = cache['users']['refreshed']
+        if 'groups' in cache:
+            self.groups = set(cache['groups']['records'])
+            self._refreshed['groups'] = cache['groups']['refreshed']
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        self.created = self.created or DirectoryCache.get_time()
+        cache = {'customer_id': self.customer_id, 'super_admin': self.super_admin, 'created': self.created}
+        if self.user_directory is not None:
+            cache['users'] = {'refreshed': self._refreshed['users'], 'records': self.user_directory.users}
+        if self.groups is not None:
+            cache['groups'] = {'refreshed': self._refreshed['groups'], 'records': sorted(self.groups)}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temp_path, self.path)  # a killed run never leaves a partially written cache
@@ -1,34 +1,369 @@
 import logging
-import os
+import time
+from collections import deque
+from time import sleep
 
-from .admin_directory import DEFAULT_MAILBOX_SETUP_FILE, AdminDirectory
+from .admin_directory import AdminDirectory
+from .directory_cache import DEFAULT_CACHE_TTL
+from ..shared.checkpoint import CheckpointStore
 from ..shared.module_handler import ModuleHandler
+from ..shared.retry_policy import RetryPolicy, RATE_LIMITED, NOT_FOUND
+from ..shared.watermark import WatermarkStore
+
+# The formats of messages.get that messages can be fetched in
+FETCH_FORMATS = ['full', 'metadata', 'raw']
+# The headers that are fetched in "metadata" format by default
+DEFAULT_METADATA_HEADERS = ['From', 'To', 'Cc', 'Bcc', 'Reply-To', 'Subject', 'Date', 'Message-ID', 'In-Reply-To',
+                            'Return-Path', 'Received', 'Authentication-Results', 'X-Originating-IP']
+# The labels of the messages that messages.list skips unless includeSpamTrash is set
+SPAM_TRASH_LABELS = {'SPAM', 'TRASH'}
+# The changes of a history record
+HISTORY_CHANGES = ['messagesAdded', 'messagesDeleted', 'labelsAdded', 'labelsRemoved']
 
 
 class Gmail(ModuleHandler):
-    def __init__(self, creds, file_handler, service=None):
-        super().__init__(creds=creds, file_handler=file_handler, service=service, module='gmail')
+    SERVICE_NAME = 'gmail'
+    SERVICE_VERSION = 'v1'
+
+    def __init__(self, creds, file_handler, service=None, **kwargs):
+        super().__init__(creds=creds, file_handler=file_handler, service=service, module='gmail', **kwargs)
+
+    def collect_messages(self, users: list, params: dict, fetch_format: str = None, metadata_headers: list = None,
+                         incremental: bool = False) -> None:
+        """
+        Collects the messages of every user. The latest historyId of every mailbox is taken before its collection, and
+        is kept as the watermark of the user (see WatermarkStore) once the collection is completed.
+        @param users: the users whose mailboxes are collected
+        @param params: the params of messages.list (userId, q, includeSpamTrash)
+        @param fetch_format: the format to fetch the content of the messages in (see FETCH_FORMATS and
+        MessageFetchStage). By default, only the IDs of the messages are collected.
+        @param metadata_headers: the headers to fetch in "metadata" format. By default, DEFAULT_METADATA_HEADERS
+        @param incremental: whether to collect only the changes (added, deleted and label-changed messages) since the
+        watermark of the user using users.history.list. Users without a watermark, or whose watermark is too old for
+        the history API, are fully collected. The history API cannot search messages, so incremental collections do
+        not support the "q" param. Without includeSpamTrash, added messages in the spam or trash are dropped.
+        """
+        if incremental and params.get('q'):
+            raise ValueError('Incremental collections of messages do not support queries (the "q" param)')
+        get_params = None
+        if fetch_format is not None:
+            get_params = {'userId': 'me', 'format': fetch_format}
+            if fetch_format == 'metadata':
+                get_params['metadataHeaders'] = metadata_headers or DEFAULT_METADATA_HEADERS
+        # the fetch stage of a user already runs on the handler's workers, so users are collected one after the other
+        if get_params is not None or self.workers == 1 or len(users) < 2:
+            for user in users:
+                self._collect_user_messages(user=user, params=params, get_params=get_params, incremental=incremental)
+            return
+        executor = self._get_executor()
+        futures = {user: executor.submit(self._collect_user_messages, user=user, params=params, get_params=get_params,
+                                         incremental=incremental) for user in users}
+        for user, future in futures.items():
+            try:
+                future.result()
+            except Exception as ex:
+                self.add_error_to_log(function='messages', requested_action='', page=0, latest_err=str(ex),
+                                      additions=f'Failed to collect item {user}')
+
+    def _collect_user_messages(self, user: str, params: dict, get_params: dict = None,
+                               incremental: bool = False) -> None:
+        # a watermark covers only the messages that its listing selected, so every filter keeps a watermark of its own
+        listing_filter = {'q': params.get('q') or None, 'includeSpamTrash': bool(params.get('includeSpamTrash'))}
+        watermark_key = WatermarkStore.get_key(module=self.module, name='history',
+                                               scope=f'{user}:{CheckpointStore.get_params_hash(listing_filter)}')
+        service = self.service_pool.acquire(user)
+        try:
+            history_id = self._get_history_id(user=user, service=service)
+            start_history_id = self.file_handler.watermarks.get(watermark_key) if incremental else None
+            if incremental and start_history_id is None:
+                self.file_handler.append_log(f'No history watermark for {user}, collecting the whole mailbox')
+            elif start_history_id is not None and \
+                    not self._is_history_available(user=user, service=service, start_history_id=start_history_id):
+                self.file_handler.append_log(f'The history watermark of {user} ({start_history_id}) has expired, '
+                                             f'collecting the whole mailbox')
+                start_history_id = None
+            if start_history_id is not None:
+                self.print_stdout(f'Collecting data for [{user}] using the function history (since '
+                                  f'{start_history_id})')
+                completed = self._collect_history(user=user, service=service, start_history_id=start_history_id,
+                                                  get_params=get_params,
+                                                  include_spam_trash=listing_filter['includeSpamTrash'])
+            elif get_params is not None:
+                self.print_stdout(f'Collecting data for [{user}] using the function messages '
+                                  f'({get_params["format"]})')
+                completed = self._fetch_user_messages(user=user, service=service, params=params,
+                                                      get_params=get_params)
+            else:
+                completed = self._list_user_messages(user=user, service=service, params=params)
+        finally:
+            self.service_pool.release(user, service)
+        if completed and history_id is not None:
+            self.file_handler.watermarks.set(watermark_key, history_id)
+
+    def _list_user_messages(self, user: str, service, params: dict) -> bool:
+        """
+        @return: whether the messages were completely collected by this call
+        """
+        action = {'function': 'messages', 'base_functions': ['users'], 'params': params, 'inner_object': 'messages'}
+        if self._is_item_completed(item=user, action=action):
+            self.file_handler.append_log(f'Skipping item {user}: already collected by a previous run')
+            return False
+        self._list_action_by_value(item=user, service=service, action=action, main_key='user', delegate_users=True)
+        return self._is_item_completed(item=user, action=action)
+
+    def _fetch_user_messages(self, user: str, service, params: dict, get_params: dict) -> bool:
+        """
+        Lists the messages of a user, feeding the IDs of every page into a MessageFetchStage
+        @return: whether all the messages were listed and fetched by this call
+        """
+        function = f'messages_{get_params["format"]}'
+        checkpoint_key = CheckpointStore.get_key(module=self.module, function=function,
+                                                 params=dict(params, **get_params), item=user)
+        if self.file_handler.checkpoints.is_completed(checkpoint_key):
+            self.file_handler.append_log(f'Skipping {self.module}=>{function} for {user}. '
+                                         f'Already collected by a previous run')
+            return False
+        fetch_stage = MessageFetchStage(handler=self, user=user, get_params=get_params)
+        listing = {'completed': False}
+
+        def fetch_page(messages: list, next_page_token: str) -> None:
+            fetch_stage.add([message['id'] for message in messages or []])
+            listing['completed'] = next_page_token is None
+
+        try:
+            self.list_action(function='messages', base_functions=['users'],
+                             params=dict(params, fields='messages(id),nextPageToken'), inner_object='messages',
+                             add_to_log=False, service=service, subject=user, page_callback=fetch_page)
+        finally:
+            completed = fetch_stage.close() and listing['completed']
+        if completed:
+            self._save_checkpoint(key=checkpoint_key, function=function, params=dict(params, **get_params),
+                                  documented_item=user, completed=True)
+        return completed
+
+    def _collect_history(self, user: str, service, start_history_id: str, get_params: dict = None,
+                         include_spam_trash: bool = True) -> bool:
+        """
+        Collects the history records (added, deleted and label-changed messages) of a user since a history ID. If
+        get_params is given, the added messages are fetched too (see MessageFetchStage).
+        @param include_spam_trash: whether to keep the added messages that are in the spam or trash
+        @return: whether the history was completely collected (and the added messages fetched) by this call
+        """
+        params = {'userId': 'me', 'startHistoryId': start_history_id}
+        checkpoint_key = CheckpointStore.get_key(module=self.module, function='history', params=params, item=user)
+        if self.file_handler.checkpoints.is_completed(checkpoint_key):
+            self.file_handler.append_log(f'Skipping {self.module}=>history for {user}. Already collected by a '
+                                         f'previous run')
+            return False
+        fetch_stage = MessageFetchStage(handler=self, user=user, get_params=get_params) if get_params else None
+
+        def add_page(history: list, next_page_token: str) -> None:
+            if history and not include_spam_trash:
+                for record in history:
+                    if 'messagesAdded' in record:
+                        record['messagesAdded'] = [added for added in record['messagesAdded'] if not
+                                                   SPAM_TRASH_LABELS.intersection(added['message'].get('labelIds', []))]
+                # the records that are left without changes are not written
+                history[:] = [record for record in history if any(record.get(change) for change in HISTORY_CHANGES)]
+            if fetch_stage is not None:
+                fetch_stage.add([added['message']['id'] for record in history or []
+                                 for added in record.get('messagesAdded', [])])
+
+        try:
+            self.list_action(function='history', base_functions=['users'], params=params, inner_object='history',
+                             metadata_additions=[('user', user)], results_only=False, documented_item=user,
+                             service=service, subject=user, page_callback=add_page, item=('user', user))
+        finally:
+            fetched = fetch_stage.close() if fetch_stage is not None else True
+        return fetched and self.file_handler.checkpoints.is_completed(checkpoint_key)
+
+    def _get_history_id(self, user: str, service):
+        """
+        @return: the current history ID of the user's mailbox, or None if it cannot be retrieved
+        """
+        try:
+            return self._execute_with_retries(user=user, request=service.users().getProfile(
+                userId='me', fields='historyId')).get('historyId')
+        except Exception as ex:
+            self.add_error_to_log(function='getProfile', requested_action='', page=0, latest_err=str(ex),
+                                  additions=f'The history watermark of {user} will not be updated.')
+            return None
+
+    def _is_history_available(self, user: str, service, start_history_id: str) -> bool:
+        """
+        @return: False if the history API no longer has the records since the history ID (HTTP 404), which requires a
+        full collection
+        """
+        try:
+            self._execute_with_retries(user=user, request=service.users().history().list(
+                userId='me', startHistoryId=start_history_id, maxResults=1, fields='historyId'))
+        except Exception as ex:
+            # other errors are documented by the collection of the history itself
+            return ModuleHandler.RETRY_POLICY.classify(ex) != NOT_FOUND
+        return True
+
+    def _execute_with_retries(self, user: str, request) -> dict:
+        retry_count = 0
+        while True:
+            self.get_rate_limit_bucket(subject=user).acquire()
+            try:
+                return request.execute()
+            except Exception as ex:
+                if not RetryPolicy.is_retryable(ModuleHandler.RETRY_POLICY.classify(ex)) or \
+                        retry_count == ModuleHandler.RETRY_POLICY.max_retry:
+                    raise
+                retry_count += 1
+                sleep(ModuleHandler.RETRY_POLICY.get_delay(retry_count=retry_count, ex=ex))
+
+    def _fetch_messages(self, user: str, message_ids: list, get_params: dict) -> list:
+        """
+        Gets messages using a batch request. Only the sub-requests that failed with a retryable error are retried, in a
+        new batch request.
+        @return: the messages, in the order of the IDs. Messages that could not be fetched are None (messages that
+        were deleted since they were listed are omitted)
+        """
+        function = f'messages_{get_params["format"]}'
+        service = self.service_pool.acquire(user)
+        rate_limit_bucket = self.get_rate_limit_bucket(subject=user)
+        messages = {}
+        pending = list(message_ids)
+        retry_count = 0
+        try:
+            while pending:
+                responses = {}
+
+                def callback(request_id, response, exception):
+                    responses[request_id] = (response, exception)
+
+                batch = service.new_batch_http_request(callback=callback)
+                for message_id in pending:
+                    rate_limit_bucket.acquire()
+                    batch.add(service.users().messages().get(id=message_id, **get_params), request_id=message_id)
+                batch_error = None
+                batch_start_time = time.monotonic()
+                try:
+                    batch.execute()
+                except Exception as ex:  # the whole batch failed, all of its messages are retried
+                    batch_error = ex
+                self.file_handler.metrics.record_page(module=self.module, function=function, item=user,
+                                                      page=retry_count + 1,
+                                                      latency=time.monotonic() - batch_start_time,
+                                                      items=sum(1 for _, exception in responses.values()
+                                                                if exception is None))
+                failed = []
+                for message_id in pending:
+                    response, exception = responses.get(message_id, (None, batch_error))
+                    if exception is None:
+                        messages[message_id] = response
+                        continue
+                    error_class = ModuleHandler.RETRY_POLICY.classify(exception)
+                    if error_class == RATE_LIMITED:
+                        rate_limit_bucket.decrease()
+                    if error_class == NOT_FOUND:
+                        self.file_handler.append_log(f'Message {message_id} of {user} was not found')
+                        messages[message_id] = False
+                    elif not RetryPolicy.is_retryable(error_class) or \
+                            retry_count == ModuleHandler.RETRY_POLICY.max_retry:
+                        self.add_error_to_log(function=function, requested_action='.get', page=1,
+                                              latest_err=str(exception),
+                                              additions=f'Message {message_id} of {user} ({error_class}).')
+                    else:
+                        failed.append(message_id)
+                if failed:
+                    retry_count += 1
+                    sleep_time = ModuleHandler.RETRY_POLICY.get_delay(retry_count=retry_count)
+                    logging.info(f'{len(failed)} sub-requests of {function} batch failed. '
+                                 f'Retrying in {sleep_time:.1f} seconds...')
+                    sleep(sleep_time)
+                pending = failed
+        finally:
+            self.service_pool.release(user, service)
+        return [messages.get(message_id) for message_id in message_ids if messages.get(message_id) is not False]
 
     @staticmethod
-    def get_relevant_gmail_users(admin_directory_handler: AdminDirectory, users: list, override=False):
+    def get_relevant_gmail_users(admin_directory_handler: AdminDirectory, users: list, override=False,
+                                 cache_ttl=DEFAULT_CACHE_TTL):
         logging.info('Getting relevant gmail users')
-        gmail_users = []
-        # if mailbox_setup_enabled was already gathered by getting all users
-        if os.path.exists(DEFAULT_MAILBOX_SETUP_FILE) and not override:
-            logging.info('Retrieving from cache file')
-            with open(DEFAULT_MAILBOX_SETUP_FILE, 'r') as f:
-                for line in f:
-                    gmail_users.append(line.rstrip())
-        # else => gather mailbox_setup_enabled users with admin_directory handler
-        else:
-            if override:
-                logging.info('overriding cache file')
-            else:
-                logging.info('No cache file found, getting mailbox settings for all users')
-            gmail_users = admin_directory_handler.get_mailbox_enabled_users()
+        # the mailbox enabled users of the user directory snapshot of the run (see AdminDirectory.get_user_directory)
+        gmail_users = admin_directory_handler.get_mailbox_enabled_users(override=override, cache_ttl=cache_ttl)
 
         # match given users list to gmail users and give the in
         logging.info(f'Got {len(users)} total users, retrieved {len(gmail_users)} gmail users.')
         relevant_gmail_users = list(set(users) & set(gmail_users))
         logging.info(f'Got {len(relevant_gmail_users)} users after comparison.')
         return relevant_gmail_users
+
+
+class MessageFetchStage:
+    """
+    Class MessageFetchStage fetches the content of the messages of a single user as their IDs are listed: the IDs are
+    fetched using batched messages.get requests (see Gmail._fetch_messages) that the handler's workers execute
+    concurrently. At most two batches per worker are in flight, so the listing never runs far ahead of the fetching.
+    The fetched messages are appended to the output of the user, in the order of the listing, as soon as their batch
+    completes.
+    """
+
+    def __init__(self, handler: Gmail, user: str, get_params: dict):
+        """
+        @param handler: the Gmail handler
+        @param user: the user whose messages are fetched
+        @param get_params: the params of messages.get (format, metadataHeaders)
+        """
+        self.handler = handler
+        self.user = user
+        self.get_params = get_params
+        self.function = f'messages_{get_params["format"]}'
+        self.messages = 0
+        self.failed = 0
+        self._batch_size = ModuleHandler.BATCH_SIZES.get(handler.SERVICE_NAME, ModuleHandler.DEFAULT_BATCH_SIZE)
+        self._max_pending = handler.workers * 2
+        self._pending = deque()  # the futures of the fetched batches, in the order of the listing
+
+    def add(self, message_ids: list) -> None:
+        for i in range(0, len(message_ids), self._batch_size):
+            chunk = message_ids[i:i + self._batch_size]
+            if self.handler.workers == 1:
+                self._write(self.handler._fetch_messages(user=self.user, message_ids=chunk,
+                                                         get_params=self.get_params))
+                continue
+            self._pending.append(self.handler._get_executor().submit(self.handler._fetch_messages, user=self.user,
+                                                                     message_ids=chunk, get_params=self.get_params))
+            while len(self._pending) > self._max_pending or (self._pending and self._pending[0].done()):
+                self._write_next()
+
+    def close(self) -> bool:
+        """
+        Waits for the pending batches and completes the output of the user
+        @return: whether all the messages were fetched
+        """
+        while self._pending:
+            self._write_next()
+        if self.messages == 0:
+            self.handler.file_handler.append_log(f'No messages were fetched for {self.user}')
+        else:
+            self.handler.print_stdout(f'{self.messages} messages were fetched')
+            summary = self.handler._wrap_results(function=self.function, params=self.get_params, results=None,
+                                                 metadata_additions=[('user', self.user)], results_only=False)
+            del summary['data']
+            summary['messages'] = self.messages
+            summary['failed'] = self.failed
+            self.handler.end_stream_log(function=self.function, summary=summary, documented_item=self.user,
+                                        item=('user', self.user))
+        return self.failed == 0
+
+    def _write(self, messages: list) -> None:
+        self.failed += messages.count(None)
+        messages = [message for message in messages if message is not None]
+        if messages:
+            self.handler.add_to_log(function=self.function, results=messages, documented_item=self.user,
+                                    writing_mode='a', item=('user', self.user))
+            self.messages += len(messages)
+
+    def _write_next(self) -> None:
+        try:
+            self._write(self._pending.popleft().result())
+        except Exception as ex:
+            self.failed += 1
+            self.handler.add_error_to_log(function=self.function, requested_action='.get', page=0,
+                                          latest_err=str(ex), additions=f'Failed to fetch a batch of messages of '
+                                                                        f'{self.user}')
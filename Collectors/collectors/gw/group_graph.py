@@ -0,0 +1,96 @@
+from array import array
+
+GROUP_TYPE = 'GROUP'
+
+
+class GroupGraph:
+    """
+    Class GroupGraph is a compact graph of the direct memberships of groups. Every group and member is an integer node,
+    and the membership edges are kept in integer arrays, which are packed into an adjacency array (compressed sparse
+    rows) once the graph is built. The transitive memberships of a group are computed locally by a breadth-first
+    search of the graph, so nested groups are listed once instead of once for every group they are nested in.
+    """
+
+    def __init__(self):
+        self.keys = []  # node => the email (or ID) of the group or member
+        self.types = []  # node => the member type (GROUP, USER, CUSTOMER, etc.)
+        self._nodes = {}  # email (or ID) => node
+        self._sources = array('i')  # edge => the node of the group
+        self._targets = array('i')  # edge => the node of the member
+        self._offsets = None  # node => the index of its first member in self._adjacency
+        self._adjacency = None  # the member nodes of every group, ordered by the group
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def edges(self) -> int:
+        return len(self._sources)
+
+    def get_node(self, key: str, member_type: str = None) -> int:
+        """
+        @param key: the email (or ID) of the group or member
+        @param member_type: the member type, if known
+        @return: the node of the group or member, which is added to the graph if needed
+        """
+        node = self._nodes.get(key)
+        if node is None:
+            node = len(self.keys)
+            self._nodes[key] = node
+            self.keys.append(key)
+            self.types.append(member_type)
+        elif member_type is not None and self.types[node] is None:
+            self.types[node] = member_type
+        return node
+
+    def add_edge(self, group: int, member: int) -> None:
+        self._sources.append(group)
+        self._targets.append(member)
+        self._offsets = None
+
+    def build(self) -> None:
+        """
+        Packs the edges into the adjacency array (a counting sort of the edges by their group)
+        """
+        offsets = array('i', [0]) * (len(self.keys) + 1)
+        for source in self._sources:
+            offsets[source + 1] += 1
+        for node in range(len(self.keys)):
+            offsets[node + 1] += offsets[node]
+        positions = array('i', offsets)
+        adjacency = array('i', [0]) * len(self._targets)
+        for source, target in zip(self._sources, self._targets):
+            adjacency[positions[source]] = target
+            positions[source] += 1
+        self._offsets, self._adjacency = offsets, adjacency
+
+    def get_members(self, group: int) -> array:
+        """
+        @return: the nodes of the direct members of a group
+        """
+        if self._offsets is None:
+            self.build()
+        return self._adjacency[self._offsets[group]:self._offsets[group + 1]]
+
+    def get_transitive_members(self, group: int) -> list:
+        """
+        Gets the direct and the derived (nested) members of a group. Membership cycles are followed once.
+        @return: a list of (member node, depth) tuples, where depth 1 is a direct member
+        """
+        if self._offsets is None:
+            self.build()
+        visited = {group}
+        members = []
+        level, depth = [group], 1
+        while level:
+            next_level = []
+            for node in level:
+                for member in self._adjacency[self._offsets[node]:self._offsets[node + 1]]:
+                    if member in visited:
+                        continue
+                    visited.add(member)
+                    members.append((member, depth))
+                    if self.types[member] == GROUP_TYPE:
+                        next_level.append(member)
+            level, depth = next_level, depth + 1
+        return members
@@ -6,10 +6,10 @@ from sys import exit
 
 from google.oauth2.service_account import Credentials
 
-from .admin_directory import AdminDirectory, DEFAULT_CACHE_FOLDER
+from .admin_directory import AdminDirectory
 from .cmdline import Parser
 from .gmail import Gmail
-from .log_events import LogEvents, ALL_APPLICATIONS
+from .log_events import LogEvents, ALL_APPLICATIONS, DEFAULT_OVERLAP_MINUTES
 from ..shared.shared_utils import FileHandler, DEFAULT_OUTPUT_FOLDER
 
 SCOPES = ['https://www.googleapis.com/auth/admin.directory.user.readonly',
@@ -25,6 +25,23 @@ SCOPES = ['https://www.googleapis.com/auth/admin.directory.user.readonly',
           'https://www.googleapis.com/auth/admin.reports.usage.readonly',
           'https://www.googleapis.com/auth/gmail.readonly']
 SUPPORTED_MODULES = ['admin_directory', 'logs', 'gmail']
+# Gmail settings actions => the API call that collects them for a single user
+GMAIL_SETTINGS_ACTIONS = {
+    'send_as': {'function': 'sendAs', 'base_functions': ['users', 'settings'], 'params': {'userId': 'me'},
+                'inner_object': 'sendAs', 'single_page': True},
+    'delegates': {'function': 'delegates', 'base_functions': ['users', 'settings'], 'params': {'userId': 'me'},
+                  'inner_object': 'delegates', 'single_page': True},
+    'auto_forwarding': {'function': 'getAutoForwarding', 'base_functions': ['users', 'settings'],
+                        'params': {'userId': 'me'}, 'is_no_action': True},
+    'forwarding_addresses': {'function': 'forwardingAddresses', 'base_functions': ['users', 'settings'],
+                             'params': {'userId': 'me'}, 'inner_object': 'forwardingAddresses', 'single_page': True},
+    'imap': {'function': 'getImap', 'base_functions': ['users', 'settings'], 'params': {'userId': 'me'},
+             'is_no_action': True},
+    'pop': {'function': 'getPop', 'base_functions': ['users', 'settings'], 'params': {'userId': 'me'},
+            'is_no_action': True},
+    'labels': {'function': 'labels', 'base_functions': ['users'], 'params': {'userId': 'me'},
+               'inner_object': 'labels', 'single_page': True},
+}
 CUSTOMER_ID_DEFAULT_PARAMS = {'customerId': 'my_customer'}
 CUSTOMER_DEFAULT_PARAMS = {'customer': 'my_customer'}
 
@@ -42,6 +59,7 @@ def main():
         # Parse arguments
         parser = Parser()
         args = parser.parser.parse_args(sys.argv[2:])
+        parser.validate_args(parser.parser, args)
         module = args.module
         cmdline = " ".join(sys.argv)
         query = ''
@@ -55,7 +73,10 @@ def main():
             groups = [x.lower() for x in args.groups.split(',')]
 
         # Create file handler (for output folder and log file)
-        file_handler = FileHandler(folder=args.output, log_file=args.log_file, cmdline=cmdline)
+        file_handler = FileHandler(folder=args.output, log_file=args.log_file, cmdline=cmdline,
+                                   stream=args.stream, resume=args.resume, consolidate=args.consolidate,
+                                   rotate_size=args.rotate_size * 1024 * 1024 if args.rotate_size else None,
+                                   index_db=args.index_db)
         log_file = file_handler.log_file
 
         # Basic validations
@@ -82,8 +103,10 @@ def main():
 
         # Getting all users/groups in case none were asked for
         # This section is executed in case no users/groups were given while they are required for the requested action
-        # This section also checks whether Gmail settings were requested to gather all "mailbox_setup enabled users"
-        mailbox_setup_required = (module == 'all' or module == 'gmail')
+        # The user directory is listed at most once per run (see AdminDirectory.fetch_user_directory), and the same
+        # snapshot is the "users" output, the active users and the mailbox enabled users of the run
+        user_directory = None
+        collect_users = module == 'all' or (module == 'admin_directory' and action in ('users', 'all'))
         all_users_flag = (module == 'all' or
                           (module == 'admin_directory' and action == 'all') or
                           ('users' in args and args.users == 'all_users'))
@@ -91,32 +114,31 @@ def main():
                            (module == 'admin_directory' and
                             (action == 'all' or ('groups' in args and args.groups == 'all_groups'))))
         if all_groups_flag or all_users_flag:
-            admin_directory_handler = AdminDirectory(creds=delegated_credentials, file_handler=file_handler)
-            # Create Cache folder if it doesn't exist
-            if not os.path.exists(DEFAULT_CACHE_FOLDER):
-                os.makedirs(DEFAULT_CACHE_FOLDER)
+            admin_directory_handler = AdminDirectory(creds=delegated_credentials, file_handler=file_handler,
+                                                     workers=args.workers, batch=args.batch,
+                                                     fields_profile=args.fields_profile, sharded=args.sharded)
             if all_users_flag:
-                # Gmail does not require getting all users
-                if mailbox_setup_required:
-                    users = admin_directory_handler.get_all_active_users(override=args.override_cache,
-                                                                         mailbox_setup=mailbox_setup_required)
-                else:
-                    users = admin_directory_handler.get_all_active_users(override=args.override_cache)
+                users = admin_directory_handler.get_all_active_users(override=args.override_cache,
+                                                                     collect_users=collect_users,
+                                                                     cache_ttl=args.cache_ttl)
+                user_directory = admin_directory_handler.user_directory
                 if len(users) == 0:
                     exit('could not retrieved users to work with. Exiting.')
             if all_groups_flag:
-                groups = admin_directory_handler.get_all_groups(override=args.override_cache)
+                groups = admin_directory_handler.get_all_groups(override=args.override_cache,
+                                                                cache_ttl=args.cache_ttl)
 
         # Script start time
         script_start_time = time.time()
 
         # Admin directory module
         if module == 'admin_directory' or module == 'all':
-            admin_directory_handler = AdminDirectory(creds=delegated_credentials, file_handler=file_handler)
+            admin_directory_handler = AdminDirectory(creds=delegated_credentials, file_handler=file_handler,
+                                                     workers=args.workers, batch=args.batch,
+                                                     fields_profile=args.fields_profile, sharded=args.sharded)
             print(f"{BG}Starting to collect configurations from Admin Directory{RR}")
-            if action == 'users' or action == 'all':
-                admin_directory_handler.list_action(function='users', params=CUSTOMER_DEFAULT_PARAMS,
-                                                    inner_object='users')
+            if (action == 'users' or action == 'all') and (user_directory is None or not user_directory.written):
+                user_directory = admin_directory_handler.fetch_user_directory(write_output=True)
             if action == 'deleted_users' or action == 'all':
                 admin_directory_handler.list_action(function='users', params={'customer': 'my_customer',
                                                                               'showDeleted': True},
@@ -129,11 +151,11 @@ def main():
                 admin_directory_handler.list_action_by_values(function='asps', params={'userKey': None},
                                                               list_items=users,
                                                               inner_object='items', dynamic_key_param='userKey',
-                                                              item_as_data=True)
+                                                              item_as_data=True, single_page=True)
             if action == 'chromeosdevices' or action == 'all':
-                admin_directory_handler.list_action(function='chromeosdevices',
-                                                    params=CUSTOMER_ID_DEFAULT_PARAMS,
-                                                    inner_object='chromeosdevices')
+                admin_directory_handler.list_directory(function='chromeosdevices',
+                                                       params=CUSTOMER_ID_DEFAULT_PARAMS,
+                                                       inner_object='chromeosdevices')
             if action == 'customers' or action == 'all':
                 admin_directory_handler.list_action(function='customers',
                                                     params={'customerKey': 'my_customer'},
@@ -142,7 +164,9 @@ def main():
                 admin_directory_handler.list_action(function='groups',
                                                     params=CUSTOMER_DEFAULT_PARAMS,
                                                     inner_object='groups')
-            if action == 'members' or action == 'all':
+            if action == 'members' and args.graph:
+                admin_directory_handler.collect_group_graph(groups=groups)
+            elif action == 'members' or action == 'all':
                 admin_directory_handler.list_action_by_values(function='members',
                                                               params={'groupKey': None,
                                                                       'includeDerivedMembership': True},
@@ -150,9 +174,9 @@ def main():
                                                               inner_object='members', dynamic_key_param='groupKey',
                                                               item_as_data=True)
             if action == 'mobiledevices' or action == 'all':
-                admin_directory_handler.list_action(function='mobiledevices',
-                                                    params=CUSTOMER_ID_DEFAULT_PARAMS,
-                                                    inner_object='mobiledevices')
+                admin_directory_handler.list_directory(function='mobiledevices',
+                                                       params=CUSTOMER_ID_DEFAULT_PARAMS,
+                                                       inner_object='mobiledevices')
             if action == 'orgunits' or action == 'all':
                 admin_directory_handler.list_action(function='orgunits',
                                                     params=CUSTOMER_ID_DEFAULT_PARAMS,
@@ -170,12 +194,14 @@ def main():
                                                               params={'userKey': None},
                                                               list_items=users,
                                                               inner_object='items', dynamic_key_param='userKey',
-                                                              item_as_data=True)
+                                                              item_as_data=True, single_page=True)
             admin_directory_handler.close()
 
         # Log events module
         if module == 'logs' or module == 'all':
-            log_events_handler = LogEvents(creds=delegated_credentials, file_handler=file_handler)
+            log_events_handler = LogEvents(creds=delegated_credentials, file_handler=file_handler,
+                                           workers=args.workers, batch=args.batch,
+                                           fields_profile=args.fields_profile)
             print(f"{BG}Starting to collect logs from Google Log Events{RR}")
             if 'logs' in args and args.logs != "all_logs":
                 apps = [x.lower() for x in args.logs.split(',')]
@@ -187,39 +213,29 @@ def main():
                 formatted_logs = ["all"]
             formatted_log_selection = [word.replace("_", " ").title() for word in formatted_logs]
             final_format_logs = ', '.join(formatted_log_selection)
-            params = {'applicationName': None}
+            params = {}
             if 'start_time' in args:
                 params['startTime'] = args.start_time
             if 'end_time' in args:
                 params['endTime'] = args.end_time
 
+            incremental = 'incremental' in args and args.incremental
+            overlap_minutes = args.overlap_minutes if 'overlap_minutes' in args else DEFAULT_OVERLAP_MINUTES
+            time_slices = args.time_slices if 'time_slices' in args else 1
             if all_users_flag:  # short version to get information for all users instead iterating them
-
-                params['userKey'] = 'all'
                 logging.info('Beginning log collection for activity across the organization ...')
-                log_events_handler.list_action_by_values(function='activities',
-                                                         params=params,
-                                                         list_items=apps,
-                                                         item_as_data=True,
-                                                         dynamic_key_param='applicationName',
-                                                         inner_object='items', results_only=True)
-
+                log_events_handler.collect_activities(apps=apps, params=params, user_key='all',
+                                                      incremental=incremental, overlap_minutes=overlap_minutes,
+                                                      time_slices=time_slices)
 
             else:  # specific users were supplied
                 for user in users:
-                    tmp_params = params.copy()
-                    tmp_params['userKey'] = user
                     try:
                         logging.info(f'Collecting [{final_format_logs}] log events for user ...')
-                        log_events_handler.list_action_by_values(function='activities',
-                                                                 params=tmp_params,
-                                                                 list_items=apps,
-                                                                 item_as_data=True,
-                                                                 dynamic_key_param='applicationName',
-                                                                 inner_object='items', results_only=True,
-                                                                 filename_additions=user)
-
-
+                        log_events_handler.collect_activities(apps=apps, params=params, user_key=user,
+                                                              filename_additions=user, incremental=incremental,
+                                                              overlap_minutes=overlap_minutes,
+                                                              time_slices=time_slices)
                     except:
                         logging.info(f'Error in collecting log events for user {user}!')
 
@@ -227,12 +243,15 @@ def main():
 
         # Gmail module
         if module == 'gmail' or module == 'all':
-            gmail_handler = Gmail(creds=source_credentials, file_handler=file_handler)
-            admin_directory_handler = AdminDirectory(creds=delegated_credentials, file_handler=file_handler)
-            # Create Cache folder if it doesn't exist
-            os.makedirs(DEFAULT_CACHE_FOLDER, exist_ok=True)
+            gmail_handler = Gmail(creds=source_credentials, file_handler=file_handler, workers=args.workers,
+                                  batch=args.batch, fields_profile=args.fields_profile)
+            admin_directory_handler = AdminDirectory(creds=delegated_credentials, file_handler=file_handler,
+                                                     workers=args.workers, batch=args.batch,
+                                                     fields_profile=args.fields_profile, sharded=args.sharded)
+            admin_directory_handler.user_directory = user_directory
             gmail_users = gmail_handler.get_relevant_gmail_users(admin_directory_handler=admin_directory_handler,
-                                                                 users=users, override=args.override_cache)
+                                                                 users=users, override=args.override_cache,
+                                                                 cache_ttl=args.cache_ttl)
             print(f"{BG}Starting to collect configurations/data from Gmail{RR}")
             if action == 'threads':
                 gmail_handler.list_action_by_values(function='threads',
@@ -244,70 +263,20 @@ def main():
                                                     inner_object='threads',
                                                     delegate_users=True)
             if action == 'messages':
-                gmail_handler.list_action_by_values(function='messages',
-                                                    base_functions=['users'],
-                                                    params={'includeSpamTrash': include_trash_spam,
-                                                            'q': query, 'userId': 'me'},
-                                                    list_items=gmail_users,
-                                                    main_key='user',
-                                                    inner_object='messages',
-                                                    delegate_users=True)
-            if action == 'send_as' or action == 'all':
-                gmail_handler.list_action_by_values(function='sendAs',
-                                                    base_functions=['users', 'settings'],
-                                                    params={'userId': 'me'},
-                                                    list_items=gmail_users,
-                                                    main_key='user',
-                                                    inner_object='sendAs',
-                                                    delegate_users=True)
-            if action == 'delegates' or action == 'all':
-                gmail_handler.list_action_by_values(function='delegates',
-                                                    base_functions=['users', 'settings'],
-                                                    params={'userId': 'me'},
-                                                    list_items=gmail_users,
-                                                    main_key='user',
-                                                    inner_object='delegates',
-                                                    delegate_users=True)
-            if action == 'auto_forwarding' or action == 'all':
-                gmail_handler.list_action_by_values(function='getAutoForwarding',
-                                                    base_functions=['users', 'settings'],
-                                                    params={'userId': 'me'},
-                                                    list_items=gmail_users,
-                                                    main_key='user',
-                                                    delegate_users=True,
-                                                    is_no_action=True)
-            if action == 'forwarding_addresses' or action == 'all':
-                gmail_handler.list_action_by_values(function='forwardingAddresses',
-                                                    base_functions=['users', 'settings'],
-                                                    params={'userId': 'me'},
-                                                    list_items=gmail_users,
-                                                    main_key='user',
-                                                    inner_object='forwardingAddresses',
-                                                    delegate_users=True)
-            if action == 'imap' or action == 'all':
-                gmail_handler.list_action_by_values(function='getImap',
-                                                    base_functions=['users', 'settings'],
-                                                    params={'userId': 'me'},
-                                                    list_items=gmail_users,
-                                                    main_key='user',
-                                                    delegate_users=True,
-                                                    is_no_action=True)
-            if action == 'pop' or action == 'all':
-                gmail_handler.list_action_by_values(function='getPop',
-                                                    base_functions=['users', 'settings'],
-                                                    params={'userId': 'me'},
-                                                    list_items=gmail_users,
-                                                    main_key='user',
-                                                    delegate_users=True,
-                                                    is_no_action=True)
-            if action == 'labels':
-                gmail_handler.list_action_by_values(function='labels',
-                                                    base_functions=['users'],
-                                                    params={'userId': 'me'},
-                                                    list_items=gmail_users,
-                                                    main_key='user',
-                                                    inner_object='labels',
-                                                    delegate_users=True)
+                gmail_handler.collect_messages(users=gmail_users,
+                                               params={'includeSpamTrash': include_trash_spam, 'q': query,
+                                                       'userId': 'me'},
+                                               fetch_format=args.fetch,
+                                               metadata_headers=args.headers.split(',') if args.headers else None,
+                                               incremental=args.incremental)
+            settings_actions = [settings_action for name, settings_action in GMAIL_SETTINGS_ACTIONS.items()
+                                if action == name or (action == 'all' and name != 'labels')]
+            if settings_actions:
+                # the settings of each user are collected back-to-back using a single delegated service
+                gmail_handler.list_actions_by_values(actions=settings_actions,
+                                                     list_items=gmail_users,
+                                                     main_key='user',
+                                                     delegate_users=True)
             if action == 'message' and 'id' in args:
                 gmail_handler.list_action_by_values(function='messages',
                                                     base_functions=['users'],
@@ -352,6 +321,12 @@ def main():
         print(f"{BG}Results are tracked in [{DEFAULT_OUTPUT_FOLDER}]{RR}")
         print(f"{BG}More detailed results can be found at [{log_file}]{RR}")
         file_handler.append_log(f'Finished in {(time.time() - script_start_time) / 60} minutes')
+        # Performance summary of the run (latency per API function, throughput, etc.)
+        metrics_report = file_handler.metrics.report()
+        print(metrics_report)
+        file_handler.append_log(metrics_report)
+        file_handler.close()
+        print(f"{BG}Evidence manifest can be found at [{file_handler.manifest_file}]{RR}")
 
     # General exception catcher
     except (Exception, SystemExit) as e:
@@ -360,7 +335,7 @@ def main():
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
             err_msg = f'ERROR => {exc_type.__name__}: {str(exc_obj)}, line {exc_tb.tb_lineno}, in file {fname}.'
             if log_file is not None and os.access(log_file, os.R_OK):
-                file_handler.append_log(data=err_msg)
+                file_handler.append_log(data=err_msg, level='error')
                 logging.info(f'ERROR! please see log {log_file}')
             else:  # in case log file can't be accesses => print to stdout
                 logging.info(err_msg)
@@ -1,17 +1,37 @@
-from googleapiclient.discovery import build
+from datetime import datetime, timedelta
 
+from .directory_cache import get_tenant_scope
+from ..shared.checkpoint import CheckpointStore
 from ..shared.module_handler import ModuleHandler
-from ..shared.shared_utils import MemoryCache
+from ..shared.service_pool import build_service
+from ..shared.shared_utils import parse_time, format_time, split_time_range
+from ..shared.watermark import WatermarkStore
 
 ALL_APPLICATIONS = ['access_transparency', 'admin', 'calendar', 'chat', 'drive', 'gcp', 'gplus', 'groups',
                     'groups_enterprise', 'jamboard', 'login', 'meet', 'mobile', 'rules', 'saml', 'token',
                     'user_accounts', 'context_aware_access', 'chrome', 'data_studio', 'keep']
+# Events may become available in the Reports API hours after they occur, so incremental collections request the events
+# since the watermark minus an overlap, and drop the events of the overlap that were already collected
+DEFAULT_OVERLAP_MINUTES = 60
+# The applications whose audit logs are large enough to be split into time slices that are collected concurrently
+HEAVY_APPLICATIONS = ['drive', 'login', 'token']
+REPORTS_RETENTION_DAYS = 180
 
 
 class LogEvents(ModuleHandler):
-    def __init__(self, creds, file_handler):
-        super().__init__(creds, file_handler, build('admin', 'reports_v1', credentials=creds, cache=MemoryCache()),
-                         'log_events')
+    SERVICE_NAME = 'admin'
+    SERVICE_VERSION = 'reports_v1'
+    FIELD_PROFILES = {
+        'activities': {
+            'minimal': {'fields': 'nextPageToken,items(id(time,uniqueQualifier,applicationName),actor/email,ipAddress,'
+                                  'events(type,name))'},
+            'triage': {'fields': 'nextPageToken,items(id,actor,ipAddress,ownerDomain,events)'},
+        },
+    }
+
+    def __init__(self, creds, file_handler, **kwargs):
+        super().__init__(creds, file_handler, self.build_service(creds), 'log_events', **kwargs)
+        self.tenant = None  # the scope of the watermarks of the tenant, see get_tenant
 
     @staticmethod
     def check_apps(apps: list):
@@ -19,3 +39,192 @@ class LogEvents(ModuleHandler):
             if app not in ALL_APPLICATIONS:
                 return False
         return True
+
+    def get_tenant(self) -> str:
+        """
+        @return: the tenant (customer ID and super admin, see get_tenant_scope) that the watermarks of the handler are
+        kept for, so incremental collections of several tenants from the same host never share watermarks. The
+        customer ID is resolved once per handler, by incremental collections only. None if it cannot be resolved.
+        """
+        if self.tenant is None:
+            service = build_service('admin', 'directory_v1', self.creds)
+            try:
+                customer = self.list_action(function='customers',
+                                            params={'customerKey': 'my_customer', 'fields': 'id'}, service=service,
+                                            is_get_action=True, add_to_log=False)
+            finally:
+                service.close()
+            # an empty tenant is kept if the customer ID cannot be resolved, so it is not requested again
+            self.tenant = get_tenant_scope(customer[0]['id'], self.creds._subject) if customer else ''
+        return self.tenant or None
+
+    def collect_activities(self, apps: list, params: dict, user_key: str = 'all', filename_additions: str = None,
+                           incremental: bool = False, overlap_minutes: int = DEFAULT_OVERLAP_MINUTES,
+                           time_slices: int = 1) -> None:
+        """
+        Collects the activities of every application. The applications (and their time slices) are collected
+        concurrently by the handler's workers. All the workers share the rate limiter of the Reports API, so the
+        concurrency never exceeds its quota. The time of the newest collected event, and the IDs of the events of the
+        last overlap_minutes before it, are kept as the watermark of the application and userKey (see WatermarkStore)
+        once an incremental collection of the application is completed.
+        @param apps: the applications to collect (see ALL_APPLICATIONS)
+        @param params: the params of activities.list (startTime, endTime)
+        @param user_key: the userKey of the activities ("all" for all the users)
+        @param filename_additions: additional string to add to after the application in the output filenames
+        @param incremental: whether to collect only the events since the watermark of every application (minus
+        overlap_minutes, to cover the ingestion lag of the Reports API). Events of the overlap that were already
+        collected are dropped. Applications without a watermark are collected from the given startTime.
+        @param overlap_minutes: the overlap of incremental collections, in minutes
+        @param time_slices: the number of time slices to split the time range of the heavy applications (see
+        HEAVY_APPLICATIONS) into. The slices of an application are collected concurrently, each to its own output.
+        """
+        overlap = timedelta(minutes=overlap_minutes)
+        tasks = []  # (application, params of the slice, documented item of the slice, whether the slice ends the range)
+        watermarks = {}  # application => (watermark key, watermark, IDs of the events that were already collected)
+        if incremental and self.get_tenant() is None:
+            self.file_handler.append_log('The customer ID of the tenant cannot be resolved, so its watermarks cannot '
+                                         'be used. Collecting the whole time range instead.')
+            incremental = False
+        for app in apps:
+            app_params = dict(params, applicationName=app, userKey=user_key)
+            watermark_key, watermark = None, None
+            if incremental:
+                watermark_key = WatermarkStore.get_key(module=self.module, name='activities',
+                                                       scope=f'{self.get_tenant()}:{app}:{user_key}')
+                watermark = self.file_handler.watermarks.get(watermark_key)
+            collected_ids = set()
+            if incremental and watermark is not None:
+                start_time = parse_time(watermark['time']) - overlap
+                if app_params.get('startTime') is None or parse_time(app_params['startTime']) < start_time:
+                    app_params['startTime'] = format_time(start_time)
+                collected_ids = set(watermark['ids'])
+                if app_params.get('endTime') is not None and parse_time(app_params['endTime']) <= start_time:
+                    self.file_handler.append_log(f'Skipping {self.module}=>activities for {app}: already collected '
+                                                 f'up to {watermark["time"]}')
+                    continue
+            elif incremental:
+                self.file_handler.append_log(f'No watermark for {self.module}=>activities of {app} ({user_key}), '
+                                             f'collecting from {app_params.get("startTime") or "the oldest event"}')
+            watermarks[app] = (watermark_key, watermark, collected_ids)
+            documented_item = f'{app}_{filename_additions}' if filename_additions else app
+            if time_slices < 2 or app not in HEAVY_APPLICATIONS:
+                tasks.append((app, app_params, documented_item, True))
+                continue
+            start_time, end_time = self._get_slices_range(app_params=app_params, documented_item=documented_item)
+            windows = split_time_range(start_time=start_time, end_time=end_time, shards=time_slices)
+            for i, (window_start, window_end, end_inclusive) in enumerate(windows):
+                tasks.append((app, dict(app_params, startTime=window_start, endTime=window_end),
+                              f'{documented_item}_slice{i + 1}of{len(windows)}', end_inclusive))
+
+        if self.workers == 1 or len(tasks) < 2:
+            results = [self._run_activities_task(task=task, collected_ids=watermarks[task[0]][2], overlap=overlap)
+                       for task in tasks]
+        else:
+            executor = self._get_executor()
+            futures = [executor.submit(self._run_activities_task, task=task, collected_ids=watermarks[task[0]][2],
+                                       overlap=overlap, in_worker=True) for task in tasks]
+            results = [future.result() for future in futures]
+
+        for app, (watermark_key, watermark, _) in watermarks.items():
+            if watermark_key is None:
+                continue
+            app_results = [result for task, result in zip(tasks, results) if task[0] == app]
+            if not all(result is not None and result['completed'] for result in app_results):
+                continue
+            event_ids = [event_id for result in app_results for event_id in result['ids']]
+            if not event_ids:  # no new events, the previous watermark still holds
+                continue
+            newest_time = max(parse_time(result['time']) for result in app_results if result['time'] is not None)
+            if watermark is not None and parse_time(watermark['time']) > newest_time:
+                continue
+            # the events of the overlap may span several slices
+            event_ids = [event_id for event_id in dict.fromkeys(event_ids)
+                         if newest_time - parse_time(event_id.partition('/')[0]) <= overlap]
+            self.file_handler.watermarks.set(watermark_key, {'time': format_time(newest_time), 'ids': event_ids})
+
+    def _get_slices_range(self, app_params: dict, documented_item: str) -> tuple:
+        """
+        @return: the (start time, end time) of the time slices of an application. Missing bounds are computed from the
+        current time, and are kept in the checkpoints journal so a resumed run computes the same slices.
+        """
+        if app_params.get('startTime') and app_params.get('endTime'):
+            return app_params['startTime'], app_params['endTime']
+        key = CheckpointStore.get_key(module=self.module, function='activities_slices', params=app_params,
+                                      item=documented_item)
+        time_range = self.file_handler.checkpoints.get_time_range(key)
+        if time_range is None:
+            # the Reports API keeps the events of the last REPORTS_RETENTION_DAYS days
+            now = datetime.utcnow().replace(microsecond=0)
+            time_range = (app_params.get('startTime') or format_time(now - timedelta(days=REPORTS_RETENTION_DAYS)),
+                          app_params.get('endTime') or format_time(now))
+            self.file_handler.checkpoints.save_time_range(key=key, function=f'{self.module}=>activities',
+                                                          start_time=time_range[0], end_time=time_range[1])
+        return time_range
+
+    def _run_activities_task(self, task: tuple, collected_ids: set, overlap: timedelta, in_worker: bool = False):
+        app, params, documented_item, end_inclusive = task
+        try:
+            return self._collect_app_activities(app=app, params=params, documented_item=documented_item,
+                                                collected_ids=collected_ids, overlap=overlap,
+                                                end_inclusive=end_inclusive, in_worker=in_worker)
+        except Exception as ex:
+            self.add_error_to_log(function='activities', requested_action='', page=0, latest_err=str(ex),
+                                  additions=f'Failed to collect item {documented_item}')
+            return None
+
+    def _collect_app_activities(self, app: str, params: dict, documented_item: str, collected_ids: set,
+                                overlap: timedelta, end_inclusive: bool = True, in_worker: bool = False) -> dict:
+        """
+        Collects the activities of an application in a single time range
+        @param collected_ids: the IDs of the events that were already collected (see _get_event_id), which are dropped
+        @param overlap: the length of the window of the newest events whose IDs are kept for the watermark
+        @param end_inclusive: whether the events of the endTime are collected. The events at the end of a time slice
+        belong to the next slice.
+        @return: whether the activities were completely collected by this call, the time of the newest event and the
+        IDs of the events of the overlap before it
+        """
+        checkpoint_key = CheckpointStore.get_key(module=self.module, function='activities', params=params,
+                                                 item=documented_item)
+        checkpoint = self.file_handler.checkpoints.get(checkpoint_key)
+        if checkpoint is not None and checkpoint['completed']:
+            self.file_handler.append_log(f'Skipping item {documented_item}: already collected by a previous run')
+            return {'completed': False, 'time': None, 'ids': []}
+        # the pages of a resumed collection do not include its newest events, so its watermark is not kept
+        resumed = checkpoint is not None and checkpoint['next_page_token'] is not None
+        end_time = parse_time(params['endTime']) if not end_inclusive else None
+        # activities are listed from the newest, so the events of the newest overlap are the first ones
+        newest = {'time': None, 'ids': [], 'duplicates': 0}
+
+        def track_page(activities: list, next_page_token: str) -> None:
+            if not activities:
+                return
+            if end_time is not None:
+                activities[:] = [activity for activity in activities
+                                 if parse_time(activity['id']['time']) < end_time]
+            for activity in activities:
+                event_time = parse_time(activity['id']['time'])
+                if newest['time'] is None:
+                    newest['time'] = event_time
+                elif newest['time'] - event_time > overlap:
+                    break
+                newest['ids'].append(LogEvents._get_event_id(activity))
+            if collected_ids:
+                fresh = [activity for activity in activities
+                         if LogEvents._get_event_id(activity) not in collected_ids]
+                newest['duplicates'] += len(activities) - len(fresh)
+                activities[:] = fresh  # the events that were already collected are not written
+
+        self.print_stdout(f'Collecting data for [{documented_item}] using the function activities')
+        self.list_action(function='activities', params=params, inner_object='items', results_only=True,
+                         service=self._get_worker_service() if in_worker else None, documented_item=documented_item,
+                         page_callback=track_page, item=('item', app))
+        if newest['duplicates']:
+            self.file_handler.append_log(f'{newest["duplicates"]} events of {documented_item} were already '
+                                         f'collected by a previous run and were dropped')
+        completed = not resumed and self.file_handler.checkpoints.is_completed(checkpoint_key)
+        return {'completed': completed, 'time': format_time(newest['time']) if newest['time'] else None,
+                'ids': newest['ids']}
+
+    @staticmethod
+    def _get_event_id(activity: dict) -> str:
+        return f'{activity["id"]["time"]}/{activity["id"].get("uniqueQualifier")}'
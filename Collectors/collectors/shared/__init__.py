@@ -1,2 +1,4 @@
 from .module_handler import ModuleHandler
+from .rate_limiter import RateLimiter, TokenBucket, API_QUOTAS
+from .service_pool import ServicePool
 from .shared_utils import FileHandler, Validators, ConsoleFormatter, DEFAULT_LOG_FILE, DEFAULT_OUTPUT_FOLDER
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+CHECKPOINT_FILE = 'checkpoints.ndjson'
+
+
+class CheckpointStore:
+    """
+    Class CheckpointStore keeps track of the progress of paginated API calls, so an interrupted collection can be
+    resumed: for every call (function, params hash and item) it records the page token of the next page that was not
+    written yet and the number of written pages, or that the call was completed.
+    Checkpoints are appended to a journal file (one JSON record per line, the last record of a call wins), so saving a
+    checkpoint after every written page stays cheap on large collections.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        """
+        @param path: the path of the checkpoints journal
+        @param resume: whether to load the checkpoints of a previous run from the journal. Otherwise, the journal is
+        started from scratch.
+        """
+        self.path = path
+        self.resume = resume
+        self._checkpoints = {}  # key => checkpoint
+        self._lock = threading.Lock()
+        if resume:
+            self._load()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def get_key(module: str, function: str, params: dict, item: str = None) -> str:
+        """
+        @param module: the module of the API call
+        @param function: the API function
+        @param params: the params of the API call (without page tokens)
+        @param item: the item the API call is executed for (see ModuleHandler.list_action documented_item)
+        @return: the key of the API call's checkpoint
+        """
+        return f'{module}.{function}:{CheckpointStore.get_params_hash(params)}:{item}'
+
+    @staticmethod
+    def get_params_hash(params: dict) -> str:
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+    def get(self, key: str):
+        """
+        @return: the checkpoint of an API call from the previous run, or None if the call was not started
+        """
+        with self._lock:
+            return self._checkpoints.get(key)
+
+    def is_completed(self, key: str) -> bool:
+        checkpoint = self.get(key)
+        return checkpoint is not None and checkpoint['completed']
+
+    def save(self, key: str, function: str, params_hash: str, item: str = None, next_page_token: str = None,
+             pages: int = 0, completed: bool = False) -> None:
+        """
+        Records the progress of an API call after its pages were written
+        @param key: the key of the API call (see get_key)
+        @param function: the API function, for documentation purposes
+        @param params_hash: the hash of the API call's params, for documentation purposes
+        @param item: the item the API call is executed for, for documentation purposes
+        @param next_page_token: the page token of the first page that was not written yet
+        @param pages: the number of pages that were written so far
+        @param completed: whether all the pages of the API call were written
+        """
+        checkpoint = {'key': key, 'function': function, 'params_hash': params_hash, 'item': item,
+                      'next_page_token': next_page_token, 'pages': pages, 'completed': completed,
+                      'updated': datetime.utcnow().isoformat(timespec='seconds')}
+        with self._lock:
+            self._checkpoints[key] = checkpoint
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(checkpoint) + '\n')
+
+    def get_time_range(self, key: str):
+        """
+        @return: the (start time, end time) that a collection of the previous run computed for itself (see
+        save_time_range), or None
+        """
+        checkpoint = self.get(key)
+        return tuple(checkpoint['time_range']) if checkpoint is not None else None
+
+    def save_time_range(self, key: str, function: str, start_time: str, end_time: str) -> None:
+        """
+        Records the time range that a collection computed for itself (e.g. from the current time), so a resumed run
+        splits the same time range into the same API calls, and finds their checkpoints
+        @param key: the key of the time range (see get_key)
+        @param function: the API function, for documentation purposes
+        """
+        checkpoint = {'key': key, 'function': function, 'time_range': [start_time, end_time],
+                      'updated': datetime.utcnow().isoformat(timespec='seconds')}
+        with self._lock:
+            self._checkpoints[key] = checkpoint
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(checkpoint) + '\n')
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    checkpoint = json.loads(line)
+                except ValueError:  # the last line may be partial if the previous run was killed while writing it
+                    continue
+                self._checkpoints[checkpoint['key']] = checkpoint
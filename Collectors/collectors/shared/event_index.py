@@ -0,0 +1,113 @@
+import sqlite3
+import threading
+
+# Parameters of Reports API events that name the resource the event acted on, by priority
+ACTIVITY_RESOURCE_PARAMETERS = ['doc_id', 'resource_name', 'target_user', 'group_email', 'user_email', 'device_id']
+
+
+class EventIndex:
+    """
+    Class EventIndex is a local SQLite database of normalized events that is populated during the collection, so the
+    collected logs can be queried by time, actor, event name, source IP or resource while (and right after) they are
+    collected. Every row points to the raw record in the output files (the file and the index of the record in it).
+    Supported records:
+    - Reports API activities (log_events activities): a row per event of the activity
+    - Cloud Logging entries (log_collection entries): a row per entry
+    Rows are inserted in batches, and the database uses WAL journaling so it can be queried while it is written.
+    """
+    BATCH_SIZE = 5000
+    COLUMNS = ['time', 'source', 'actor', 'event', 'ip', 'resource', 'file', 'record']
+    INDEXED_COLUMNS = ['time', 'actor', 'event', 'ip', 'resource']
+
+    def __init__(self, path: str):
+        """
+        @param path: the path of the database. Events are added to an existing database
+        """
+        self.path = path
+        self.rows = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS events (time TEXT, source TEXT, actor TEXT, event TEXT, '
+                                 'ip TEXT, resource TEXT, file TEXT, record INTEGER)')
+        for column in EventIndex.INDEXED_COLUMNS:
+            self._connection.execute(f'CREATE INDEX IF NOT EXISTS events_{column} ON events ({column})')
+        self._connection.commit()
+
+    def add_records(self, records: list, path: str, first_record: int = 0) -> None:
+        """
+        Adds the events of records that were written to an output file. Records that are not events are ignored.
+        @param records: the written records
+        @param path: the output file the records were written to
+        @param first_record: the index of the first record in the output file (line number for NDJSON files, position
+        in the results for JSON files)
+        """
+        rows = []
+        for position, record in enumerate(records, start=first_record):
+            rows.extend(row + (path, position) for row in EventIndex.get_rows(record))
+        if not rows:
+            return
+        with self._lock:
+            self._pending.extend(rows)
+            if len(self._pending) >= EventIndex.BATCH_SIZE:
+                self._insert_pending()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._insert_pending()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is None:
+                return
+            self._insert_pending()
+            self._connection.close()
+            self._connection = None
+
+    def _insert_pending(self) -> None:
+        if not self._pending or self._connection is None:
+            return
+        self._connection.executemany(f'INSERT INTO events VALUES ({", ".join("?" * len(EventIndex.COLUMNS))})',
+                                     self._pending)
+        self._connection.commit()
+        self.rows += len(self._pending)
+        self._pending = []
+
+    @staticmethod
+    def get_rows(record) -> list:
+        """
+        @param record: a collected record
+        @return: the normalized (time, source, actor, event, ip, resource) rows of the record's events
+        """
+        if not isinstance(record, dict):
+            return []
+        record_id = record.get('id')
+        if isinstance(record_id, dict) and 'applicationName' in record_id and 'events' in record:
+            return EventIndex._get_activity_rows(record)
+        if 'logName' in record and 'timestamp' in record:
+            return [EventIndex._get_entry_row(record)]
+        return []
+
+    @staticmethod
+    def _get_activity_rows(activity: dict) -> list:
+        actor = activity.get('actor', {})
+        rows = []
+        for event in activity.get('events', []):
+            parameters = {parameter.get('name'): parameter.get('value') for parameter in event.get('parameters', [])}
+            resource = next((parameters[name] for name in ACTIVITY_RESOURCE_PARAMETERS if parameters.get(name)), None)
+            rows.append((activity['id'].get('time'), activity['id']['applicationName'],
+                         actor.get('email', actor.get('profileId')), event.get('name'), activity.get('ipAddress'),
+                         resource if resource is None else str(resource)))
+        return rows
+
+    @staticmethod
+    def _get_entry_row(entry: dict) -> tuple:
+        payload = entry.get('protoPayload', {})
+        actor = payload.get('authenticationInfo', {}).get('principalEmail')
+        event = payload.get('methodName')
+        resource = payload.get('resourceName') or entry.get('resource', {}).get('type')
+        ip = payload.get('requestMetadata', {}).get('callerIp') or entry.get('httpRequest', {}).get('remoteIp')
+        return (entry['timestamp'], entry['logName'], actor, event, ip,
+                resource if resource is None else str(resource))
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+MANIFEST_FILE = 'manifest.json'
+# Fields that hold the time of a record, in the results of the collected APIs
+RECORD_TIME_FIELDS = [('timestamp',), ('id', 'time'), ('updateTime',), ('creationTime',)]
+
+
+class EvidenceManifest:
+    """
+    Class EvidenceManifest keeps the chain of custody information of the output files of a run: the SHA-256, size,
+    record count and time range (of the records) of every file are computed incrementally while the file is written,
+    so the manifest never requires reading the evidence again. The manifest can be written at any time, including for
+    partial runs.
+    """
+
+    def __init__(self, folder: str, cmdline: str):
+        """
+        @param folder: the output folder. Paths in the manifest are relative to it
+        @param cmdline: the command line of the run
+        """
+        self.folder = folder
+        self.cmdline = cmdline
+        self.started = datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+        self._files = {}  # path => {'sha256': hash object, 'size': int, 'records': int, 'first': str, 'last': str}
+        self._lock = threading.Lock()
+
+    def update(self, path: str, data, records: list = None) -> None:
+        """
+        Adds data that was written to an output file
+        @param path: the path of the output file
+        @param data: the written data (str or bytes)
+        @param records: the records that the data holds (used for the record count and the time range)
+        """
+        encoded = data.encode('utf-8') if isinstance(data, str) else data
+        times = [t for t in (EvidenceManifest._get_record_time(record) for record in records or []) if t]
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is None:
+                entry = {'sha256': hashlib.sha256(), 'size': 0, 'records': 0, 'first': None, 'last': None}
+                self._files[path] = entry
+            entry['sha256'].update(encoded)
+            entry['size'] += len(encoded)
+            entry['records'] += len(records or [])
+            if times:
+                entry['first'] = min([entry['first']] + times) if entry['first'] else min(times)
+                entry['last'] = max([entry['last']] + times) if entry['last'] else max(times)
+
+    def write(self, path: str, completed: bool) -> str:
+        """
+        Writes the manifest. The manifest is sealed by the SHA-256 of its content (without the seal itself)
+        @param path: the path of the manifest file
+        @param completed: whether the run was completed, or the manifest documents a partial run
+        @return: the path of the manifest file
+        """
+        with self._lock:
+            files = [{'path': os.path.relpath(file_path, self.folder), 'sha256': entry['sha256'].hexdigest(),
+                      'size': entry['size'], 'records': entry['records'], 'first_record_time': entry['first'],
+                      'last_record_time': entry['last']}
+                     for file_path, entry in sorted(self._files.items())]
+        manifest = {'command': self.cmdline, 'started': self.started,
+                    'ended': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+                    'status': 'completed' if completed else 'partial', 'files': files}
+        manifest['manifest_sha256'] = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return path
+
+    @staticmethod
+    def _get_record_time(record):
+        if not isinstance(record, dict):
+            return None
+        for field_path in RECORD_TIME_FIELDS:
+            value = record
+            for field in field_path:
+                value = value.get(field) if isinstance(value, dict) else None
+            if isinstance(value, str):
+                return value
+        return None
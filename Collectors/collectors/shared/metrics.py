@@ -0,0 +1,161 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+from tabulate import tabulate
+
+METRICS_FILE = 'metrics.ndjson'
+
+
+class MetricsRecorder:
+    """
+    Class MetricsRecorder records the performance metrics of a collection run to a metrics file (one JSON record per
+    line) and aggregates them per API function for the end of run report:
+    - page records: request latency, response bytes, items, retries, retry sleep and rate limit wait of every page
+    - call records: the totals of every list_action call
+    - write records: JSON serialization time, file write time and bytes of every output write
+    """
+
+    def __init__(self, path: str):
+        """
+        @param path: the path of the metrics file
+        """
+        self.path = path
+        self._functions = {}  # function => aggregated metrics
+        self._writes = {'count': 0, 'bytes': 0, 'serialize_time': 0.0, 'write_time': 0.0}
+        self._file = None
+        self._lock = threading.Lock()
+
+    def record_page(self, module: str, function: str, item: str = None, page: int = 0, latency: float = 0.0,
+                    response_bytes: int = 0, items: int = 0, retries: int = 0, retry_sleep: float = 0.0,
+                    rate_limit_wait: float = 0.0) -> None:
+        """
+        Records the metrics of a single page of an API call
+        @param module: the module of the API call
+        @param function: the API function
+        @param item: the item the API call was executed for
+        @param page: the page number
+        @param latency: the latency (in seconds) of the successful request of the page
+        @param response_bytes: the size of the response body
+        @param items: the number of items in the page
+        @param retries: the number of retries of the page
+        @param retry_sleep: the time (in seconds) that was spent sleeping between the retries of the page
+        @param rate_limit_wait: the time (in seconds) that was spent waiting for the rate limiter
+        """
+        end = time.monotonic()
+        with self._lock:
+            metrics = self._functions.get((module, function))
+            if metrics is None:
+                metrics = {'latencies': [], 'items': 0, 'bytes': 0, 'retries': 0, 'retry_sleep': 0.0,
+                           'rate_limit_wait': 0.0, 'calls': 0, 'start': end - latency, 'end': end}
+                self._functions[(module, function)] = metrics
+            metrics['latencies'].append(latency)
+            metrics['items'] += items
+            metrics['bytes'] += response_bytes
+            metrics['retries'] += retries
+            metrics['retry_sleep'] += retry_sleep
+            metrics['rate_limit_wait'] += rate_limit_wait
+            metrics['start'] = min(metrics['start'], end - latency - retry_sleep - rate_limit_wait)
+            metrics['end'] = max(metrics['end'], end)
+        self._write_record({'type': 'page', 'module': module, 'function': function, 'item': item, 'page': page,
+                            'latency': round(latency, 6), 'response_bytes': response_bytes, 'items': items,
+                            'retries': retries, 'retry_sleep': round(retry_sleep, 6),
+                            'rate_limit_wait': round(rate_limit_wait, 6)})
+
+    def record_call(self, module: str, function: str, item: str = None, pages: int = 0, items: int = 0,
+                    retries: int = 0, latency: float = 0.0, retry_sleep: float = 0.0, duration: float = 0.0,
+                    error: str = None) -> None:
+        """
+        Records the totals of an API call (all of its pages)
+        @param duration: the total time (in seconds) of the call, including writing its results
+        @param error: the error that stopped the call, if any
+        """
+        with self._lock:
+            if (module, function) in self._functions:
+                self._functions[(module, function)]['calls'] += 1
+        self._write_record({'type': 'call', 'module': module, 'function': function, 'item': item, 'pages': pages,
+                            'items': items, 'retries': retries, 'latency': round(latency, 6),
+                            'retry_sleep': round(retry_sleep, 6), 'duration': round(duration, 6), 'error': error})
+
+    def record_write(self, outfile: str, serialize_time: float, write_time: float, written_bytes: int) -> None:
+        """
+        Records the metrics of writing results to an output file
+        @param outfile: the output file
+        @param serialize_time: the time (in seconds) it took to serialize the results to JSON
+        @param write_time: the time (in seconds) it took to write the serialized results to the file
+        @param written_bytes: the size of the serialized results
+        """
+        with self._lock:
+            self._writes['count'] += 1
+            self._writes['bytes'] += written_bytes
+            self._writes['serialize_time'] += serialize_time
+            self._writes['write_time'] += write_time
+        self._write_record({'type': 'write', 'outfile': outfile, 'serialize_time': round(serialize_time, 6),
+                            'write_time': round(write_time, 6), 'bytes': written_bytes})
+
+    def get_summary(self) -> list:
+        """
+        @return: the aggregated metrics of every API function: p50/p95 page latency, throughput in items per second,
+        and the totals of the run
+        """
+        with self._lock:
+            functions = {key: dict(metrics, latencies=sorted(metrics['latencies']))
+                         for key, metrics in self._functions.items()}
+        summary = []
+        for (module, function), metrics in functions.items():
+            elapsed = metrics['end'] - metrics['start']
+            summary.append({'module': module, 'function': function, 'calls': metrics['calls'],
+                            'pages': len(metrics['latencies']), 'items': metrics['items'],
+                            'p50_latency': round(MetricsRecorder._percentile(metrics['latencies'], 50), 3),
+                            'p95_latency': round(MetricsRecorder._percentile(metrics['latencies'], 95), 3),
+                            'items_per_second': round(metrics['items'] / elapsed, 1) if elapsed > 0 else None,
+                            'response_bytes': metrics['bytes'], 'retries': metrics['retries'],
+                            'retry_sleep': round(metrics['retry_sleep'], 3),
+                            'rate_limit_wait': round(metrics['rate_limit_wait'], 3)})
+        return summary
+
+    def report(self) -> str:
+        """
+        Writes the summary of the run to the metrics file and closes it
+        @return: the summary of the run as a printable table
+        """
+        summary = self.get_summary()
+        with self._lock:
+            writes = dict(self._writes)
+        self._write_record({'type': 'summary', 'functions': summary, 'writes': writes})
+        self.close()
+        table = tabulate([[row['module'], row['function'], row['calls'], row['pages'], row['items'],
+                           row['p50_latency'], row['p95_latency'], row['items_per_second'], row['retries'],
+                           row['retry_sleep'], row['rate_limit_wait']] for row in summary],
+                         headers=['module', 'function', 'calls', 'pages', 'items', 'p50 latency (s)',
+                                  'p95 latency (s)', 'items/s', 'retries', 'retry sleep (s)', 'rate limit wait (s)'],
+                         tablefmt='simple_outline')
+        return f'{table}\nOutput writes: {writes["count"]}, {writes["bytes"]} bytes, ' \
+               f'serialization {writes["serialize_time"]:.3f}s, file write {writes["write_time"]:.3f}s\n' \
+               f'Metrics can be found at [{self.path}]'
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write_record(self, record: dict) -> None:
+        record['time'] = datetime.utcnow().isoformat(timespec='milliseconds')
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(line)
+
+    @staticmethod
+    def _percentile(values: list, percentile: int) -> float:
+        """
+        @param values: sorted values
+        @return: the nearest-rank percentile of the values
+        """
+        if not values:
+            return 0.0
+        rank = max(1, -(-percentile * len(values) // 100))  # ceil
+        return values[rank - 1]
@@ -1,10 +1,17 @@
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build, Resource
+from googleapiclient.discovery import Resource
 
-from .shared_utils import FileHandler, ConsoleFormatter, MemoryCache
+from .rate_limiter import RateLimiter
+from .retry_policy import RetryPolicy, RATE_LIMITED, NOT_FOUND
+from .checkpoint import CheckpointStore
+from .service_pool import ServicePool, build_service
+from .shared_utils import FileHandler, ConsoleFormatter
 
 BG = "\u001b[32;1m"  # Bright green
 RR = "\u001b[0m"  # Reset
@@ -18,29 +25,57 @@ class ModuleHandler:
     """
     MAX_EVENTS = 50000
     MAX_PAGES = 50
-    MAX_RETRY = 3
-    SLEEP_SECONDS_FOR_RETRY = 5
+    RETRY_POLICY = RetryPolicy()
+    # Maximal number of sub-requests in a single batch request, by SERVICE_NAME
+    BATCH_SIZES = {'admin': 100, 'gmail': 50}
+    DEFAULT_BATCH_SIZE = 50
+    # Maximal number of idle delegated services (and their connections) kept by the handler
+    SERVICE_POOL_SIZE = 256
+    # The Google API service the handler works with (see googleapiclient.discovery.build)
+    SERVICE_NAME = None
+    SERVICE_VERSION = None
+    # Shared by all the handlers, so every API call of the run is throttled according to the API quotas
+    RATE_LIMITER = RateLimiter()
+    # Field profiles, from the smallest response to the complete one. The "full" profile never changes the params
+    FIELDS_PROFILES = ['minimal', 'triage', 'full']
+    DEFAULT_FIELDS_PROFILE = 'full'
+    # Partial response params of each function per profile: function => {profile => params}. Each handler defines the
+    # params of its API ("fields" masks, "projection", etc.). List masks must keep nextPageToken if the API pages.
+    FIELD_PROFILES = {}
 
     def __init__(self, creds: Credentials, file_handler: FileHandler, service: Resource, module: str,
-                 console_formatter: ConsoleFormatter = None):
+                 console_formatter: ConsoleFormatter = None, workers: int = 1, batch: bool = False,
+                 fields_profile: str = DEFAULT_FIELDS_PROFILE):
         """
         @param creds: Google creds object
         @param file_handler: FileHandler object from shared_utils.py
         @param service: the API service object, created by googleapiclient.discovery.build function
         @param module: a string describing the requestes service. Used mainly for documentation purposes.
+        @param workers: the maximal number of API calls list_action_by_values executes concurrently
+        @param batch: whether list_action_by_values packs single page calls into HTTP batch requests
+        @param fields_profile: the default field profile (see FIELDS_PROFILES) of the handler's API calls
         """
         self.creds = creds
         self.service = service
         self.file_handler = file_handler
         self.module = module
         self.delegates = {}
+        self.workers = max(1, workers)
+        self.batch = batch
+        self.fields_profile = fields_profile
+        self._executor = None
+        self._worker_local = threading.local()  # service objects are not thread-safe, each worker builds its own
+        self._worker_services = []
+        self.service_pool = ServicePool(factory=self._build_delegated_service, max_size=ModuleHandler.SERVICE_POOL_SIZE)
+        self._lock = threading.Lock()
         self.configure_formatter()
         # self.console_formatter = console_formatter if console_formatter is not None else ConsoleFormatter()
 
     def list_action(self, function: str, params: dict, metadata_additions: list = None, documented_item: str = None,
                     inner_object: str = None, add_to_log: bool = True, service: object = None,
                     base_functions: list = None, results_only: bool = True, is_wrapped=False,
-                    is_get_action: bool = False, is_no_action: bool = False, is_create_action: bool = False):
+                    is_get_action: bool = False, is_no_action: bool = False, is_create_action: bool = False,
+                    subject: str = None, fields_profile: str = None, page_callback=None, item: tuple = None):
         """
         This function executes a single Google API call.
 
@@ -73,11 +108,30 @@ class ModuleHandler:
         @param is_no_action: by default, the applied action is "list". Use this flag in order to use no action.
         @param is_create_action: by default, the applied action is "list". Use this flag in order to change it
         to "create".
+        @param subject: the delegated user that the service acts as, used for per-user API quotas. By default, the
+        subject of the handler's credentials.
+        @param fields_profile: the field profile of the call (see FIELDS_PROFILES) that selects the fields of the
+        response. By default, the handler's field profile.
+        @param page_callback: a function that is called with the results of every page (the inner object) and the token
+        of the next page. The callback may remove items from the page (in place) so they are not written. Returning
+        False stops the pagination after the page. A stopped call is not completed as far as the checkpoints are
+        concerned, so a resumed run continues it from the next page. If add_to_log is False, the pages are only given
+        to the callback and are not accumulated in the returned results.
+        @param item: the (key, value) of the item that the call is executed for by list_action_by_values, e.g.
+        ("user", "user@example.com"). If the FileHandler was created in consolidated mode, the pages of the item are
+        appended to the single output file of the function.
         @return: The function uses the FileHandler to write the results to the log file. In case the flag "add_to_log"
         was set to True, the function returns the results instead of writing them to the log.
+        If the FileHandler was created in stream mode and "add_to_log" is True, each page is appended to an NDJSON
+        output file as soon as it arrives instead of being accumulated in memory.
+        When "add_to_log" is True, the progress of the call is saved to the FileHandler's checkpoints after every
+        written page. Calls that were completed by a resumed run are skipped, and interrupted calls continue from the
+        first page that was not written.
         """
         requested_action = ''
         pages = 1
+        consolidated = add_to_log and item is not None and self.file_handler.consolidate
+        stream = add_to_log and (self.file_handler.stream or consolidated)
         try:
 
             # Get a handle for relevant API action based on service, base_functions and function (main function)
@@ -86,65 +140,137 @@ class ModuleHandler:
                 for f in base_functions:
                     service = getattr(service, f)()
             action = getattr(service, function)
+            rate_limit_bucket = self.get_rate_limit_bucket(subject=subject)
+            call_stats = {'pages': 0, 'items': 0, 'retries': 0, 'retry_sleep': 0.0, 'latency': 0.0}
+            call_start_time = time.monotonic()
             results = {}
             total_event_count = 0
             final_results = []
             first_check = True
             partial_dump = False
+            failure = None  # the error that stopped the collection, if any
+            stopped = False  # whether the pagination was stopped by page_callback
+            page_token = None
+            # the params of the API requests also select the response fields. The original params are documented
+            request_params = self.get_projected_params(function=function, params=params, fields_profile=fields_profile)
+            # Checkpoints are kept only for calls whose results are written to the output folder
+            checkpoint_key = CheckpointStore.get_key(module=self.module, function=function, params=params,
+                                                     item=documented_item) if add_to_log else None
+            checkpoint = self.file_handler.checkpoints.get(checkpoint_key) if add_to_log else None
+            if checkpoint is not None and checkpoint['completed']:
+                self.file_handler.append_log(f'Skipping {self.module}=>{function}, params: {params}. '
+                                             f'Already collected by a previous run')
+                return None
+            if checkpoint is not None and checkpoint['next_page_token']:
+                results = {'nextPageToken': checkpoint['next_page_token']}
+                pages = checkpoint['pages'] + 1
+                first_check = False
+                self.file_handler.append_log(f'Resuming {self.module}=>{function} from page #{pages}, '
+                                             f'params: {params}')
             # Iterate each page of the results
             logging.info(f'Executing {self.module}=>{function}{requested_action}')
             self.file_handler.append_log(f'Executing {self.module}=>{function}{requested_action}, params: {params}')
             while first_check or 'nextPageToken' in results:
                 # Update params token for next page if exists
-                updated_params = params.copy()
-                has_next_page = 'nextPageToken' in results
-                if has_next_page:
+                updated_params = request_params.copy()
+                page_token = results.get('nextPageToken')
+                if page_token:
                     if is_wrapped:  # for GCP historical logs results which are wrapped
-                        updated_params['body']['pageToken'] = results['nextPageToken']
+                        updated_params['body'] = dict(params['body'], pageToken=page_token)
                     else:
-                        updated_params['pageToken'] = results['nextPageToken']
-                # Apply requested action with retry mechanism
+                        updated_params['pageToken'] = page_token
+                # Apply requested action with retry mechanism. Retries always use the last successful page token,
+                # so a failure never skips pages.
                 retry_count = 0
-                success = False
-                while retry_count < ModuleHandler.MAX_RETRY and not success:
+                page_stats = {'retries': 0, 'retry_sleep': 0.0, 'rate_limit_wait': 0.0, 'latency': 0.0, 'bytes': 0}
+                while True:
                     try:
+                        page_stats['rate_limit_wait'] += rate_limit_bucket.acquire()
+                        request_start_time = time.monotonic()
                         # Execute the relevant API action based on the relevant boolean flag
                         if is_get_action:
                             requested_action = '.get'  # for exception
-                            results = action().get(**updated_params).execute()
+                            request = action().get(**updated_params)
                         elif is_create_action:
                             requested_action = '.create'  # for exception
-                            results = action().create(**updated_params).execute()
+                            request = action().create(**updated_params)
                         elif is_no_action:
                             requested_action = ''
-                            results = action(**updated_params).execute()
+                            request = action(**updated_params)
                         else:
                             requested_action = '.list'
-                            results = action().list(**updated_params).execute()
-                        success = True
+                            request = action().list(**updated_params)
+                        results = ModuleHandler._execute_request(request=request, page_stats=page_stats)
+                        page_stats['latency'] = time.monotonic() - request_start_time
+                        call_stats['latency'] += page_stats['latency']
+                        rate_limit_bucket.increase()
+                        break
                     except Exception as ex:
+                        call_stats['latency'] += time.monotonic() - request_start_time
+                        error_class = ModuleHandler.RETRY_POLICY.classify(ex)
+                        if error_class == RATE_LIMITED:
+                            rate_limit_bucket.decrease()
                         # Handle known errors
-                        if 'Requested entity was not found.' in str(ex):
+                        if error_class == NOT_FOUND:
                             self.file_handler.append_log('Requested entity was not found')
+                            failure = ex
+                            break
+                        if not RetryPolicy.is_retryable(error_class):
+                            self.add_error_to_log(function=function, requested_action=requested_action, page=pages,
+                                                  latest_err=str(ex), additions=f'Error is not retryable '
+                                                                                f'({error_class}).')
+                            failure = ex
                             break
                         # Retry Mechanism
-                        else:
-                            if retry_count == ModuleHandler.MAX_RETRY - 1:
-                                self.add_error_to_log(function=function, requested_action=requested_action, page=pages,
-                                                      latest_err=str(ex),
-                                                      additions=f'Max retry count reached ({ModuleHandler.MAX_RETRY}).')
-                                return {}  # END FUNCTION.
-                            else:
-                                retry_count += 1
-                                sleep_time = retry_count * ModuleHandler.SLEEP_SECONDS_FOR_RETRY
-                                logging.info(f'Failed to retrieve {function}{requested_action}, page #{pages}, '
-                                             f'params {params}, metadata additions {metadata_additions}.\n'
-                                             f'Exception: {str(ex)}\n'
-                                             f'Retrying in {sleep_time} seconds...')
-                                sleep(sleep_time)
-                # append page results to final list
+                        if retry_count == ModuleHandler.RETRY_POLICY.max_retry:
+                            self.add_error_to_log(function=function, requested_action=requested_action, page=pages,
+                                                  latest_err=str(ex),
+                                                  additions=f'Max retry count reached '
+                                                            f'({ModuleHandler.RETRY_POLICY.max_retry}). '
+                                                            f'Collection can be resumed from page token: '
+                                                            f'{page_token}')
+                            failure = ex
+                            break
+                        retry_count += 1
+                        sleep_time = ModuleHandler.RETRY_POLICY.get_delay(retry_count=retry_count, ex=ex)
+                        call_stats['retries'] += 1
+                        call_stats['retry_sleep'] += sleep_time
+                        page_stats['retries'] += 1
+                        page_stats['retry_sleep'] += sleep_time
+                        logging.info(f'Failed to retrieve {function}{requested_action}, page #{pages} '
+                                     f'({error_class}), params {params}, metadata additions {metadata_additions}.\n'
+                                     f'Exception: {str(ex)}\n'
+                                     f'Retrying in {sleep_time:.1f} seconds...')
+                        sleep(sleep_time)
+                if failure is not None:
+                    break  # results that were already collected are still written below
+                call_stats['pages'] += 1
+                # append page results to final list (or directly to the output stream)
                 final_result = results.get(inner_object, {}) if inner_object else results
-                if len(final_result) > 0:
+                page_items = len(final_result) if type(final_result) == list else int(len(final_result) > 0)
+                call_stats['items'] += page_items
+                self.file_handler.metrics.record_page(module=self.module, function=function, item=documented_item,
+                                                      page=pages, latency=page_stats['latency'],
+                                                      response_bytes=page_stats['bytes'], items=page_items,
+                                                      retries=page_stats['retries'],
+                                                      retry_sleep=page_stats['retry_sleep'],
+                                                      rate_limit_wait=page_stats['rate_limit_wait'])
+                if page_callback is not None and page_callback(final_result, results.get('nextPageToken')) is False:
+                    stopped = True
+                if stream:
+                    if len(final_result) > 0:
+                        self.add_to_log(function=function, results=final_result, documented_item=documented_item,
+                                        writing_mode='a', item=item)
+                        total_event_count += len(final_result) if type(final_result) == list else 1
+                    self._save_checkpoint(key=checkpoint_key, function=function, params=params,
+                                          documented_item=documented_item,
+                                          next_page_token=results.get('nextPageToken'), pages=pages)
+                    first_check = False
+                    pages += 1
+                    if stopped:
+                        break
+                    continue
+                if len(final_result) > 0 and (add_to_log or page_callback is None):
                     if type(final_result) == list:
                         final_results.extend(final_result)
                     else:
@@ -154,25 +280,19 @@ class ModuleHandler:
                 # Check if there are too many pages. If so, the results are split to avoid high memory.
                 # If the amount of pages is higher than the MAX_PAGES defined and add_to_log is False,
                 # the function return only the first MAX_PAGES and writes an error to the log.
-                if pages % ModuleHandler.MAX_PAGES == 0:
+                if pages % ModuleHandler.MAX_PAGES == 0 and final_results:
                     partial_dump = True
                     has_error = False
-                    if results_only:
-                        obj = final_results
-                    else:
-                        display_params = params.copy()
-                        if metadata_additions is not None:
-                            for key, value in metadata_additions:
-                                display_params[key] = value
-                        obj = {'module': self.module,
-                               'function': function,
-                               'params': display_params,
-                               'data': final_results}
+                    obj = self._wrap_results(function=function, params=params, results=final_results,
+                                             metadata_additions=metadata_additions, results_only=results_only)
                     if add_to_log:
                         self.add_to_log(function=function, results=obj, documented_item=documented_item)
                         self.file_handler.append_log(
                             f'Partial dump for function {function}, params: {str(params)}. '
                             f'Total Pages written: {pages}')
+                        self._save_checkpoint(key=checkpoint_key, function=function, params=params,
+                                              documented_item=documented_item,
+                                              next_page_token=results.get('nextPageToken'), pages=pages)
                     else:
                         has_error = True
                         error_msg = f'WARNING: Max pages ({ModuleHandler.MAX_PAGES}) in memory ' \
@@ -186,20 +306,43 @@ class ModuleHandler:
                     if not has_error:
                         final_results.clear()
                 pages += 1
+                if stopped:
+                    break
 
+            self.file_handler.append_log(f'Call stats for {self.module}=>{function}{requested_action}: '
+                                         f'{call_stats["pages"]} pages, {call_stats["retries"]} retries, '
+                                         f'request latency {call_stats["latency"]:.3f}s, '
+                                         f'retry sleep {call_stats["retry_sleep"]:.3f}s, '
+                                         f'total {time.monotonic() - call_start_time:.3f}s')
+            self.file_handler.metrics.record_call(module=self.module, function=function, item=documented_item,
+                                                  pages=call_stats['pages'], items=call_stats['items'],
+                                                  retries=call_stats['retries'], latency=call_stats['latency'],
+                                                  retry_sleep=call_stats['retry_sleep'],
+                                                  duration=time.monotonic() - call_start_time,
+                                                  error=str(failure) if failure is not None else None)
+            completed = not stopped and (failure is None or
+                                         ModuleHandler.RETRY_POLICY.classify(failure) == NOT_FOUND)
+            # In stream mode the pages were already written, only the stream footer is left
+            if stream:
+                if total_event_count > 0:
+                    self.print_stdout(f'{total_event_count} results were found')
+                    summary = self._wrap_results(function=function, params=params, results=None,
+                                                 metadata_additions=metadata_additions, results_only=False)
+                    del summary['data']
+                    summary['pages'] = call_stats['pages']
+                    if failure is not None and ModuleHandler.RETRY_POLICY.classify(failure) != NOT_FOUND:
+                        summary['error'] = str(failure)
+                        summary['next_page_token'] = page_token
+                    self.end_stream_log(function=function, summary=summary, documented_item=documented_item,
+                                        item=item)
+                    if completed:
+                        self._save_checkpoint(key=checkpoint_key, function=function, params=params,
+                                              documented_item=documented_item, pages=pages - 1, completed=True)
+                    return None
             # In case there are more results after partial dump, or only no partial dump at all
-            if len(final_results) > 0:
-                if results_only:
-                    obj = final_results
-                else:
-                    display_params = params.copy()
-                    if metadata_additions is not None:
-                        for key, value in metadata_additions:
-                            display_params[key] = value
-                    obj = {'module': self.module,
-                           'function': function,
-                           'params': display_params,
-                           'data': final_results}
+            elif len(final_results) > 0:
+                obj = self._wrap_results(function=function, params=params, results=final_results,
+                                         metadata_additions=metadata_additions, results_only=results_only)
 
                 if add_to_log:
 
@@ -213,23 +356,35 @@ class ModuleHandler:
                         self.file_handler.append_log(
                             f'Ended partial dump for function {function}, params: {str(params)}. '
                             f'Total Pages written: {pages}')
+                    self._save_checkpoint(key=checkpoint_key, function=function, params=params,
+                                          documented_item=documented_item,
+                                          next_page_token=None if completed else results.get('nextPageToken'),
+                                          pages=pages - 1,
+                                          completed=completed)
+                    return None
                 else:
                     return obj
-            else:
-                _out = f'No results for {function}{requested_action} with the following params ' \
-                       f'{str(params)}. Acting as {self.creds._subject}'
-                self.print_stdout('No Results Found')
-                if add_to_log:
-                    self.file_handler.append_log(_out)
-                else:
-                    logging.info(_out)
-                return {}
 
-            return None
+            if not add_to_log and call_stats['items'] > 0:  # the pages were consumed by page_callback
+                return {}
+            _out = f'No results for {function}{requested_action} with the following params ' \
+                   f'{str(params)}. Acting as {self.creds._subject}'
+            self.print_stdout('No Results Found')
+            if add_to_log:
+                self.file_handler.append_log(_out)
+                if completed:
+                    self._save_checkpoint(key=checkpoint_key, function=function, params=params,
+                                          documented_item=documented_item, pages=pages - 1, completed=True)
+            else:
+                logging.info(_out)
+            return {}
 
         except Exception as ex:
             self.add_error_to_log(function=function, requested_action=requested_action, page=pages,
                                   latest_err=str(ex))
+            if stream:  # complete the partially written stream, the footer documents the failure
+                self.end_stream_log(function=function, summary={'pages': pages - 1, 'error': str(ex)},
+                                    documented_item=documented_item, item=item)
 
     def list_action_by_values(self, function: str, params: dict, list_items: list,
                               main_key: str = None,
@@ -237,8 +392,8 @@ class ModuleHandler:
                               item_as_data: bool = False, delegate_users: bool = False,
                               base_functions: list = None, is_get_action: bool = False,
                               is_no_action: bool = False, is_create_action: bool = False,
-                              results_only: bool = False, filename_additions: str = None
-                              ) -> None:
+                              results_only: bool = False, filename_additions: str = None,
+                              single_page: bool = False, fields_profile: str = None) -> None:
         """
         This function executes multiple Google API call based on a given list.
 
@@ -274,41 +429,472 @@ class ModuleHandler:
         @param results_only: by default the results are not wrapped by the list_action function
         with the requested params and metadata_additions. This flag indicates whether to return the results wrapped.
         @param filename_additions: additional string to add to after the supplied "item" in the output log filename.
+        @param single_page: whether the "list" action returns a single page (no pagination) for each item. "get" and
+        "no action" calls are always considered single page. If the handler was created in batch mode, single page
+        calls are packed into HTTP batch requests.
+        @param fields_profile: the field profile of the calls (see list_action)
+        @return: None
+        """
+        self.list_actions_by_values(actions=[dict(function=function, params=params, inner_object=inner_object,
+                                                  dynamic_key_param=dynamic_key_param, item_as_data=item_as_data,
+                                                  base_functions=base_functions, is_get_action=is_get_action,
+                                                  is_no_action=is_no_action, is_create_action=is_create_action,
+                                                  results_only=results_only, filename_additions=filename_additions,
+                                                  single_page=single_page, fields_profile=fields_profile)],
+                                    list_items=list_items, main_key=main_key, delegate_users=delegate_users)
+
+    def list_actions_by_values(self, actions: list, list_items: list, main_key: str = None,
+                               delegate_users: bool = False) -> None:
+        """
+        This function executes several Google API calls for each item of a given list. All the calls of an item are
+        executed one after the other using the same service, so delegated users reuse a single authorized connection.
+
+        @param actions: a list of dictionaries, each holding the params of list_action_by_values for a single call
+        (function, params, inner_object, dynamic_key_param, item_as_data, base_functions, is_get_action,
+        is_no_action, is_create_action, results_only, filename_additions, single_page, fields_profile)
+        @param list_items: the items to iterate on and execute the API calls for each one of them
+        @param main_key: see list_action_by_values
+        @param delegate_users: see list_action_by_values
         @return: None
         """
-        self.file_handler.append_log(f'Iterating multiple items for function {function}')
+        for action in actions:
+            self.file_handler.append_log(f'Iterating multiple items for function {action["function"]}')
+        if self.batch:  # batch requests pack the items of a single function
+            for action in actions:
+                if ModuleHandler._is_single_page(action):
+                    self._batch_action_by_values(action=action, list_items=list_items, main_key=main_key,
+                                                 delegate_users=delegate_users)
+            actions = [action for action in actions if not ModuleHandler._is_single_page(action)]
+            if not actions:
+                return
+
+        if self.workers == 1 or len(list_items) < 2:
+            for item in list_items:
+                self._list_actions_by_value(item=item, actions=actions, main_key=main_key,
+                                            delegate_users=delegate_users)
+            return
+
+        executor = self._get_executor()
+        futures = {item: executor.submit(self._list_actions_by_value, item=item, actions=actions, main_key=main_key,
+                                         delegate_users=delegate_users, in_worker=True)
+                   for item in list_items}
+        for item, future in futures.items():
+            try:
+                future.result()
+            except Exception as ex:
+                self.add_error_to_log(function=', '.join(action['function'] for action in actions),
+                                      requested_action='', page=0, latest_err=str(ex),
+                                      additions=f'Failed to collect item {item}')
+
+    def sharded_list_action(self, function: str, params: dict, shards: list, inner_object: str, id_key: str = 'id',
+                            add_to_log: bool = True, documented_item: str = None, base_functions: list = None,
+                            fields_profile: str = None, page_callback=None) -> bool:
+        """
+        Lists a collection in several shards (e.g. the users whose email starts with every letter) that the handler's
+        workers list concurrently, and merges the shards into a single NDJSON output. Items that are listed by more
+        than one shard are written once.
+
+        @param function: the main function of the listing (see list_action)
+        @param params: the params of the whole listing, which document the output
+        @param shards: the params of every shard, each a complete params dictionary of the listing
+        @param inner_object: the inner object of the results that contains the items
+        @param id_key: the key of the items that identifies them across the shards
+        @param add_to_log: whether to write the merged items to the output
+        @param documented_item: see list_action
+        @param base_functions: see list_action
+        @param fields_profile: see list_action
+        @param page_callback: a function that is called with the new (deduplicated) items of every page, and None
+        @return: whether all the shards were listed completely
+        """
+        checkpoint_key = CheckpointStore.get_key(module=self.module, function=function, params=params,
+                                                 item=documented_item) if add_to_log else None
+        if add_to_log and self.file_handler.checkpoints.is_completed(checkpoint_key):
+            self.file_handler.append_log(f'Skipping {self.module}=>{function}, params: {params}. '
+                                         f'Already collected by a previous run')
+            return False
+        self.file_handler.append_log(f'Listing {self.module}=>{function} in {len(shards)} shards, params: {params}')
+        lock = threading.Lock()
+        seen_ids = set()
+        stats = {'items': 0, 'duplicates': 0}
 
-        for item in list_items:
-            if item_as_data and dynamic_key_param is not None:
-                params[dynamic_key_param] = item
-            service = None  # None service which is later sent to list_action method,
-            # gets the service from self.service instead of overriding it
+        def merge_page(items: list, next_page_token: str) -> None:
+            with lock:
+                new_items = []
+                for list_item in items or []:
+                    item_id = list_item.get(id_key)
+                    if item_id is not None and item_id in seen_ids:
+                        stats['duplicates'] += 1
+                        continue
+                    seen_ids.add(item_id)
+                    new_items.append(list_item)
+                if not new_items:
+                    return
+                stats['items'] += len(new_items)
+                if page_callback is not None:
+                    page_callback(new_items, None)
+                if add_to_log:
+                    self.add_to_log(function=function, results=new_items, documented_item=documented_item,
+                                    writing_mode='a')
+
+        def list_shard(shard_params: dict, in_worker: bool = False) -> bool:
+            listing = {'completed': False}
+
+            def shard_page(items: list, next_page_token: str) -> None:
+                merge_page(items, next_page_token)
+                listing['completed'] = next_page_token is None
+
+            self.list_action(function=function, params=shard_params, inner_object=inner_object, add_to_log=False,
+                             service=self._get_worker_service() if in_worker else None, base_functions=base_functions,
+                             fields_profile=fields_profile, page_callback=shard_page)
+            return listing['completed']
+
+        if self.workers == 1 or len(shards) < 2:
+            completed = [list_shard(shard_params) for shard_params in shards]
+        else:
+            executor = self._get_executor()
+            futures = [executor.submit(list_shard, shard_params=shard_params, in_worker=True) for shard_params in shards]
+            completed = []
+            for shard_params, future in zip(shards, futures):
+                try:
+                    completed.append(future.result())
+                except Exception as ex:
+                    self.add_error_to_log(function=function, requested_action='.list', page=0, latest_err=str(ex),
+                                          additions=f'Failed to list the shard {shard_params}')
+                    completed.append(False)
+        failed_shards = len(completed) - sum(completed)
+        self.print_stdout(f'{stats["items"]} results were found')
+        self.file_handler.append_log(f'Listed {self.module}=>{function} in {len(shards)} shards: {stats["items"]} '
+                                     f'items, {stats["duplicates"]} duplicates, {failed_shards} failed shards')
+        if add_to_log:
+            summary = self._wrap_results(function=function, params=params, results=None, results_only=False)
+            del summary['data']
+            summary['shards'] = len(shards)
+            summary['duplicates'] = stats['duplicates']
+            summary['failed_shards'] = failed_shards
+            self.end_stream_log(function=function, summary=summary, documented_item=documented_item)
+            if failed_shards == 0:
+                self._save_checkpoint(key=checkpoint_key, function=function, params=params,
+                                      documented_item=documented_item, completed=True)
+        return failed_shards == 0
+
+    @staticmethod
+    def _is_single_page(action: dict) -> bool:
+        return (action.get('single_page') or action.get('is_get_action') or action.get('is_no_action')) and \
+            not action.get('is_create_action')
+
+    def _list_actions_by_value(self, item, actions: list, main_key: str = None, delegate_users: bool = False,
+                               in_worker: bool = False) -> None:
+        """
+        Executes list_action for a single item of list_actions_by_values (see list_actions_by_values for the params).
+
+        @param in_worker: whether the function runs in a worker thread of the handler, and therefore requires a
+        service object of its own.
+        """
+        # skip the actions that were already completed for the item by a resumed run
+        actions = [action for action in actions if not self._is_item_completed(item=item, action=action)]
+        if not actions:
+            self.file_handler.append_log(f'Skipping item {item}: already collected by a previous run')
+            return
+        service = None  # None service which is later sent to list_action method,
+        # gets the service from self.service instead of overriding it
+        if delegate_users:  # works only if item is the user
+            service = self.service_pool.acquire(item)
+        elif in_worker:
+            service = self._get_worker_service()
+        try:
+            for action in actions:
+                self._list_action_by_value(item=item, service=service, action=action, main_key=main_key,
+                                           delegate_users=delegate_users)
+        finally:
+            if delegate_users:
+                self.service_pool.release(item, service)
+
+    def _list_action_by_value(self, item, service: Resource, action: dict, main_key: str = None,
+                              delegate_users: bool = False) -> None:
+        function = action['function']
+        params, documented_item = ModuleHandler._get_item_call(item=item, action=action)
+        metadata_additions = [(main_key, item)] if main_key is not None else None
 
-            if delegate_users:  # works only if item is the user
-                if item in self.delegates:
-                    delegated_credentials = self.delegates[item]
+        self.print_stdout(f'Collecting data for [{item}] using the function {function}')
+
+        self.file_handler.append_log(f'Current Item: {item}')
+        self.list_action(function=function, params=params, inner_object=action.get('inner_object'),
+                         metadata_additions=metadata_additions,
+                         service=service, base_functions=action.get('base_functions'),
+                         is_get_action=action.get('is_get_action', False),
+                         is_no_action=action.get('is_no_action', False),
+                         is_create_action=action.get('is_create_action', False),
+                         results_only=action.get('results_only', False), documented_item=documented_item,
+                         subject=item if delegate_users else None, fields_profile=action.get('fields_profile'),
+                         item=(main_key or 'item', item))
+
+    @staticmethod
+    def _execute_request(request, page_stats: dict) -> dict:
+        """
+        Executes an API request (googleapiclient HttpRequest), recording the size of the response body in page_stats.
+        """
+        postproc = request.postproc
+
+        def measured_postproc(resp, content):
+            page_stats['bytes'] = len(content) if content else 0
+            return postproc(resp, content)
+
+        request.postproc = measured_postproc
+        return request.execute()
+
+    def _batch_action_by_values(self, action: dict, list_items: list, main_key: str = None,
+                                delegate_users: bool = False) -> None:
+        """
+        Executes a single page action of list_actions_by_values using HTTP batch requests: the items are packed into
+        batches of up to BATCH_SIZES sub-requests, and the responses are written per item as list_action would have
+        written them. Batches are executed concurrently by the handler's workers.
+        """
+        function = action['function']
+        list_items = [item for item in list_items if not self._is_item_completed(item=item, action=action)]
+        batch_size = ModuleHandler.BATCH_SIZES.get(self.SERVICE_NAME, ModuleHandler.DEFAULT_BATCH_SIZE)
+        chunks = [list_items[i:i + batch_size] for i in range(0, len(list_items), batch_size)]
+        self.file_handler.append_log(f'Executing {self.module}=>{function} for {len(list_items)} items '
+                                     f'in {len(chunks)} batch requests')
+        if self.workers == 1 or len(chunks) < 2:
+            for chunk in chunks:
+                self._execute_batch(action=action, items=chunk, main_key=main_key, delegate_users=delegate_users)
+            return
+
+        executor = self._get_executor()
+        futures = [executor.submit(self._execute_batch, action=action, items=chunk, main_key=main_key,
+                                   delegate_users=delegate_users, in_worker=True) for chunk in chunks]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as ex:
+                self.add_error_to_log(function=function, requested_action='', page=0, latest_err=str(ex),
+                                      additions='Failed to execute batch request')
+
+    def _execute_batch(self, action: dict, items: list, main_key: str = None, delegate_users: bool = False,
+                       in_worker: bool = False) -> None:
+        """
+        Executes a single batch request for the given items. Only the sub-requests that failed with a retryable error
+        are retried, in a new batch request. Items whose response turns out to have more pages are collected again
+        using list_action.
+        """
+        function, params = action['function'], action['params']
+        inner_object = action.get('inner_object')
+        is_get_action, is_no_action = action.get('is_get_action', False), action.get('is_no_action', False)
+        requested_action = '.get' if is_get_action else '' if is_no_action else '.list'
+        pending = list(items)
+        retry_count = 0
+        while pending:
+            service = self._get_worker_service() if in_worker else self.service
+            responses = {}
+            items_calls = []  # (params, documented item) of each item
+            delegated_services = {}
+            batch = None
+
+            def callback(request_id, response, exception):
+                responses[request_id] = (response, exception)
+
+            for index, item in enumerate(pending):
+                item_params, documented_item = ModuleHandler._get_item_call(item=item, action=action)
+                items_calls.append((item_params, documented_item))
+                item_service = service
+                if delegate_users:
+                    item_service = delegated_services.get(item) or self.service_pool.acquire(item)
+                    delegated_services[item] = item_service
+                if batch is None:
+                    batch = item_service.new_batch_http_request(callback=callback)
+                request = item_service
+                for f in (action.get('base_functions') or []):
+                    request = getattr(request, f)()
+                request = getattr(request, function)
+                request_params = self.get_projected_params(function=function, params=item_params,
+                                                           fields_profile=action.get('fields_profile'))
+                if is_get_action:
+                    request = request().get(**request_params)
+                elif is_no_action:
+                    request = request(**request_params)
+                else:
+                    request = request().list(**request_params)
+                self.get_rate_limit_bucket(subject=item if delegate_users else None).acquire()
+                batch.add(request, request_id=str(index))
+
+            batch_error = None
+            batch_start_time = time.monotonic()
+            try:
+                batch.execute()
+            except Exception as ex:  # the whole batch failed, all of its items are retried
+                batch_error = ex
+            self.file_handler.metrics.record_page(module=self.module, function=function,
+                                                  item=f'batch of {len(pending)} items', page=retry_count + 1,
+                                                  latency=time.monotonic() - batch_start_time,
+                                                  items=sum(1 for _, exception in responses.values()
+                                                            if exception is None))
+            for item, item_service in delegated_services.items():
+                self.service_pool.release(item, item_service)
+
+            failed = []
+            for index, item in enumerate(pending):
+                response, exception = responses.get(str(index), (None, batch_error))
+                item_params, documented_item = items_calls[index]
+                metadata_additions = [(main_key, item)] if main_key is not None else None
+                if exception is None and response is not None and 'nextPageToken' in response:
+                    # not a single page response after all => collect all of its pages
+                    self._list_actions_by_value(item=item, actions=[action], main_key=main_key,
+                                                delegate_users=delegate_users, in_worker=in_worker)
+                elif exception is None:
+                    self._write_item_results(function=function, params=item_params, response=response,
+                                             inner_object=inner_object, metadata_additions=metadata_additions,
+                                             results_only=action.get('results_only', False),
+                                             documented_item=documented_item, item=(main_key or 'item', item))
                 else:
-                    delegated_credentials = self.creds.with_subject(item)
-                    self.delegates[item] = delegated_credentials
+                    error_class = ModuleHandler.RETRY_POLICY.classify(exception)
+                    if error_class == RATE_LIMITED:
+                        self.get_rate_limit_bucket(subject=item if delegate_users else None).decrease()
+                    if error_class == NOT_FOUND:
+                        self.file_handler.append_log(f'Requested entity was not found: {item}')
+                    elif not RetryPolicy.is_retryable(error_class):
+                        self.add_error_to_log(function=function, requested_action=requested_action, page=1,
+                                              latest_err=str(exception),
+                                              additions=f'Item {item}: error is not retryable ({error_class}).')
+                    elif retry_count == ModuleHandler.RETRY_POLICY.max_retry:
+                        self.add_error_to_log(function=function, requested_action=requested_action, page=1,
+                                              latest_err=str(exception),
+                                              additions=f'Item {item}: max retry count reached '
+                                                        f'({ModuleHandler.RETRY_POLICY.max_retry}).')
+                    else:
+                        failed.append(item)
+            if failed:
+                retry_count += 1
+                sleep_time = ModuleHandler.RETRY_POLICY.get_delay(retry_count=retry_count)
+                logging.info(f'{len(failed)} sub-requests of {function}{requested_action} batch failed. '
+                             f'Retrying in {sleep_time:.1f} seconds...')
+                sleep(sleep_time)
+            pending = failed
+
+    def _write_item_results(self, function: str, params: dict, response: dict, inner_object: str = None,
+                            metadata_additions: list = None, results_only: bool = True,
+                            documented_item: str = None, item: tuple = None) -> None:
+        """
+        Writes the response of a single page API call for a single item, the same way list_action writes it.
+        """
+        final_result = response.get(inner_object, {}) if inner_object else response
+        if len(final_result) == 0:
+            self.file_handler.append_log(f'No results for {function} with the following params {str(params)}, '
+                                         f'item {documented_item}')
+        else:
+            self._write_item_page(function=function, params=params, final_result=final_result,
+                                  metadata_additions=metadata_additions, results_only=results_only,
+                                  documented_item=documented_item, item=item)
+        self._save_checkpoint(key=CheckpointStore.get_key(module=self.module, function=function, params=params,
+                                                          item=documented_item),
+                              function=function, params=params, documented_item=documented_item, pages=1,
+                              completed=True)
+
+    def _write_item_page(self, function: str, params: dict, final_result, metadata_additions: list = None,
+                         results_only: bool = True, documented_item: str = None, item: tuple = None) -> None:
+        final_results = final_result if type(final_result) == list else [final_result]
+        if self.file_handler.stream or self.file_handler.consolidate:
+            self.add_to_log(function=function, results=final_results, documented_item=documented_item,
+                            writing_mode='a', item=item)
+            summary = self._wrap_results(function=function, params=params, results=None,
+                                         metadata_additions=metadata_additions, results_only=False)
+            del summary['data']
+            summary['pages'] = 1
+            self.end_stream_log(function=function, summary=summary, documented_item=documented_item, item=item)
+        else:
+            obj = self._wrap_results(function=function, params=params, results=final_results,
+                                     metadata_additions=metadata_additions, results_only=results_only)
+            self.add_to_log(function=function, results=obj, documented_item=documented_item)
+
+    @staticmethod
+    def _get_item_call(item, action: dict) -> tuple:
+        """
+        @return: the params and the documented item of the API call of an action (see list_actions_by_values) for
+        a single item
+        """
+        params = action['params'].copy()
+        if action.get('item_as_data') and action.get('dynamic_key_param') is not None:
+            params[action['dynamic_key_param']] = item
+        filename_additions = action.get('filename_additions')
+        return params, f'{item}_{filename_additions}' if filename_additions else item
+
+    def _is_item_completed(self, item, action: dict) -> bool:
+        params, documented_item = ModuleHandler._get_item_call(item=item, action=action)
+        return self.file_handler.checkpoints.is_completed(
+            CheckpointStore.get_key(module=self.module, function=action['function'], params=params,
+                                    item=documented_item))
+
+    def _save_checkpoint(self, key: str, function: str, params: dict, documented_item: str = None,
+                         next_page_token: str = None, pages: int = 0, completed: bool = False) -> None:
+        if key is None:  # the results are not written by list_action
+            return
+        self.file_handler.checkpoints.save(key=key, function=f'{self.module}=>{function}',
+                                           params_hash=CheckpointStore.get_params_hash(params),
+                                           item=documented_item, next_page_token=next_page_token, pages=pages,
+                                           completed=completed)
+
+    def _get_delegated_credentials(self, user: str) -> Credentials:
+        with self._lock:
+            if user not in self.delegates:
+                self.delegates[user] = self.creds.with_subject(user)
+            return self.delegates[user]
+
+    def build_service(self, creds: Credentials = None) -> Resource:
+        """
+        Builds a new service object of the handler's API (SERVICE_NAME and SERVICE_VERSION).
 
-                if self.module == 'gmail':  # Currently the only module requires using the delegations
-                    service = build('gmail', 'v1', credentials=delegated_credentials, cache=MemoryCache())
+        @param creds: the credentials of the service, by default the handler's credentials are used
+        @return: the API service object
+        """
+        return build_service(self.SERVICE_NAME, self.SERVICE_VERSION,
+                             credentials=creds if creds is not None else self.creds)
 
-            metadata_additions = [(main_key, item)] if main_key is not None else None
-            documented_item = f'{item}_{filename_additions}' if filename_additions else item
+    def _build_delegated_service(self, user: str) -> Resource:
+        return self.build_service(self._get_delegated_credentials(user))
 
-            self.print_stdout(f'Collecting data for [{item}] using the function {function}')
+    def get_projected_params(self, function: str, params: dict, fields_profile: str = None) -> dict:
+        """
+        Adds the partial response params of a field profile (see FIELD_PROFILES) to the params of an API call. Params
+        that were explicitly given are never overridden.
 
-            self.file_handler.append_log(f'Current Item: {item}')
-            self.list_action(function=function, params=params, inner_object=inner_object,
-                             metadata_additions=metadata_additions,
-                             service=service, base_functions=base_functions,
-                             is_get_action=is_get_action, is_no_action=is_no_action,
-                             is_create_action=is_create_action,
-                             results_only=results_only, documented_item=documented_item)
+        @param function: the API function
+        @param params: the params of the API call
+        @param fields_profile: the field profile. By default, the handler's field profile.
+        @return: the params to send to the API
+        """
+        fields_profile = fields_profile if fields_profile is not None else self.fields_profile
+        profile_params = self.FIELD_PROFILES.get(function, {}).get(fields_profile)
+        if not profile_params:
+            return params
+        return dict(profile_params, **params)
 
-            if service:
-                service.close()
+    def get_rate_limit_bucket(self, subject: str = None):
+        """
+        Gets the shared rate limiter bucket for the handler's API.
+
+        @param subject: the delegated user that the API calls are executed as. By default, the subject of the handler's
+        credentials.
+        @return: the TokenBucket object from rate_limiter.py
+        """
+        subject = subject if subject is not None else getattr(self.creds, '_subject', None)
+        return ModuleHandler.RATE_LIMITER.get_bucket(api=f'{self.SERVICE_NAME}.{self.SERVICE_VERSION}',
+                                                     subject=subject,
+                                                     project=getattr(self.creds, 'project_id', None))
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix=f'{self.module}_worker')
+            return self._executor
+
+    def _get_worker_service(self) -> Resource:
+        service = getattr(self._worker_local, 'service', None)
+        if service is None:
+            service = self.build_service()
+            self._worker_local.service = service
+            with self._lock:
+                self._worker_services.append(service)
+        return service
 
     def test_list_action(self, function: str, params: dict,
                          service: object = None,
@@ -366,25 +952,87 @@ class ModuleHandler:
             response['error_msg'] = str(ex)
         return response
 
-    def add_to_log(self, function: str, results: dict, documented_item: str = None):
+    def add_to_log(self, function: str, results: dict, documented_item: str = None, writing_mode: str = 'w',
+                   item: tuple = None):
         """
         This function adds the results of an API call to the log.
 
         @param function: the name of the function the results are for - used for output file name only
         @param results: the API response results
         @param documented_item: the name of the item that the function was executed for - used for output file name only
+        @param writing_mode: 'w' to write the results to a new output file, 'a' to append them to the output stream
+        @param item: the (key, value) of the item the results are for (see list_action). In consolidated mode, the
+        appended results of items are written to the single output file of the function.
         @return: None
         """
         function_item = f'{function}_{documented_item}' if documented_item else function
         function_name = f'{self.module} {function_item}'
-        outfile = f'{self.module}_{function_item}.json'
+        outfile = self._get_outfile(function=function, documented_item=documented_item)
         try:
+            if writing_mode == 'a' and item is not None and self.file_handler.consolidate:
+                self.file_handler.append_item_results(results=results, outfile=self._get_outfile(function=function),
+                                                      key=item[0], item=documented_item)
+                return
             self.file_handler.results_handler(results=results, outfile=outfile,
-                                              function_name=function_name)
+                                              function_name=function_name, writing_mode=writing_mode)
         except Exception as e:
             logging.info('Can\'t write to log:', str(e))
             logging.info(f"results for {function_item}=>", results)
 
+    def get_output_files(self, function: str, documented_item: str = None) -> list:
+        """
+        @param function: the name of the function the results are for
+        @param documented_item: the name of the item that the function was executed for
+        @return: the paths of the output files that add_to_log wrote for the function and item
+        """
+        return self.file_handler.get_output_files(self._get_outfile(function=function, documented_item=documented_item))
+
+    def _get_outfile(self, function: str, documented_item: str = None) -> str:
+        function_item = f'{function}_{documented_item}' if documented_item else function
+        return f'{self.module}_{function_item}.json'
+
+    def end_stream_log(self, function: str, summary: dict, documented_item: str = None, item: tuple = None):
+        """
+        This function completes an output stream that was written by add_to_log in append mode.
+
+        @param function: the name of the function the results are for - used for output file name only
+        @param summary: the metadata to write as the footer line of the stream
+        @param documented_item: the name of the item that the function was executed for - used for output file name only
+        @param item: the (key, value) of the item the results are for (see add_to_log). In consolidated mode, the
+        summary is kept in the index of the function's output instead.
+        @return: None
+        """
+        function_item = f'{function}_{documented_item}' if documented_item else function
+        function_name = f'{self.module} {function_item}'
+        outfile = self._get_outfile(function=function, documented_item=documented_item)
+        try:
+            if item is not None and self.file_handler.consolidate:
+                self.file_handler.close_item(outfile=self._get_outfile(function=function), item=documented_item,
+                                             function_name=function_name, summary=summary)
+                return
+            self.file_handler.close_stream(outfile=outfile, function_name=function_name, summary=summary)
+        except Exception as e:
+            logging.info(f'Can\'t write to log: {str(e)}')
+
+    def _wrap_results(self, function: str, params: dict, results, metadata_additions: list = None,
+                      results_only: bool = True):
+        """
+        Wraps the results of an API call with the call metadata (module, function and params), unless results_only
+        is set.
+
+        @return: the results, or a dictionary of the metadata with the results under the "data" key
+        """
+        if results_only:
+            return results
+        display_params = params.copy()
+        if metadata_additions is not None:
+            for key, value in metadata_additions:
+                display_params[key] = value
+        return {'module': self.module,
+                'function': function,
+                'params': display_params,
+                'data': results}
+
     def add_error_to_log(self, function: str, requested_action: str,
                          page: int, latest_err: str, additions: str = '') -> None:
         """
@@ -402,7 +1050,8 @@ class ModuleHandler:
             error_msg += '\n' + additions
         logging.info(error_msg)
         try:
-            self.file_handler.append_log(error_msg)
+            self.file_handler.append_log(error_msg, level='error', page=page, error=latest_err,
+                                         function=f'{self.module}=>{function}{requested_action}')
         except Exception as e:
             logging.info('Can\'t write to log:', str(e))
             logging.info(error_msg)
@@ -421,5 +1070,13 @@ class ModuleHandler:
         closes the service.
         @return: None
         """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for service in self._worker_services:
+            service.close()
+        self._worker_services.clear()
+        self._worker_local = threading.local()
+        self.service_pool.close()
         if self.service:
             self.service.close()
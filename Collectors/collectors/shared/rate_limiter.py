@@ -0,0 +1,112 @@
+import threading
+import time
+
+# Known API quotas, keyed by "<service name>.<service version>" (the discovery document naming).
+# rate - the requests per second that the quota allows (the ceiling of the limiter)
+# burst - the number of requests that can be executed at once after an idle period
+# scope - the entity the quota is enforced for: 'subject' (delegated user), 'project' (quota project of the
+# credentials) or None (a single bucket for the API)
+API_QUOTAS = {
+    # Admin SDK Directory API: 2,400 queries per minute per user
+    'admin.directory_v1': {'rate': 40.0, 'burst': 10, 'scope': 'subject'},
+    # Admin SDK Reports API: 2,400 queries per minute per user
+    'admin.reports_v1': {'rate': 40.0, 'burst': 10, 'scope': 'subject'},
+    # Gmail API: 250 quota units per user per second, most read methods cost 5 units
+    'gmail.v1': {'rate': 50.0, 'burst': 25, 'scope': 'subject'},
+    # Cloud Logging API: entries.list is limited to 60 requests per minute per project
+    'logging.v2': {'rate': 1.0, 'burst': 1, 'scope': 'project'},
+    # Cloud Asset API: ListAssets is limited to 100 requests per minute per project
+    'cloudasset.v1': {'rate': 1.6, 'burst': 2, 'scope': 'project'},
+}
+DEFAULT_QUOTA = {'rate': 10.0, 'burst': 5, 'scope': None}
+
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded', 'RESOURCE_EXHAUSTED']
+
+
+class TokenBucket:
+    """
+    Class TokenBucket is a thread-safe token bucket whose rate is tuned using AIMD (additive increase,
+    multiplicative decrease): the rate is cut on every throttling response, and slowly increased back towards the
+    ceiling while the requests succeed.
+    """
+    MIN_RATE_FACTOR = 0.05  # the lowest rate, as a fraction of the ceiling
+    DECREASE_FACTOR = 0.5
+    INCREASE_FACTOR = 0.05  # the rate added per second of successful requests, as a fraction of the ceiling
+
+    def __init__(self, rate: float, burst: int):
+        """
+        @param rate: the ceiling of the bucket in requests per second
+        @param burst: the capacity of the bucket
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._last_increase = self._updated
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Takes a token from the bucket, sleeping until one is available.
+        @return: the time (in seconds) that was spent waiting for the token
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= 1  # the token is reserved, concurrent callers wait for the following tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def decrease(self):
+        with self._lock:
+            self.rate = max(self.max_rate * TokenBucket.MIN_RATE_FACTOR, self.rate * TokenBucket.DECREASE_FACTOR)
+            self.tokens = min(self.tokens, 0.0)
+
+    def increase(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.rate < self.max_rate and now - self._last_increase >= 1:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * TokenBucket.INCREASE_FACTOR)
+                self._last_increase = now
+
+
+class RateLimiter:
+    """
+    Class RateLimiter holds a token bucket per API and quota scope (delegated user or project), configured from a table
+    of known quotas. A single RateLimiter is shared by all the ModuleHandler objects, so concurrent workers of all the
+    modules run at the quota ceiling without storming the API with retries.
+    """
+
+    def __init__(self, quotas: dict = None):
+        """
+        @param quotas: the quotas table (see API_QUOTAS)
+        """
+        self.quotas = quotas if quotas is not None else API_QUOTAS
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get_bucket(self, api: str, subject: str = None, project: str = None) -> TokenBucket:
+        """
+        Gets the token bucket matching the API and the quota scope of the API.
+        @param api: the API name, as "<service name>.<service version>"
+        @param subject: the delegated user the API calls are executed as
+        @param project: the quota project of the API calls
+        @return: the token bucket
+        """
+        quota = self.quotas.get(api, DEFAULT_QUOTA)
+        if quota['scope'] == 'subject':
+            key = (api, subject)
+        elif quota['scope'] == 'project':
+            key = (api, project)
+        else:
+            key = (api, None)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate=quota['rate'], burst=quota['burst'])
+                self._buckets[key] = bucket
+        return bucket
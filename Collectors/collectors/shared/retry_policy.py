@@ -0,0 +1,121 @@
+import json
+import random
+import socket
+import ssl
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httplib2
+from google.auth.exceptions import TransportError
+from googleapiclient.errors import HttpError
+
+from .rate_limiter import RATE_LIMIT_REASONS
+
+# Error classes returned by RetryPolicy.classify
+RETRYABLE = 'retryable'  # transient errors (HTTP 5xx, transport errors)
+RATE_LIMITED = 'rate_limited'  # HTTP 429 and 403 quota errors
+NOT_FOUND = 'not_found'  # HTTP 404, the requested entity does not exist
+PERMISSION_DENIED = 'permission_denied'  # HTTP 401/403 that are not related to quota
+FATAL = 'fatal'  # any other error (invalid request, programming errors, etc.)
+
+# The exceptions of the transport layer (timeouts, connection resets, etc.), which are retried
+TRANSPORT_ERRORS = (socket.timeout, TimeoutError, ConnectionError, ssl.SSLError, httplib2.HttpLib2Error,
+                    TransportError)
+
+# 403 reasons that will not be resolved by waiting (daily quotas are reset only once a day)
+TERMINAL_QUOTA_REASONS = ['dailyLimitExceeded']
+
+
+class RetryPolicy:
+    """
+    Class RetryPolicy classifies the errors of Google API calls and computes the time to wait before retrying them:
+    exponential backoff with full jitter, or the time requested by the API in the Retry-After header.
+    """
+
+    def __init__(self, max_retry: int = 6, base_delay: float = 1.0, max_delay: float = 64.0):
+        """
+        @param max_retry: the maximal number of retries for a single API call
+        @param base_delay: the delay (in seconds) of the first retry, doubled on every retry
+        @param max_delay: the maximal delay (in seconds) between two retries
+        """
+        self.max_retry = max_retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def classify(ex: Exception) -> str:
+        """
+        Classifies an exception that was raised by an API call.
+        @param ex: the exception
+        @return: one of RETRYABLE, RATE_LIMITED, NOT_FOUND, PERMISSION_DENIED, FATAL
+        """
+        if not isinstance(ex, HttpError):
+            if 'Requested entity was not found.' in str(ex):
+                return NOT_FOUND
+            if isinstance(ex, TRANSPORT_ERRORS):
+                return RETRYABLE
+            return FATAL  # e.g. a request that was built with invalid params, reported without retries
+        status = ex.resp.status
+        reasons = RetryPolicy.get_reasons(ex)
+        if status == 429:
+            return RATE_LIMITED
+        if status == 403 and any(reason in TERMINAL_QUOTA_REASONS for reason in reasons):
+            return FATAL
+        if status == 403 and any(reason in RATE_LIMIT_REASONS for reason in reasons):
+            return RATE_LIMITED
+        if status == 404:
+            return NOT_FOUND
+        if status in (401, 403):
+            return PERMISSION_DENIED
+        if status >= 500 or status == 408:
+            return RETRYABLE
+        return FATAL
+
+    @staticmethod
+    def is_retryable(error_class: str) -> bool:
+        return error_class in (RETRYABLE, RATE_LIMITED)
+
+    @staticmethod
+    def get_reasons(ex: HttpError) -> list:
+        """
+        @return: the error reasons of an API error response (e.g. "rateLimitExceeded", "forbidden")
+        """
+        try:
+            content = ex.content.decode('utf-8') if isinstance(ex.content, bytes) else str(ex.content)
+            error = json.loads(content).get('error', {})
+        except (ValueError, AttributeError):
+            return []
+        if not isinstance(error, dict):
+            return []
+        return [e.get('reason') for e in error.get('errors', [])] + [error.get('status')]
+
+    def get_delay(self, retry_count: int, ex: Exception = None) -> float:
+        """
+        Computes the time to wait before the next retry.
+        @param retry_count: the number of the upcoming retry (starting from 1)
+        @param ex: the exception of the failed attempt, used for its Retry-After header
+        @return: the delay in seconds
+        """
+        retry_after = RetryPolicy.get_retry_after(ex)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry_count - 1)))
+
+    @staticmethod
+    def get_retry_after(ex: Exception):
+        """
+        @return: the delay in seconds that was requested by the Retry-After header of the response, or None
+        """
+        if not isinstance(ex, HttpError) or ex.resp is None:
+            return None
+        value = ex.resp.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:  # HTTP-date format
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from googleapiclient import version as googleapiclient_version
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document, build_http, DISCOVERY_URI, V2_DISCOVERY_URI, Resource
+
+from .shared_utils import DEFAULT_CACHE_FOLDER
+
+# Discovery documents that are not bundled with googleapiclient are kept on disk between runs. The folder is versioned
+# by the googleapiclient version, so upgrading the library never reuses documents that were fetched by an older one
+DISCOVERY_CACHE_FOLDER = os.path.join(DEFAULT_CACHE_FOLDER, 'discovery', googleapiclient_version.__version__)
+DISCOVERY_CACHE_MAX_AGE = 7 * 24 * 60 * 60  # in seconds
+
+# A function that returns the HTTP object of new services, instead of authorizing them with their credentials. Used to
+# run the collectors offline against a stand-in of the Google APIs (see benchmarks/fake_google_api.py)
+HTTP_FACTORY = None
+
+_DOCUMENTS = {}  # (service name, version) => parsed discovery document, shared by all the services of the process
+_DOCUMENTS_LOCK = threading.Lock()
+
+
+def get_discovery_document(service_name: str, version: str) -> dict:
+    """
+    Gets the parsed discovery document of an API. The document is loaded and parsed only once per process, from the
+    documents bundled with googleapiclient, the on-disk discovery cache, or the discovery service (in this order).
+    @param service_name: the API name (e.g. "gmail")
+    @param version: the API version (e.g. "v1")
+    @return: the discovery document
+    """
+    key = (service_name, version)
+    with _DOCUMENTS_LOCK:
+        document = _DOCUMENTS.get(key)
+        if document is None:
+            content = discovery_cache.get_static_doc(service_name, version)
+            if content is None:
+                content = _read_cached_document(service_name, version)
+            if content is None:
+                content = _fetch_discovery_document(service_name, version)
+                _write_cached_document(service_name, version, content)
+            document = json.loads(content)
+            _DOCUMENTS[key] = document
+    return document
+
+
+def _get_cached_document_path(service_name: str, version: str) -> str:
+    return os.path.join(DISCOVERY_CACHE_FOLDER, f'{service_name}.{version}.json')
+
+
+def _read_cached_document(service_name: str, version: str):
+    path = _get_cached_document_path(service_name, version)
+    try:
+        if time.time() - os.path.getmtime(path) > DISCOVERY_CACHE_MAX_AGE:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_cached_document(service_name: str, version: str, content: str) -> None:
+    path = _get_cached_document_path(service_name, version)
+    try:
+        os.makedirs(DISCOVERY_CACHE_FOLDER, exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)  # concurrent runs never read a partially written document
+    except OSError as ex:
+        logging.info(f'Failed to cache the discovery document of {service_name} {version}: {ex}')
+
+
+def _fetch_discovery_document(service_name: str, version: str) -> str:
+    http = build_http()
+    for uri_template in (DISCOVERY_URI, V2_DISCOVERY_URI):
+        resp, content = http.request(uri_template.format(api=service_name, apiVersion=version))
+        if resp.status < 400:
+            return content.decode('utf-8') if isinstance(content, bytes) else content
+    raise Exception(f'cannot retrieve the discovery document of {service_name} {version}')
+
+
+def build_service(service_name: str, version: str, credentials) -> Resource:
+    """
+    Builds an API service object from the shared parsed discovery document.
+    @param service_name: the API name (e.g. "gmail")
+    @param version: the API version (e.g. "v1")
+    @param credentials: the credentials of the service
+    @return: the API service object
+    """
+    if HTTP_FACTORY is not None:
+        return build_from_document(get_discovery_document(service_name, version), http=HTTP_FACTORY())
+    return build_from_document(get_discovery_document(service_name, version), credentials=credentials)
+
+
+class ServicePool:
+    """
+    Class ServicePool keeps idle API service objects (each with its own authorized HTTP connection) keyed by
+    the delegated subject, so consecutive API calls for the same user reuse a single connection and a single token.
+    Service objects are not thread-safe, so a service is used by a single caller between acquire and release.
+    Least recently used services are closed once the pool is full.
+    """
+
+    def __init__(self, factory, max_size: int = 256):
+        """
+        @param factory: a function that gets a subject and returns a new service object for it
+        @param max_size: the maximal number of idle services kept in the pool
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self._idle = OrderedDict()  # subject => list of idle services, ordered from least to most recently used
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, subject: str) -> Resource:
+        """
+        @return: an idle service of the subject, or a new one if none is idle
+        """
+        with self._lock:
+            services = self._idle.get(subject)
+            if services:
+                service = services.pop()
+                self._size -= 1
+                if not services:
+                    del self._idle[subject]
+                return service
+        return self.factory(subject)
+
+    def release(self, subject: str, service: Resource) -> None:
+        """
+        Returns a service that was acquired from the pool, marking it as the most recently used.
+        """
+        evicted = []
+        with self._lock:
+            self._idle.setdefault(subject, []).append(service)
+            self._idle.move_to_end(subject)
+            self._size += 1
+            while self._size > self.max_size:
+                lru_subject, services = next(iter(self._idle.items()))
+                evicted.append(services.pop(0))
+                self._size -= 1
+                if not services:
+                    del self._idle[lru_subject]
+        for evicted_service in evicted:
+            evicted_service.close()
+
+    def close(self) -> None:
+        """
+        Closes all the idle services of the pool.
+        """
+        with self._lock:
+            services = [service for subject_services in self._idle.values() for service in subject_services]
+            self._idle.clear()
+            self._size = 0
+        for service in services:
+            service.close()
@@ -1,16 +1,27 @@
 import argparse
+import atexit
 import json
 import logging
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 
 from google.oauth2.service_account import Credentials
 
+from .checkpoint import CheckpointStore, CHECKPOINT_FILE
+from .event_index import EventIndex
+from .manifest import EvidenceManifest, MANIFEST_FILE
+from .metrics import MetricsRecorder, METRICS_FILE
+from .watermark import WatermarkStore, WATERMARK_FILE
+
 # defining default locations. All are based on the shared folder that this file resides in
 RUNNING_DIRECTORY = os.path.realpath(__file__).rpartition('\\')[0]
 DEFAULT_LOG_FILE = os.path.realpath(os.path.join(RUNNING_DIRECTORY, 'google_collectors.log'))
 DEFAULT_OUTPUT_FOLDER = os.path.realpath(os.path.join(RUNNING_DIRECTORY, 'output'))
 DEFAULT_CACHE_FOLDER = os.path.realpath(os.path.join(RUNNING_DIRECTORY, 'cache'))
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'  # RFC3339, as given in the command line
 
 
 class FileHandler:
@@ -18,19 +29,45 @@ class FileHandler:
     Class FileHandler handles writing API results to Mirage output folder and update the log file
     """
 
-    def __init__(self, folder: str, log_file: str, cmdline: str):
+    def __init__(self, folder: str, log_file: str, cmdline: str, stream: bool = False, resume: bool = False,
+                 consolidate: bool = False, rotate_size: int = None, index_db: str = None):
         """
         Creates a FileHandler object while initializing the output folder and the log file
         @param folder: the folder to place the API outputs (results) in
         @param log_file: the path to the log file to document the results
         @param cmdline: The command line that was given to Mirage, used only for documentation purposes in the log file
+        @param stream: whether API results should be appended page by page to NDJSON output files (bounded memory)
+        instead of being accumulated and dumped as a single JSON document
+        @param resume: whether to resume the interrupted collection of a previous run that used the same output folder
+        @param consolidate: whether the results of all the items of a function (see append_item_results) should be
+        appended to a single NDJSON output file, instead of a file per item
+        @param rotate_size: the maximal size (in bytes) of a consolidated output file. Once reached, a new part is started
+        @param index_db: the path of a SQLite database to index the collected events in during the collection (see
+        EventIndex), if any
         """
 
         self.folder = folder if folder is not None else DEFAULT_OUTPUT_FOLDER
         # self.tmp_file = DEFAULT_TMP_FILE
         self.log_file = log_file if log_file is not None else DEFAULT_LOG_FILE
+        self.stream = stream
+        self.consolidate = consolidate
+        self.rotate_size = rotate_size
+        self._streams = {}  # outfile => {'path': str, 'records': int, 'lock': the lock of the appends to the stream}
+        self._consolidated = {}  # outfile => ConsolidatedOutput
+        self._reserved_files = set()
+        self._output_files = {}  # outfile => the paths of the files that were written for it
+        self._lock = threading.RLock()  # FileHandler is shared by concurrent workers
         self._init_folder()
         self._init_log(cmdline)
+        self.checkpoints = CheckpointStore(path=os.path.join(self.folder, CHECKPOINT_FILE), resume=resume)
+        # the watermarks of incremental collections are kept between runs, regardless of the output folder
+        self.watermarks = WatermarkStore(path=os.path.join(DEFAULT_CACHE_FOLDER, WATERMARK_FILE))
+        self.metrics = MetricsRecorder(path=self._get_output_path(METRICS_FILE))
+        self.manifest = EvidenceManifest(folder=self.folder, cmdline=cmdline)
+        self.manifest_file = self._get_output_path(MANIFEST_FILE)
+        self.event_index = EventIndex(path=index_db) if index_db else None
+        self._closed = False
+        atexit.register(self._close_interrupted_run)
 
     def results_handler(self, results={}, outfile='output.json', function_name='', writing_mode='w'):
         """
@@ -38,41 +75,204 @@ class FileHandler:
         @param results: A dictionary that contains the API request's results
         @param outfile: The name of the output file to place the results in
         @param function_name: the name of the API function that matches the results; For log documentation only.
-        @param writing_mode: the writing mode supplied once opening the file (default is 'w')
+        @param writing_mode: the writing mode supplied once opening the file (default is 'w'). Use 'a' in order to
+        append the results incrementally (one JSON record per line) to the NDJSON stream matching the outfile. The
+        stream is created on the first append and is completed by calling close_stream.
         """
 
-        if not results:
-            with open(self.log_file, 'a') as f:
-                f.write(f'No results were found for function {function_name}\n')
+        if writing_mode == 'a':
+            self._append_to_stream(results=results, outfile=outfile)
+        elif not results:
+            self.append_log(f'No results were found for function {function_name}')
         else:
-            timestamp = FileHandler._get_time()
-            parts = outfile.rpartition('.')
-            outfile_with_time = f'{parts[0]}_{timestamp}.{parts[-1]}'
-            new_file = os.path.realpath(os.path.join(self.folder, outfile_with_time))
-            if os.path.exists(new_file):  # in case two file were created in the same millisecond
+            new_file = self._get_output_path(outfile)
+            serialize_start = time.perf_counter()
+            data = json.dumps(results)
+            write_start = time.perf_counter()
+            with open(new_file, writing_mode) as f:
+                f.write(data)
+            self.manifest.update(path=new_file, data=data, records=FileHandler._get_records(results))
+            if self.event_index is not None:
+                self.event_index.add_records(records=FileHandler._get_records(results), path=new_file)
+            self.metrics.record_write(outfile=new_file, serialize_time=write_start - serialize_start,
+                                      write_time=time.perf_counter() - write_start, written_bytes=len(data))
+            self._add_output_file(outfile=outfile, path=new_file)
+            self.append_log(f'{len(results)} results for function {function_name} can found here: {new_file}')
+
+    def close_stream(self, outfile: str, function_name: str = '', summary: dict = None):
+        """
+        Completes an NDJSON stream that was created by results_handler in append mode: writes a final footer line
+        that contains the summary of the stream and documents the output file in the log file
+        @param outfile: The name of the output file that was given to results_handler
+        @param function_name: the name of the API function that matches the results; For log documentation only.
+        @param summary: metadata to add to the footer line (module, function, params, etc.)
+        """
+        with self._lock:
+            stream = self._streams.pop(outfile, None)
+        if stream is None:
+            self.append_log(f'No results were found for function {function_name}')
+            return
+        with stream['lock']:  # the footer follows the last chunk of any appender
+            footer = dict(summary) if summary else {}
+            footer['records'] = stream['records']
+            footer['completed'] = FileHandler._get_time()
+            data = json.dumps({'summary': footer}) + '\n'
+            with open(stream['path'], 'a') as f:
+                f.write(data)
+            self.manifest.update(path=stream['path'], data=data)
+        self.append_log(f'{stream["records"]} results for function {function_name} can found here: {stream["path"]}')
+
+    def _append_to_stream(self, results, outfile: str):
+        with self._lock:
+            stream = self._streams.get(outfile)
+            if stream is None:
+                parts = outfile.rpartition('.')
+                stream = {'path': self._get_output_path(f'{parts[0]}.ndjson'), 'records': 0,
+                          'lock': threading.Lock()}
+                self._streams[outfile] = stream
+                self._add_output_file(outfile=outfile, path=stream['path'])
+        records = results if type(results) == list else [results]
+        serialize_start = time.perf_counter()
+        data = ''.join(json.dumps(record) + '\n' for record in records)
+        # the manifest hashes the chunks of the stream in order, so the chunks of concurrent appenders are written,
+        # hashed, indexed and counted one at a time
+        with stream['lock']:
+            write_start = time.perf_counter()
+            with open(stream['path'], 'a') as f:
+                f.write(data)
+            self.manifest.update(path=stream['path'], data=data, records=records)
+            self.metrics.record_write(outfile=stream['path'], serialize_time=write_start - serialize_start,
+                                      write_time=time.perf_counter() - write_start, written_bytes=len(data))
+            if self.event_index is not None:
+                self.event_index.add_records(records=records, path=stream['path'], first_record=stream['records'])
+            stream['records'] += len(records)
+
+    def get_output_files(self, outfile: str) -> list:
+        """
+        @param outfile: The name of the output file that was given to results_handler
+        @return: the paths of the files that were written for the outfile (partial dumps, streams, etc.)
+        """
+        with self._lock:
+            return list(self._output_files.get(outfile, []))
+
+    def _add_output_file(self, outfile: str, path: str) -> None:
+        with self._lock:
+            self._output_files.setdefault(outfile, []).append(path)
+
+    def _get_output_path(self, outfile: str) -> str:
+        timestamp = FileHandler._get_time()
+        parts = outfile.rpartition('.')
+        outfile_with_time = f'{parts[0]}_{timestamp}.{parts[-1]}'
+        new_file = os.path.realpath(os.path.join(self.folder, outfile_with_time))
+        with self._lock:  # reserve the file name, so concurrent workers never share an output file
+            while new_file in self._reserved_files or os.path.exists(new_file):  # in case two file were created in
+                # the same millisecond
                 _parts = new_file.rpartition('.')
                 new_file = _parts[0] + "_." + _parts[-1]
-            with open(new_file, writing_mode) as f:
-                json.dump(results, f)
-            with open(self.log_file, 'a') as f:
-                f.write(f'{len(results)} results for function {function_name} can found here: {new_file}\n')
+            self._reserved_files.add(new_file)
+        return new_file
 
     def _init_log(self, cmdline):
         try:
-            with open(self.log_file, 'a') as f:
-                f.write('-----------------------------------------------------------\n')
-                f.write(f"Time: {FileHandler._get_time()}\n")
-                f.write(f'Running command: {cmdline}\n')
+            self._log_writer = LogWriter(self.log_file)
         except:
             raise Exception(f'cannot init log file: {self.log_file}')
+        self.append_log('Running command', event='run_start', command=cmdline)
+
+    def append_log(self, data, level: str = 'info', **fields):
+        """
+        Appends a record to the log file. Records are JSON lines that are written by a background writer
+        @param data: the message of the record
+        @param level: the level of the record ("info" or "error")
+        @param fields: additional fields of the record (function, page, etc.)
+        """
+        record = {'time': datetime.utcnow().isoformat(timespec='milliseconds'), 'level': level, 'message': str(data)}
+        record.update(fields)
+        self._log_writer.write(record)
+
+    def append_item_results(self, results, outfile: str, key: str, item: str) -> None:
+        """
+        Appends the results of a single item to the consolidated NDJSON output of the outfile. Every line holds a single
+        record, keyed by the item: {key: item, "data": record}. The location of the item's lines is kept for the index
+        of the output (see close_item).
+        @param results: the results (a record or a list of records)
+        @param outfile: The name of the output file of the function (without the item)
+        @param key: the key of the item in the output lines (e.g. "user")
+        @param item: the item (e.g. the user's email address)
+        """
+        with self._lock:
+            output = self._consolidated.get(outfile)
+            if output is None:
+                output = ConsolidatedOutput(file_handler=self, outfile=outfile, rotate_size=self.rotate_size)
+                self._consolidated[outfile] = output
+        records = results if type(results) == list else [results]
+        serialize_start = time.perf_counter()
+        data = ''.join(json.dumps({key: item, 'data': record}) + '\n' for record in records)
+        write_start = time.perf_counter()
+        path, first_record = output.append(item=item, data=data, records=records)
+        self.metrics.record_write(outfile=path, serialize_time=write_start - serialize_start,
+                                  write_time=time.perf_counter() - write_start, written_bytes=len(data))
+        if self.event_index is not None:
+            self.event_index.add_records(records=records, path=path, first_record=first_record)
+
+    def close_item(self, outfile: str, item: str, function_name: str = '', summary: dict = None) -> None:
+        """
+        Completes the results of an item that were appended by append_item_results: the summary is kept in the index
+        of the consolidated output
+        """
+        with self._lock:
+            output = self._consolidated.get(outfile)
+        if output is None or not output.has_item(item):
+            self.append_log(f'No results were found for function {function_name}')
+            return
+        output.close_item(item=item, summary=summary)
+
+    def close(self, completed: bool = True):
+        """
+        Closes the consolidated outputs (writing their indexes), writes the evidence manifest of the output files, and
+        flushes and closes the log file and the metrics file
+        @param completed: whether the run was completed. Otherwise, the manifest documents a partial run
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            outputs = list(self._consolidated.values())
+            self._consolidated.clear()
+        for output in outputs:
+            index_file = output.close()
+            self.append_log(f'{output.records} results of {len(output.index)} items for {output.outfile} can be found '
+                            f'here: {output.paths}, index: {index_file}')
+        if self.event_index is not None:
+            self.event_index.close()
+            self.append_log(f'{self.event_index.rows} events were indexed in {self.event_index.path}')
+        self.write_manifest(completed=completed)
+        self._log_writer.close()
+        self.metrics.close()
+
+    def write_manifest(self, completed: bool = False) -> str:
+        """
+        Writes the evidence manifest of the files that were written so far: SHA-256, size, record count and time range
+        of every file, which are computed while the files are written (see EvidenceManifest). May be called during the
+        run, to verify the integrity of a partial collection.
+        @param completed: whether the run was completed
+        @return: the path of the manifest file
+        """
+        manifest_file = self.manifest.write(path=self.manifest_file, completed=completed)
+        self.append_log(f'Evidence manifest ({"completed" if completed else "partial"} run) can be found here: '
+                        f'{manifest_file}', event='manifest', status='completed' if completed else 'partial')
+        return manifest_file
 
-    def append_log(self, data):
+    def _close_interrupted_run(self) -> None:
         """
-        Appends a custom line to the log file
-        @param data: the custom line to append to the log
+        Writes the indexed events and the manifest of a run that exits without being closed (interrupted or failed)
         """
-        with open(self.log_file, 'a') as f:
-            f.write(str(data) + '\n')
+        with self._lock:
+            if self._closed:
+                return
+        if self.event_index is not None:
+            self.event_index.close()
+        self.write_manifest(completed=False)
 
     def _init_folder(self):
         try:
@@ -81,11 +281,208 @@ class FileHandler:
         except:
             raise Exception(f'cannot create folder: {self.folder}')
 
+    @staticmethod
+    def _get_records(results) -> list:
+        """
+        @return: the records of results that are dumped as a single JSON document (wrapped results keep their records
+        under the "data" key, see ModuleHandler._wrap_results)
+        """
+        if type(results) == dict and type(results.get('data')) == list:
+            return results['data']
+        return results if type(results) == list else [results]
+
     @staticmethod
     def _get_time():
         return datetime.utcnow().isoformat(sep='_', timespec='milliseconds').replace(':', '_')
 
 
+class ConsolidatedOutput:
+    """
+    Class ConsolidatedOutput is a single NDJSON output file (optionally rotated by size into several parts) that holds
+    the results of all the items of a function, and the index of the items: item => summary and the chunks
+    (file, byte offset, length, records) that hold the item's lines. Chunks of an item are contiguous, but chunks of
+    different items may interleave when the items are collected concurrently.
+    """
+
+    def __init__(self, file_handler: FileHandler, outfile: str, rotate_size: int = None):
+        self.file_handler = file_handler
+        self.outfile = outfile
+        self.rotate_size = rotate_size
+        self.paths = []
+        self.index = {}  # item => {'chunks': [[path, offset, length, records], ...], 'summary': dict}
+        self.records = 0
+        self._file = None
+        self._size = 0
+        self._part_records = 0
+        self._lock = threading.Lock()
+
+    def append(self, item: str, data: str, records: list) -> tuple:
+        """
+        @param records: the records that the data holds
+        @return: the path of the file the data was appended to, and the line number of the first record in it
+        """
+        encoded = data.encode('utf-8')
+        with self._lock:
+            if self._file is None or (self.rotate_size and self._size > 0 and
+                                      self._size + len(encoded) > self.rotate_size):
+                self._open_part()
+            path = self.paths[-1]
+            first_record = self._part_records
+            self._file.write(encoded)
+            self._file.flush()  # the checkpoint of the item may be saved right after the append
+            self.file_handler.manifest.update(path=path, data=encoded, records=records)
+            self.index.setdefault(item, {'chunks': [], 'summary': None})['chunks'].append(
+                [path, self._size, len(encoded), len(records)])
+            self._size += len(encoded)
+            self._part_records += len(records)
+            self.records += len(records)
+        return path, first_record
+
+    def has_item(self, item: str) -> bool:
+        with self._lock:
+            return item in self.index
+
+    def close_item(self, item: str, summary: dict = None) -> None:
+        with self._lock:
+            self.index[item]['summary'] = summary
+
+    def close(self) -> str:
+        """
+        Closes the output file and writes its index
+        @return: the path of the index file
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        parts = self.outfile.rpartition('.')
+        index_path = self.file_handler._get_output_path(f'{parts[0]}_index.{parts[-1]}')
+        data = json.dumps({'outputs': self.paths, 'records': self.records, 'items': self.index})
+        with open(index_path, 'w') as f:
+            f.write(data)
+        self.file_handler.manifest.update(path=index_path, data=data)
+        return index_path
+
+    def _open_part(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        parts = self.outfile.rpartition('.')
+        part_name = f'{parts[0]}.ndjson' if not self.rotate_size else f'{parts[0]}_part{len(self.paths) + 1}.ndjson'
+        path = self.file_handler._get_output_path(part_name)
+        self._file = open(path, 'ab')
+        self._size = 0
+        self._part_records = 0
+        self.paths.append(path)
+        self.file_handler._add_output_file(outfile=self.outfile, path=path)
+
+
+class LogWriter:
+    """
+    Class LogWriter appends JSON line records to a log file using a single file handle. Records are queued by the
+    callers (safe for concurrent callers) and written by a background thread, which flushes the file periodically, on
+    flush() and on close(). The writer is closed on exit.
+    """
+    FLUSH_INTERVAL = 1.0  # in seconds
+
+    def __init__(self, path: str):
+        """
+        @param path: the path of the log file
+        """
+        self.path = path
+        self._file = open(path, 'a', buffering=64 * 1024)
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='log_writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, record: dict) -> None:
+        with self._lock:
+            if not self._closed:
+                self._queue.put(record)
+                return
+        with open(self.path, 'a') as f:  # records of late callers are written directly
+            f.write(json.dumps(record, default=str) + '\n')
+
+    def flush(self) -> None:
+        """
+        Waits until all the queued records were written and flushed to the file
+        """
+        if self._closed:
+            return
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        flushed.wait()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def _run(self) -> None:
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self._queue.get(timeout=LogWriter.FLUSH_INTERVAL)
+            except queue.Empty:
+                record = False  # periodic flush
+            if isinstance(record, dict):
+                self._file.write(json.dumps(record, default=str) + '\n')
+            if record is None or isinstance(record, threading.Event) or record is False or \
+                    time.monotonic() - last_flush >= LogWriter.FLUSH_INTERVAL:
+                self._file.flush()
+                last_flush = time.monotonic()
+            if isinstance(record, threading.Event):
+                record.set()
+            if record is None:
+                return
+
+
+def parse_time(value: str) -> datetime:
+    """
+    Parses an RFC3339 UTC timestamp, with or without fractional seconds (fractions beyond microseconds are truncated)
+    @param value: the timestamp, e.g. 2022-01-01T00:00:00Z or 2022-01-01T00:00:00.123456789Z
+    @return: the matching datetime
+    """
+    value = value.rstrip('Z')
+    seconds, _, fraction = value.partition('.')
+    parsed = datetime.strptime(seconds, TIME_FORMAT[:-1])
+    return parsed.replace(microsecond=int(fraction[:6].ljust(6, '0'))) if fraction else parsed
+
+
+def format_time(value: datetime) -> str:
+    """
+    @return: the RFC3339 UTC timestamp of a datetime (with microseconds only if it has them)
+    """
+    if value.microsecond:
+        return value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    return value.strftime(TIME_FORMAT)
+
+
+def split_time_range(start_time: str, end_time: str, shards: int, end_inclusive: bool = True) -> list:
+    """
+    Splits a time range into consecutive windows of the same length. Each window includes its start time and excludes
+    its end time, except for the last window which includes the end of the range if end_inclusive is set.
+    @param start_time: the start of the range (RFC3339)
+    @param end_time: the end of the range (RFC3339)
+    @param shards: the number of windows
+    @param end_inclusive: whether the range includes its end time
+    @return: a list of (window start, window end, window end inclusive) tuples, ordered from the oldest window
+    """
+    start, end = parse_time(start_time), parse_time(end_time)
+    shards = max(1, shards)
+    step = (end - start) / shards
+    bounds = [start_time] + [format_time(start + step * i) for i in range(1, shards)] + [end_time]
+    windows = [(bounds[i], bounds[i + 1], False) for i in range(shards)]
+    windows[-1] = (windows[-1][0], windows[-1][1], end_inclusive)
+    return windows
+
+
 class Validators:
     """
     A class of validators for different purposes
@@ -98,11 +495,53 @@ class Validators:
         @param value: the value to check
         """
         try:
-            datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+            datetime.strptime(value, TIME_FORMAT)
             return value
         except ValueError:
             raise argparse.ArgumentTypeError('Time fields should match RFC3339 date format: %Y-%m-%dT%H:%M:%SZ')
 
+    @staticmethod
+    def positive_int(value: str) -> int:
+        """
+        Checks if a value given using argparse is a positive integer
+        @param value: the value to check
+        """
+        try:
+            number = int(value)
+        except ValueError:
+            number = 0
+        if number < 1:
+            raise argparse.ArgumentTypeError(f'{value} is not a positive number')
+        return number
+
+    @staticmethod
+    def non_negative_int(value: str) -> int:
+        """
+        Checks if a value given using argparse is a non-negative integer
+        @param value: the value to check
+        """
+        try:
+            number = int(value)
+        except ValueError:
+            number = -1
+        if number < 0:
+            raise argparse.ArgumentTypeError(f'{value} is not a non-negative number')
+        return number
+
+    @staticmethod
+    def non_negative_float(value: str) -> float:
+        """
+        Checks if a value given using argparse is a non-negative number
+        @param value: the value to check
+        """
+        try:
+            number = float(value)
+        except ValueError:
+            number = -1
+        if not number >= 0:  # also rejects NaN
+            raise argparse.ArgumentTypeError(f'{value} is not a non-negative number')
+        return number
+
     @staticmethod
     def credentials(cred_file: str) -> None:
         """
@@ -119,6 +558,7 @@ class Validators:
 
 class ConsoleFormatter:
     """Class for informative and stylized console output, so each module can handle console output dynamically"""
+    _LOCK = threading.Lock()  # the handlers of the root logger are replaced by concurrent workers
 
     def __init__(self):
         self.BG = "\u001b[32;1m"  # Bright green
@@ -131,16 +571,6 @@ class ConsoleFormatter:
         formatter = logging.Formatter(
             f"[{self.GD}{datetime.utcnow().isoformat(sep=' ', timespec='seconds')}{self.RR}] %(message)s")
         console.setFormatter(formatter)
-        logging.getLogger("").addHandler(console)
-        logging.getLogger().removeHandler(logging.getLogger().handlers[0])
-
-
-class MemoryCache:
-    """Class used to handle file_cache error when using oauth2client >= 4.0.0"""
-    _CACHE = {}
-
-    def get(self, url):
-        return MemoryCache._CACHE.get(url)
-
-    def set(self, url, content):
-        MemoryCache._CACHE[url] = content
+        with ConsoleFormatter._LOCK:
+            logging.getLogger("").addHandler(console)
+            logging.getLogger().removeHandler(logging.getLogger().handlers[0])
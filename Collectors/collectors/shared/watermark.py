@@ -0,0 +1,67 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+WATERMARK_FILE = 'watermarks.json'
+
+
+class WatermarkStore:
+    """
+    Class WatermarkStore keeps the position that incremental collections reached (a Gmail historyId, the time of the
+    latest collected event, etc.) between runs, so the next run collects only what changed since. Unlike checkpoints,
+    watermarks are kept in the cache folder and are not tied to an output folder. The store is loaded on first use and
+    is rewritten atomically on every update.
+    """
+
+    def __init__(self, path: str):
+        """
+        @param path: the path of the watermarks file
+        """
+        self.path = path
+        self._watermarks = None  # key => {'value': ..., 'updated': str}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(module: str, name: str, scope: str) -> str:
+        """
+        @param module: the module of the collection (e.g. "gmail")
+        @param name: the name of the watermark (e.g. "history")
+        @param scope: the entity the watermark is kept for (e.g. the user's email address)
+        @return: the key of the watermark
+        """
+        return f'{module}.{name}:{scope}'
+
+    def get(self, key: str):
+        """
+        @return: the value of the watermark, or None if no collection reached it yet
+        """
+        with self._lock:
+            self._load()
+            watermark = self._watermarks.get(key)
+        return watermark['value'] if watermark is not None else None
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            self._load()
+            self._watermarks[key] = {'value': value, 'updated': datetime.utcnow().isoformat(timespec='seconds')}
+            self._save()
+
+    def _load(self) -> None:
+        if self._watermarks is not None:
+            return
+        self._watermarks = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self._watermarks = json.load(f)
+            except ValueError:
+                logging.info(f'Ignoring the corrupted watermarks file {self.path}')
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._watermarks, f, indent=2)
+        os.replace(temp_path, self.path)  # a killed run never leaves a partially written file
@@ -1,9 +1,6 @@
 #!/usr/bin/env python3
 import sys
 
-from collectors.gcp import main as gcp_main
-from collectors.gw import main as gw_main
-
 
 def arg_error():
     print(
@@ -20,9 +17,12 @@ def main():
         arg_error()
         return
 
+    # only the selected collector (and its dependencies) is imported, keeping the startup of short runs fast
     if args[1] == 'gw':
+        from collectors.gw import main as gw_main
         gw_main()
     elif args[1] == 'gcp':
+        from collectors.gcp import main as gcp_main
         gcp_main()
     else:
         arg_error()